@@ -17,29 +17,38 @@ from sklearn import datasets
 from sklearn.preprocessing import StandardScaler
 from sklearn.cluster import KMeans, DBSCAN
 
+LARGE_INPUT = 100000        # rows above which PCA is fitted incrementally
+PCA_BATCH_SIZE = 10000
+MAX_POINTS = 50000          # points drawn per figure panel; larger inputs are downsampled
 
 # data path
 input_path = Path(Path().parent.parent.absolute(), 'output')
 output_path = Path(Path().parent.parent.absolute(), 'output')
-print('input path', input_path)
-print('output path', output_path)
 
-# kmeans
-def km(n_cluster, df1):
+# fit only; returns the fitted scaler and model (see persistence.py)
+def fit_km(n_cluster, df1):
     scaler = StandardScaler()
-    df1_std = pd.DataFrame(scaler.fit_transform(df))
+    df1_std = scaler.fit_transform(df1.values)
     #df1_std = stats.zscore(df1)
     kmeans = KMeans(n_clusters=n_cluster).fit(df1_std)
+    return scaler, kmeans
+
+# kmeans; labels are added to a copy of df1 (the input is left untouched)
+def km(n_cluster, df1):
+    scaler, kmeans = fit_km(n_cluster, df1)
     labels = kmeans.labels_
     centroids = kmeans.cluster_centers_
+    df1 = df1.copy()
     df1['clusters'] = labels
     print('now with clusters, type of df1:', type(df1), 'dimension:', df1.shape)
-    df['clusters'] = labels
-    print('now with clusters, type of df:', type(df), 'dimension:', df.shape)
-    df_sorted = df.sort_values(by='clusters')
-    df_sorted.to_csv(Path(output_path, 'pca_label.csv'), sep=',', index=False)
+    save_labels(df1)
     return labels, df1
 
+# pca_label.csv: the labelled feature matrix sorted by cluster
+def save_labels(df1):
+    df_sorted = df1.sort_values(by='clusters', kind='stable')
+    df_sorted.to_csv(Path(output_path, 'pca_label.csv'), sep=',', index=False)
+
 def density(df):
     df_std = stats.zscore(df)
     db = DBSCAN(eps=0.1).fit(df_std)
@@ -71,48 +80,53 @@ def componentAnalysis(df):
     plt.show()
 
 
+# 2 component PCA; randomized for medium inputs, incremental (bounded memory) for large inputs
+def _pca2(X):
+    if X.shape[0] > LARGE_INPUT:
+        model = decomposition.IncrementalPCA(n_components=2, batch_size=PCA_BATCH_SIZE)
+    else:
+        model = decomposition.PCA(n_components=2, svd_solver='randomized' if X.shape[0] > PCA_BATCH_SIZE else 'auto', random_state=0)
+    return model, model.fit_transform(X)
+
 # PCA
 def pca(df1, labels, n_cluster):
-    # pca
-    scalar = preprocessing.StandardScaler().fit(df1)
-    df1_std = scalar.transform(df1)
-    pca = decomposition.PCA(n_components=2).fit(df1)
-    pca_std = decomposition.PCA(n_components=2).fit(df1_std)
+    # pca; the cluster labels are not a feature
+    if isinstance(df1, pd.DataFrame):
+        df1 = df1.drop(columns=['clusters'], errors='ignore').values
+    df1 = np.asarray(df1, dtype=np.float64)
+    df1_std = preprocessing.StandardScaler().fit_transform(df1)
+    pca, df1 = _pca2(df1)
+    pca_std, df1_std = _pca2(df1_std)
     print('non-standardized variance ratio (first two components): %s' % str(pca.explained_variance_ratio_))
     print('standardized variance ratio (first two components): %s' % str(pca_std.explained_variance_ratio_))
 
-    df1 = pca.transform(df1)
-    df1_std = pca_std.transform(df1_std)
-    # print('type of df1, ', type(df1), df1.shape)
-    (row, col) = df1_std.shape
-    l = labels.T.reshape(row, 1)
-    df1 = np.concatenate((df1, l), axis=1)
-    coordinates = [np.where(df1[:, 2] == k) for k in range(0, n_cluster)]  # get row number for each cluster label
-    df1_std = np.concatenate((df1_std, l), axis=1)
-    # print('pca result dimension', df1_std.shape, 'first row', df1_std[0:2])
-    coordinates_std = [np.where(df1_std[:, 2] == k) for k in range(0, n_cluster)]
-    print('index of samples in all clusters', coordinates_std)
+    labels = np.asarray(labels)
+    coordinates = [np.flatnonzero(labels == k) for k in range(0, n_cluster)]  # get row number for each cluster label
+    coordinates_std = coordinates
+    print('samples in all clusters', [len(c) for c in coordinates_std])
     return coordinates, coordinates_std, df1, df1_std
 
-# plot
-def plotting(n_cluster, coordinates, coordinates_std, df1, df1_std):
-    # plot non-standardized and standardized together in one figure
-    plt.figure(1)
-    fig1, (ax1, ax2) = plt.subplots(ncols=2, figsize=(10, 4))
+# row numbers to draw: each cluster downsampled to its share of max_points
+def _downsample(coordinates, max_points, seed=0):
+    total = sum(len(c) for c in coordinates)
+    if max_points is None or total <= max_points:
+        return coordinates
+    rng = np.random.default_rng(seed)
+    return [np.sort(rng.choice(c, size=max(1, int(len(c) * max_points / total)), replace=False)) if len(c) > 0 else c for c in coordinates]
+
+# plot; one scatter call per cluster, figures are saved (and only shown if requested)
+def plotting(n_cluster, coordinates, coordinates_std, df1, df1_std, max_points=MAX_POINTS, show=False):
     colors = ['navy', 'tomato', 'turquoise', 'darkorange', 'red', 'orange', 'plum', 'grey', 'olive', 'brown']
     markers = ['^', 's', 'o', 'd', 'x', '1', '2', '3', '4', '*']
-    for color, i, label in zip(colors[0:n_cluster], range(0, n_cluster), markers[0:n_cluster]):
-        print('%d th cluster:' % (i + 1))
-        for j in coordinates[i]:  # row number of cluster i
-            ax1.scatter(df1[j, 0], df1[j, 1], color=color, alpha=.8, label='Cluster %s' % i, marker=label)
-
+    coordinates = _downsample(coordinates, max_points)
+    coordinates_std = _downsample(coordinates_std, max_points)
+    # plot non-standardized and standardized together in one figure
+    fig1, (ax1, ax2) = plt.subplots(ncols=2, figsize=(10, 4))
+    for ax, coords, data in [(ax1, coordinates, df1), (ax2, coordinates_std, df1_std)]:
+        # plot all samples based on clusters, each cluster has its own marker
+        for color, i, label in zip(colors[0:n_cluster], range(0, n_cluster), markers[0:n_cluster]):
+            ax.scatter(data[coords[i], 0], data[coords[i], 1], color=color, alpha=.8, label='Cluster %s' % i, marker=label)
     ax1.set_title('Transformed NON-standardized Dataset after PCA')
-
-    # plot all samples based on clusters, each cluster has its own marker
-    for color, i, label in zip(colors[0:n_cluster], range(0, n_cluster), markers[0:n_cluster]):
-        print('%d th cluster:' % (i + 1))
-        for j in coordinates_std[i]:  # row number of cluster i
-            ax2.scatter(df1_std[j, 0], df1_std[j, 1], color=color, alpha=.8, label='Cluster %s' % i, marker=label)
     ax2.set_title('Transformed Standardized Dataset after PCA')
 
     for ax in (ax1, ax2):
@@ -120,37 +134,41 @@ def plotting(n_cluster, coordinates, coordinates_std, df1, df1_std):
         ax.set_ylabel('$2_{nd}$ Principal Component')
         ax.legend(loc='upper right')
         ax.grid()
-    plt.savefig(Path(output_path, 'pca_normalize_or_not.'))
-    plt.show()
+    fig1.savefig(Path(output_path, 'pca_normalize_or_not.eps'))
 
     # only save pca after standardization
-    plt.figure(2)
-    fig2 = plt.plot()
-    colors = ['navy', 'tomato', 'turquoise', 'darkorange', 'red', 'orange', 'plum', 'grey', 'olive', 'brown']
-    markers = ['^', 's', 'o', 'd', 'x', '1', '2', '3', '4', '*']
+    fig2, ax = plt.subplots()
     for color, i, label in zip(colors[0:n_cluster], range(0, n_cluster), markers[0:n_cluster]):
-        print('%d th cluster:' % (i + 1))
-        for j in coordinates_std[i]:  # row number of cluster i
-            plt.scatter(df1_std[j, 0], df1_std[j, 1], color=color, alpha=.8, label='Cluster %s' % i, marker=label)
-    # plt.title('PCA of Clustered IEC104 Sessions with K = %d' % n_cluster)
-    plt.xlabel('$1^{st}$ Principal Component')
-    plt.ylabel('$2^{nd}$ Crincipal Component')
-    plt.legend(loc='upper right')
-
-    plt.tight_layout()
-    plt.savefig(Path(output_path, 'pca.eps'))
-    plt.show()
+        ax.scatter(df1_std[coordinates_std[i], 0], df1_std[coordinates_std[i], 1], color=color, alpha=.8, label='Cluster %s' % i, marker=label)
+    # ax.set_title('PCA of Clustered IEC104 Sessions with K = %d' % n_cluster)
+    ax.set_xlabel('$1^{st}$ Principal Component')
+    ax.set_ylabel('$2^{nd}$ Principal Component')
+    ax.legend(loc='upper right')
+
+    fig2.tight_layout()
+    fig2.savefig(Path(output_path, 'pca.eps'))
+    if show:
+        plt.show()
+    plt.close(fig1)
+    plt.close(fig2)
+
+# clustering pipeline: feature matrix -> kmeans labels, PCA projections and figures
+def cluster_pipeline(df, n_cluster, max_points=MAX_POINTS, show=False):
+    labels, df = km(n_cluster, df)
+    coordinates, coordinates_std, df1, df1_std = pca(df, labels, n_cluster)
+    plotting(n_cluster, coordinates, coordinates_std, df1, df1_std, max_points, show)
+    return labels, df1, df1_std
 
 if __name__ == '__main__':
+    print('input path', input_path)
+    print('output path', output_path)
     csv_file = 'normal_w_attack.csv'
     #csv_file = 'normal.csv'
     df = pd.read_csv(Path(input_path, csv_file), delimiter=',')
     
     print('current features: \n', df.columns)
     n_cluster = 5
-    labels, df = km(n_cluster, df)
-    coordinates, coordinates_std, df, df_std = pca(df, labels, n_cluster)
-    plotting(n_cluster, coordinates, coordinates_std, df, df_std)
+    labels, df1, df1_std = cluster_pipeline(df, n_cluster)
     #density(df)
     #componentAnalysis(df)
 
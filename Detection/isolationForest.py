@@ -15,18 +15,23 @@ from sklearn.ensemble import IsolationForest
 # data path
 input_path = Path(Path().parent.parent.absolute(), 'output')
 output_path = Path(Path().parent.parent.absolute(), 'output')
-print('input path', input_path)
-print('output path', output_path)
 
 
-def isoForest(df):
+# fit only; returns the fitted scaler and model (see persistence.py)
+def fit_isoforest(df, contamination=0.1):
     scaler = StandardScaler()
-    df_std = pd.DataFrame(scaler.fit_transform(df))
-    model = IsolationForest(contamination=0.1)
+    df_std = scaler.fit_transform(df.values)
+    model = IsolationForest(contamination=contamination)
     model.fit(df_std)
-    df['anomaly'] = pd.Series(model.predict(df_std))
+    return scaler, model
+
+def isoForest(df):
+    scaler, model = fit_isoforest(df)
+    df['anomaly'] = pd.Series(model.predict(scaler.transform(df.values)))
     anomalies = df.loc[df['anomaly'] == -1]
-   
+    plot_anomalies(df, anomalies)
+
+def plot_anomalies(df, anomalies):
     fig, ax = plt.subplots()
     ax.plot(df['Measurement'], '.', color='blue', label='normal')  
     ax.plot(anomalies['Measurement'], '*', color='red', label='abnormal')
@@ -38,6 +43,8 @@ def isoForest(df):
 
 
 if __name__ == '__main__':
+    print('input path', input_path)
+    print('output path', output_path)
     csv_file = 'normal_w_attack.csv'
     df = pd.read_csv(Path(input_path, csv_file), delimiter=',')
     
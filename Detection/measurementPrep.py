@@ -9,28 +9,46 @@ note: here under the same source name, if multiple destination, must manually ch
 
 import pandas as pd
 import numpy as np
-import rtu.preprocessing
 import os
 from pathlib import Path
 
 # add a new column with measurement delta
-def delta_m(df:pd.DataFrame):
+# last: IOA -> last measurement of the previous chunk, updated in place (streaming operation)
+def delta_m(df:pd.DataFrame, last:dict=None):
     if 'IOA' in df.columns:
         groupKey = 'IOA'
     elif 'IOANum' in df.columns:
         groupKey = 'IOANum'
-    dfgroup = df.groupby(groupKey)
-    ioaList = list(df[groupKey].unique())
-    ioaDfs = [dfgroup.get_group(x) for x in ioaList]
-    newIoaDfs = []
-    for ioadf, x in zip(ioaDfs, ioaList):
-        ioadf['deltaM'] = ioadf.Measurement.diff().fillna(0)
-        csvname = 'ioa' + str(x) + '.csv'
-        print('{} is being generated... for ioa {}'.format(csvname, x))
-        ioadf.to_csv(csvname)
-        newIoaDfs.append(ioadf)
-    return newIoaDfs
-    print()
+    df = df.copy()
+    delta = df.groupby(groupKey, sort=False).Measurement.diff()
+    if last is not None:
+        # first row of each IOA in this chunk: difference with the last value of the previous chunk
+        first = ~df[groupKey].duplicated()
+        delta[first] = df.Measurement[first] - df[groupKey][first].map(last)
+        tail = df.drop_duplicates(groupKey, keep='last')
+        last.update(zip(tail[groupKey], tail.Measurement))
+    df['deltaM'] = delta.fillna(0)
+    return df
+
+# streaming delta over a csv file read in chunks
+# output: optional single parquet file with all the chunks (requires pyarrow)
+def delta_m_chunks(csv_file, chunksize=100000, output=None):
+    last = {}
+    writer = None
+    try:
+        for df in pd.read_csv(csv_file, delimiter=',', chunksize=chunksize):
+            df = delta_m(df, last)
+            if output is not None:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(df, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output, table.schema)
+                writer.write_table(table)
+            yield df
+    finally:
+        if writer is not None:
+            writer.close()
 
 # helper to operate on dfcur
 def helper(dfcur: pd.DataFrame):
@@ -97,9 +115,10 @@ if __name__ == '__main__':
         print('input data path is: {}'.format(inpath))
         infile = os.path.join(inpath, '192.168.111.33;192.168.250.3.csv')
         print('file under operation is: {}'.format(infile))
-        df = pd.read_csv(infile, delimiter=',')
-        newIoaDfs = delta_m(df)
+        for df in delta_m_chunks(infile, output='deltaM.parquet'):
+            print('{} rows processed...'.format(df.shape[0]))
     elif choice == 2:
+        import rtu.preprocessing
         print('input data path is: {}'.format(inpath))
         files = [os.path.join(inpath, file) for file in os.listdir(inpath) if
                  os.path.isfile(os.path.join(inpath, file))]
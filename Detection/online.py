@@ -0,0 +1,195 @@
+'''
+Online anomaly detection of IEC104 measurements
+input: live measurements from the SCADA master (nefics.master) or a passive tap (pcap stream)
+model: joblib artifact saved by persistence.py (train command)
+output: one JSON alert per line
+
+Per-IOA sliding-window features are updated incrementally for every measurement, and
+measurements are scored in micro-batches (up to batch_size rows or max_latency seconds).
+
+usage:
+    python online.py model.joblib --rtu 10.0.0.2;2 --rtu 10.0.0.3;3
+    tcpdump -i eth0 -U -w - tcp port 2404 | python online.py model.joblib --tap -
+'''
+import sys
+import json
+import asyncio
+import argparse
+from time import time
+from queue import Queue, Empty
+from threading import Thread
+from collections import deque
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from nefics.master import Master
+from nefics.pcap2csv import read_pcap, decode_tcp, decode_asdu, TCPStream, IEC104_PORT
+from persistence import load_artifact, score_matrix, WINDOW_FEATURES
+
+BATCH_SIZE = 256        # measurements scored at once
+MAX_LATENCY = 0.1       # seconds a measurement waits in a batch before being scored
+TAP_QUEUE_SIZE = 4096   # captured frames read ahead of the detector
+
+# sliding window of one IOA with running sums
+class IOAWindow(object):
+
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+        self.total = 0.0
+        self.squares = 0.0
+        self.last = None
+
+    def update(self, value):
+        if len(self.values) == self.values.maxlen:
+            old = self.values[0]
+            self.total -= old
+            self.squares -= old * old
+        self.values.append(value)
+        self.total += value
+        self.squares += value * value
+        delta = 0.0 if self.last is None else value - self.last
+        self.last = value
+        n = len(self.values)
+        mean = self.total / n
+        std = max(self.squares / n - mean * mean, 0.0) ** 0.5
+        zscore = (value - mean) / std if std > 0 else 0.0
+        return delta, mean, std, zscore
+
+class OnlineDetector(object):
+
+    def __init__(self, artifact, window=None, batch_size=BATCH_SIZE, max_latency=MAX_LATENCY, alert=None):
+        self.artifact = artifact
+        self.features = [WINDOW_FEATURES.index(f) for f in artifact['features']]
+        self.window = window if window is not None else artifact['schema']['window']
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.alert = alert if alert is not None else print_alert
+        self.windows = {}   # (rtu, IOA) -> IOAWindow
+        self.rows = []
+        self.batch = []
+        self.scored = 0
+        self.alerts = 0
+
+    # master subscriber: one measurement dictionary
+    def __call__(self, measurement):
+        value = measurement['value']
+        if value is None:
+            return
+        value = float(value)
+        key = (measurement['rtu'], measurement['ioa'])
+        window = self.windows.get(key, None)
+        if window is None:
+            window = self.windows[key] = IOAWindow(self.window)
+        delta, mean, std, zscore = window.update(value)
+        typeid = measurement['type']
+        self.rows.append((typeid == 3, typeid == 36, typeid == 50, value, delta, mean, std, zscore))
+        self.batch.append((time(), measurement))
+        if len(self.rows) >= self.batch_size:
+            self.score()
+
+    # score the pending micro-batch
+    def score(self):
+        if len(self.rows) == 0:
+            return
+        scores, anomalous = score_matrix(self.artifact, np.array(self.rows, dtype=np.float64)[:, self.features])
+        now = time()
+        for i in np.flatnonzero(anomalous):
+            received, m = self.batch[i]
+            self.alert(dict(m, score=float(scores[i]), latency=now - received))
+        self.scored += len(self.rows)
+        self.alerts += int(anomalous.sum())
+        self.rows = []
+        self.batch = []
+
+    # bounded latency: score whatever is pending every max_latency seconds
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.max_latency)
+            self.score()
+
+def print_alert(alert):
+    sys.stdout.write(json.dumps(alert) + '\n')
+    sys.stdout.flush()
+
+# subscribe to a headless SCADA master connected to the given (address, ASDU) RTUs
+async def run_master(detector, rtus):
+    master = Master()
+    master.subscribe(detector)
+    for address, asdu in rtus:
+        # unreachable RTUs are skipped, the others are still monitored
+        try:
+            await master.connect(address, asdu)
+        except ConnectionError as ex:
+            sys.stderr.write('{}\n'.format(ex))
+            continue
+        if not await master.startdt(address):
+            sys.stderr.write('STARTDT not confirmed by {}\n'.format(address))
+    if len(master.sessions) == 0:
+        sys.stderr.write('No RTU reachable\n')
+        return
+    try:
+        await detector.run()
+    finally:
+        await master.close()
+
+# reader thread of the passive tap: the frames of the pcap stream, then None (or the read error)
+def read_frames(f, frames):
+    try:
+        for record in read_pcap(f):
+            frames.put(record)
+        frames.put(None)
+    except Exception as ex:
+        frames.put(ex)
+
+# passive tap: reassemble IEC104 flows from a pcap stream (file or pipe)
+# the stream is read by another thread, so pending measurements are scored every max_latency seconds even when idle
+def run_tap(detector, f, port=IEC104_PORT):
+    streams = {}
+    frames = Queue(TAP_QUEUE_SIZE)
+    Thread(target=read_frames, args=(f, frames), daemon=True).start()
+    deadline = time() + detector.max_latency
+    while True:
+        try:
+            record = frames.get(timeout=max(deadline - time(), 0.0))
+        except Empty:
+            record = ()
+        if record is None:
+            break
+        if isinstance(record, Exception):
+            detector.score()
+            raise record
+        if record:
+            ts, linktype, frame = record
+            segment = decode_tcp(linktype, frame)
+            if segment is not None and port in [segment[1], segment[3]]:
+                src, sport, dst, dport, seq, flags, payload = segment
+                stream = streams.setdefault((src, sport, dst, dport), TCPStream())
+                stream.add(seq, flags, payload)
+                for apdu in stream.apdus():
+                    ca = apdu[10] | (apdu[11] << 8) if len(apdu) >= 12 else 0
+                    for typeid, cot, ioa, value in decode_asdu(apdu):
+                        detector({'time': ts, 'rtu': src, 'ca': ca, 'ioa': ioa, 'type': typeid, 'cot': cot, 'value': value, 'quality': 0})
+        if time() >= deadline:
+            detector.score()
+            deadline = time() + detector.max_latency
+    detector.score()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Online anomaly detection of IEC104 measurements')
+    parser.add_argument('model', type=str, help='joblib model artifact')
+    parser.add_argument('--rtu', type=str, action='append', default=[], help='RTU to poll: <address>;<ASDU>')
+    parser.add_argument('--tap', type=str, default=None, help='pcap stream to read ("-" for stdin)')
+    parser.add_argument('--window', type=int, default=None, help='window size (default: the model schema window)')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('--max-latency', type=float, default=MAX_LATENCY)
+    args = parser.parse_args()
+    detector = OnlineDetector(load_artifact(args.model), args.window, args.batch_size, args.max_latency)
+    try:
+        if args.tap is not None:
+            run_tap(detector, sys.stdin.buffer if args.tap == '-' else open(args.tap, 'rb'))
+        else:
+            asyncio.run(run_master(detector, [(r.split(';')[0], int(r.split(';')[1])) for r in args.rtu]))
+    except KeyboardInterrupt:
+        pass
+    sys.stderr.write('scored {} measurements, {} alerts\n'.format(detector.scored, detector.alerts))
@@ -4,55 +4,98 @@ This script is to decide the parameters of clustering algorithms
 e.g. best K for Kmeans algorithm
     1. elbow method
     2. silhouette score/coefficient
+K values are fitted in parallel (one process per K), optionally with MiniBatchKMeans,
+and silhouette scores are computed on a sample stratified by cluster label
+results are written as a JSON report
 '''
 from __future__ import print_function
 import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.cm as cm
 import pandas as pd
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
 from sklearn.metrics import silhouette_samples, silhouette_score
 from scipy import stats
-from scipy.spatial.distance import cdist
+from joblib import Parallel, delayed
+import argparse
+import json
 import sys
 from pathlib import Path
-def elbow(km, df):
+
+SAMPLE_SIZE = 10000     # samples used to compute silhouette scores
+
+# indices of a sample of (at most) sample_size rows, stratified by label
+def stratified_sample(labels, sample_size, seed=0):
+    if sample_size is None or len(labels) <= sample_size:
+        return np.arange(len(labels))
+    rng = np.random.default_rng(seed)
+    values, counts = np.unique(labels, return_counts=True)
+    idx = []
+    for value, count in zip(values, counts):
+        n = max(1, int(round(count * sample_size / len(labels))))
+        idx.append(rng.choice(np.flatnonzero(labels == value), size=min(n, count), replace=False))
+    return np.sort(np.concatenate(idx))
+
+# fit one K: distortion on all samples, silhouette (if score) on a stratified sample
+def _fit_k(model, df, sample_size, seed, score=True):
+    model.fit(df)
+    labels = model.labels_
+    distortion = float(np.min(model.transform(df), axis=1).mean())
+    idx = stratified_sample(labels, sample_size, seed) if score else np.arange(0)
+    sample_labels = labels[idx]
+    if len(np.unique(sample_labels)) > 1 and len(idx) > len(np.unique(sample_labels)):
+        sil_each = silhouette_samples(df[idx], sample_labels)
+        sil_avg = float(sil_each.mean())
+    else:
+        sil_each = np.zeros(len(idx))
+        sil_avg = float('nan')
+    return {
+        'k': int(model.n_clusters),
+        'distortion': distortion,
+        'inertia': float(model.inertia_),
+        'silhouette': sil_avg,
+        'sample_size': int(len(idx)),
+        'cluster_sizes': np.bincount(labels, minlength=model.n_clusters).tolist(),
+        'sil_each': sil_each,
+        'sample_labels': sample_labels,
+    }
+
+def sweep(df, Ks, minibatch=False, sample_size=SAMPLE_SIZE, n_jobs=-1, seed=0):
+    df = np.asarray(df, dtype=np.float64)
+    if minibatch:
+        km = [MiniBatchKMeans(n_clusters=k, random_state=seed, n_init=3) for k in Ks]
+    else:
+        km = [KMeans(n_clusters=k, random_state=seed, n_init=10) for k in Ks]
+    return Parallel(n_jobs=n_jobs)(delayed(_fit_k)(km0, df, sample_size, seed) for km0 in km)
+
+def elbow(km, df, n_jobs=-1):
     # following lists all indexed by k
-    kmeans = [km0.fit(df) for km0 in km]
-    centroids = [m.cluster_centers_ for m in kmeans]
-    distortions = [sum(np.min(cdist(df, center, 'euclidean'), axis=1)) / df.shape[0] for center in centroids]
+    df = np.asarray(df, dtype=np.float64)
+    results = Parallel(n_jobs=n_jobs)(delayed(_fit_k)(km0, df, None, 0, score=False) for km0 in km)
+    distortions = [r['distortion'] for r in results]
     return (distortions, True)
 
-def silhouette(Ks, km, df, output_path):
+def silhouette(Ks, km, df, output_path, sample_size=SAMPLE_SIZE, n_jobs=-1, results=None):
+    if results is None:
+        df = np.asarray(df, dtype=np.float64)
+        results = Parallel(n_jobs=n_jobs)(delayed(_fit_k)(km0, df, sample_size, 0) for km0 in km)
     score_file = Path(output_path, 'sil_avg.txt')
-    silfile = open(score_file, 'w')  # save the average silhouette score for all clusters
-    # following lists all indexed by k
-    kmeans = [km0.fit(df) for km0 in km]
-    labels = [m.labels_ for m in kmeans]
-    #print('type of labels', type(labels))
-    #print('shape of labels', len(labels))
-    #print('each array size', labels[0].shape)
-    #print('3rd array: ', labels[3])
-    sil_avg = [silhouette_score(df, label) for label in labels]     # average silhouette score for all samples
-    for k in range(len(kmeans)):
-        line = 'For n_cluster = %d, average silhouette score = %.5f\n' % (k+2, sil_avg[k])
-        silfile.write(line)
-        print(line)
-    sil_each = [silhouette_samples(df, label) for label in labels]  # sil score for every sample
-    #print('type and shape of sil_each', type(sil_each[1]), sil_each[1].shape)
-    for n_cluster in Ks:
-        k = Ks.index(n_cluster)
-        # for each k, plot individual figure for silhouette value distribution over all samples
+    with open(score_file, 'w') as silfile:  # save the average silhouette score for all clusters
+        for r in results:
+            line = 'For n_cluster = %d, average silhouette score = %.5f\n' % (r['k'], r['silhouette'])
+            silfile.write(line)
+            print(line)
+    for r in results:
+        n_cluster = r['k']
+        # for each k, plot individual figure for silhouette value distribution over all (sampled) samples
         fig = plt.plot()
         plt.xlim([-1,1])
-        plt.ylim([0, len(df) + (n_cluster + 1) * 10])                       # (n_cluster+1) * 10 is the blank between clusters
+        plt.ylim([0, r['sample_size'] + (n_cluster + 1) * 10])             # (n_cluster+1) * 10 is the blank between clusters
 
         low_y = 0
         print('%d clusters' % n_cluster)
         for i in range(n_cluster):
-            ith_cluster_sil_values = sil_each[k][labels[k] == i]
-            #print('type and shape of %d th_cluster_sil_values' % i, type(ith_cluster_sil_values), ith_cluster_sil_values.shape)
-            ith_cluster_sil_values.sort()
+            ith_cluster_sil_values = np.sort(r['sil_each'][r['sample_labels'] == i])
             size_cluster_i = ith_cluster_sil_values.shape[0]
             high_y = low_y + size_cluster_i
             color = cm.Spectral(float(i) / n_cluster)                       # spread color for each cluster
@@ -62,27 +105,50 @@ def silhouette(Ks, km, df, output_path):
         plt.title('Silhouette scores for clusters with %d clusters' % n_cluster)
         plt.xlabel('Silhouette coefficient values')
         plt.ylabel('Cluster labels')
-        plt.axvline(x=sil_avg[k], color='red', linestyle='--')         # add vertical line to show average sil score
+        plt.axvline(x=r['silhouette'], color='red', linestyle='--')         # add vertical line to show average sil score
         plt.savefig(Path(output_path, ('sil%d.eps' % n_cluster)))
         plt.show()
+    return results
+
+# machine-readable report of a sweep
+def write_report(results, path, **params):
+    report = {
+        'params': params,
+        'results': [{k: v for k, v in r.items() if k not in ['sil_each', 'sample_labels']} for r in results],
+    }
+    valid = [r for r in results if not np.isnan(r['silhouette'])]
+    report['best_k'] = max(valid, key=lambda r: r['silhouette'])['k'] if len(valid) > 0 else None
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    return report
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Choose K for KMeans (elbow and silhouette)')
+    parser.add_argument('--input', type=str, default=None, help='feature CSV (default: ../../output/normal_w_attack.csv)')
+    parser.add_argument('--output', type=str, default=None, help='output directory (default: ../../output)')
+    parser.add_argument('--kmin', type=int, default=2)
+    parser.add_argument('--kmax', type=int, default=9)
+    parser.add_argument('--minibatch', action='store_true', help='use MiniBatchKMeans')
+    parser.add_argument('--sample-size', type=int, default=SAMPLE_SIZE, help='silhouette sample size')
+    parser.add_argument('-j', '--jobs', type=int, default=-1)
+    args = parser.parse_args()
     # getting data
     input_path = Path(Path().parent.parent.absolute(), 'output')
-    output_path = Path(Path().parent.parent.absolute(), 'output')
-    print('input and output path: ', input_path)
-    df = pd.read_csv(Path(input_path, 'normal_w_attack.csv'), delimiter=',')
+    output_path = Path(args.output) if args.output else Path(Path().parent.parent.absolute(), 'output')
+    print('input and output path: ', input_path, output_path)
+    df = pd.read_csv(args.input if args.input else Path(input_path, 'normal_w_attack.csv'), delimiter=',')
     #df = pd.read_csv(Path(input_path, 'normal.csv'), delimiter=',')
     print('*****************************\ncurrent feature vector is "%s" ' % list(df.columns))
     df_std = stats.zscore(df)
 
     # k value choices
-    Ks = range(2, 10)
-    km = [KMeans(n_clusters=i) for i in Ks]
-    isElbow = False
-    distortions = []
-    (distortions, isElbow) = elbow(km, df_std)
-    silhouette(Ks, km, df_std, output_path)
+    Ks = list(range(args.kmin, args.kmax + 1))
+    results = sweep(df_std, Ks, args.minibatch, args.sample_size, args.jobs)
+    distortions = [r['distortion'] for r in results]
+    isElbow = True
+    silhouette(Ks, None, df_std, output_path, results=results)
+    report = write_report(results, Path(output_path, 'paramDecider.json'), minibatch=args.minibatch, sample_size=args.sample_size, rows=len(df))
+    print('best K by silhouette score: {}'.format(report['best_k']))
 
     # plot elbow
     if isElbow == True:
@@ -94,4 +160,3 @@ if __name__ == '__main__':
         plt.show()
 
     sys.exit(0)
-
@@ -0,0 +1,189 @@
+'''
+Model persistence for the Detection models
+train: fit StandardScaler + IsolationForest/KMeans on feature CSV/Parquet files and save them (joblib)
+score: load the saved artifact and score large CSV/Parquet inputs in chunks using all cores
+
+Artifacts are dictionaries with a versioned feature schema:
+    {'schema': {'version': SCHEMA_VERSION, 'features': [...], 'window': WINDOW},
+     'kind': 'isoforest' | 'kmeans', 'scaler': ..., 'model': ..., 'threshold': KMeans distance threshold,
+     'sklearn': sklearn version used to fit}
+
+Inputs are either feature matrices (preprocessing.feature_creator output) or raw IEC104 CSVs
+(ASDU_Type-CauseTx, IOA, Measurement), from which the features are computed
+
+usage:
+    python persistence.py train model.joblib normal.csv --kind kmeans -k 5
+    python persistence.py score model.joblib capture.csv scores.parquet
+'''
+import sys
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import joblib
+import sklearn
+
+SCHEMA_VERSION = 1
+WINDOW = 32
+CHUNK_SIZE = 200000
+KMEANS_THRESHOLD_PERCENTILE = 99
+DEFAULT_FEATURES = ['type3', 'type36', 'type50', 'Measurement']
+WINDOW_FEATURES = DEFAULT_FEATURES + ['deltaM', 'mean', 'std', 'zscore']
+
+# load an artifact and check its feature schema
+# artifacts without schema (plain {'scaler', 'model'} dictionaries) are version 0 with the default features
+def load_artifact(path):
+    artifact = joblib.load(path)
+    assert isinstance(artifact, dict) and 'model' in artifact.keys()
+    schema = artifact.setdefault('schema', {'version': 0, 'features': artifact.get('features', DEFAULT_FEATURES), 'window': WINDOW})
+    if schema['version'] > SCHEMA_VERSION:
+        raise ValueError('Unsupported feature schema version {} (max. {})'.format(schema['version'], SCHEMA_VERSION))
+    if not all(f in WINDOW_FEATURES for f in schema['features']):
+        raise ValueError('Unknown features in schema: {}'.format(schema['features']))
+    artifact.setdefault('scaler', None)
+    artifact.setdefault('threshold', None)
+    artifact.setdefault('kind', 'isoforest' if hasattr(artifact['model'], 'score_samples') else 'kmeans')
+    artifact['features'] = schema['features']
+    if artifact['kind'] == 'kmeans' and artifact['threshold'] is None:
+        raise ValueError('KMeans artifacts require a distance threshold')
+    return artifact
+
+def save_artifact(path, kind, scaler, model, features, threshold=None, window=WINDOW):
+    joblib.dump({
+        'schema': {'version': SCHEMA_VERSION, 'features': list(features), 'window': window},
+        'kind': kind,
+        'scaler': scaler,
+        'model': model,
+        'threshold': threshold,
+        'sklearn': sklearn.__version__,
+    }, path)
+
+# feature matrix of a raw IEC104 frame; same definition as the per-IOA windows of online.py
+# context: rows of the previous chunk used to fill the windows, not included in the output
+def raw_features(df, window=WINDOW, context=None):
+    n = len(df)
+    if context is not None:
+        df = pd.concat([context, df], ignore_index=True)
+    typeid = df['ASDU_Type-CauseTx'].astype(str).str.split('-', n=1).str[0]
+    out = pd.DataFrame({'type' + t: (typeid == t).astype(np.int64) for t in ['3', '36', '50']})
+    out['Measurement'] = df['Measurement'].astype(np.float64).values
+    group = out['Measurement'].groupby(df['IOA'].values, sort=False)
+    out['deltaM'] = group.diff().fillna(0).values
+    rolling = group.rolling(window, min_periods=1)
+    out['mean'] = rolling.mean().reset_index(level=0, drop=True).sort_index()
+    out['std'] = rolling.std(ddof=0).reset_index(level=0, drop=True).sort_index()
+    out['zscore'] = ((out['Measurement'] - out['mean']) / out['std'].where(out['std'] > 0)).fillna(0)
+    return out.iloc[len(out) - n:].reset_index(drop=True)
+
+def _read(path, chunksize=None):
+    path = str(path)
+    if path.endswith('.parquet'):
+        if chunksize is None:
+            return pd.read_parquet(path)
+        import pyarrow.parquet as pq
+        return (b.to_pandas() for b in pq.ParquetFile(path).iter_batches(batch_size=chunksize))
+    return pd.read_csv(path, delimiter=',', chunksize=chunksize)
+
+# feature chunks of an input file: feature matrices are read as is, raw files are converted
+def iter_features(path, features, window=WINDOW, chunksize=CHUNK_SIZE):
+    context = None
+    for df in _read(path, chunksize):
+        if all(f in df.columns for f in features):
+            yield df, df[features]
+            continue
+        X = raw_features(df, window, context)
+        # keep the last rows of each IOA to fill the windows of the next chunk
+        tail = df.groupby('IOA', sort=False).tail(window)
+        context = tail if context is None else pd.concat([context, tail]).groupby('IOA', sort=False).tail(window)
+        yield df, X[features]
+
+# (scores, anomalous) of a feature matrix; lower scores are more anomalous for IsolationForest,
+# higher scores (distance to the nearest centroid) for KMeans
+def score_matrix(artifact, X):
+    X = np.asarray(X, dtype=np.float64)
+    if artifact['scaler'] is not None:
+        X = artifact['scaler'].transform(X)
+    model = artifact['model']
+    if artifact['kind'] == 'isoforest':
+        return model.score_samples(X), model.predict(X) == -1
+    distances = model.transform(X).min(axis=1)
+    return distances, distances > artifact['threshold']
+
+def train(model_path, inputs, kind='isoforest', n_cluster=5, contamination=0.1, features=DEFAULT_FEATURES, window=WINDOW):
+    from isolationForest import fit_isoforest
+    from clustering import fit_km
+    X = pd.concat([X for path in inputs for _, X in iter_features(path, features, window)], ignore_index=True)
+    threshold = None
+    if kind == 'isoforest':
+        scaler, model = fit_isoforest(X, contamination)
+    else:
+        scaler, model = fit_km(n_cluster, X)
+        distances = model.transform(scaler.transform(X.values)).min(axis=1)
+        threshold = float(np.percentile(distances, KMEANS_THRESHOLD_PERCENTILE))
+    save_artifact(model_path, kind, scaler, model, features, threshold, window)
+    print('trained {} on {} samples with features {}'.format(kind, len(X), features))
+
+def _score_chunk(artifact, df, X):
+    scores, anomalous = score_matrix(artifact, X.values)
+    df = df.copy()
+    df['score'] = scores
+    df['anomaly'] = np.where(anomalous, -1, 1)
+    return df
+
+# chunks are written to the output as they are scored, so the output is never held in memory
+# returns (samples, anomalies)
+def score(model_path, input_path, output_path, chunksize=CHUNK_SIZE, n_jobs=-1):
+    artifact = load_artifact(model_path)
+    chunks = joblib.Parallel(n_jobs=n_jobs, return_as='generator')(
+        joblib.delayed(_score_chunk)(artifact, df, X)
+        for df, X in iter_features(input_path, artifact['features'], artifact['schema']['window'], chunksize))
+    parquet = str(output_path).endswith('.parquet')
+    samples, anomalies, writer = 0, 0, None
+    try:
+        for chunk in chunks:
+            if parquet:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(chunk, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(str(output_path), table.schema)
+                writer.write_table(table.cast(writer.schema))
+            else:
+                chunk.to_csv(output_path, sep=',', index=False, mode='w' if samples == 0 else 'a', header=samples == 0)
+            samples += len(chunk)
+            anomalies += int((chunk['anomaly'] == -1).sum())
+    finally:
+        if writer is not None:
+            writer.close()
+    if samples == 0:
+        # empty input, empty output
+        if parquet:
+            pd.DataFrame().to_parquet(output_path, index=False)
+        else:
+            pd.DataFrame().to_csv(output_path, sep=',', index=False)
+    print('scored {} samples, {} anomalies'.format(samples, anomalies))
+    return samples, anomalies
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Train and score the Detection models')
+    commands = parser.add_subparsers(dest='command', required=True)
+    t = commands.add_parser('train')
+    t.add_argument('model', type=str, help='output joblib artifact')
+    t.add_argument('inputs', type=str, nargs='+', help='feature or raw CSV/Parquet files')
+    t.add_argument('--kind', choices=['isoforest', 'kmeans'], default='isoforest')
+    t.add_argument('-k', '--clusters', type=int, default=5)
+    t.add_argument('--contamination', type=float, default=0.1)
+    t.add_argument('--features', type=str, nargs='+', choices=WINDOW_FEATURES, default=DEFAULT_FEATURES)
+    t.add_argument('--window', type=int, default=WINDOW)
+    s = commands.add_parser('score')
+    s.add_argument('model', type=str, help='joblib artifact')
+    s.add_argument('input', type=str, help='feature or raw CSV/Parquet file')
+    s.add_argument('output', type=str, help='output CSV/Parquet file with score and anomaly columns')
+    s.add_argument('--chunksize', type=int, default=CHUNK_SIZE)
+    s.add_argument('-j', '--jobs', type=int, default=-1)
+    args = parser.parse_args()
+    if args.command == 'train':
+        train(args.model, args.inputs, args.kind, args.clusters, args.contamination, args.features, args.window)
+    else:
+        score(args.model, args.input, args.output, args.chunksize, args.jobs)
+    sys.exit(0)
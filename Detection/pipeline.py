@@ -0,0 +1,138 @@
+'''
+Batch runner for the Detection pipeline
+stages: preprocessing (per file, process pool) -> feature concatenation -> kmeans + PCA -> plots
+input: directory with IEC104 CSV files (srcIP, dstIP, ASDU_Type-CauseTx, IOA, Measurement)
+output: feature matrix (normal_w_attack.csv), pca_label.csv and the PCA figures
+
+Each stage output is cached (pickle) under <output>/.cache, keyed by the hashes of the
+input files and the stage parameters; stages whose key did not change are skipped, but
+their output files are always written again from the cache. Only the cache entries of
+the last run are kept.
+
+usage:
+    python pipeline.py input/normal_w_attack output -k 5 -j 8
+'''
+import sys
+import json
+import hashlib
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+
+import preprocessing
+import clustering
+
+PIPELINE_VERSION = 1
+HASH_BLOCK = 1 << 20
+FIGURES = ['pca_normalize_or_not.eps', 'pca.eps']  # written by clustering.plotting
+
+def file_hash(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(HASH_BLOCK), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def stage_key(stage, inputs, **params):
+    h = hashlib.sha256()
+    h.update(json.dumps({'stage': stage, 'version': PIPELINE_VERSION, 'inputs': inputs, 'params': params}, sort_keys=True).encode())
+    return h.hexdigest()[:16]
+
+class StageCache(object):
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def _file(self, stage, key):
+        return Path(self.path, '{}-{}.pkl'.format(stage, key))
+
+    def get(self, stage, key):
+        f = self._file(stage, key)
+        return pd.read_pickle(f) if f.is_file() else None
+
+    # evict: remove the outputs of previous keys of this stage
+    def put(self, stage, key, value, evict=True):
+        if evict:
+            for old in self.path.glob('{}-*.pkl'.format(stage)):
+                old.unlink()
+        pd.to_pickle(value, self._file(stage, key))
+        return value
+
+    def has(self, stage, key):
+        return self._file(stage, key).is_file()
+
+    # remove the outputs of this stage not in keys; returns the amount of removed entries
+    def prune(self, stage, keys):
+        keep = set(self._file(stage, k).name for k in keys)
+        removed = 0
+        for old in self.path.glob('{}-*.pkl'.format(stage)):
+            if old.name not in keep:
+                old.unlink()
+                removed += 1
+        return removed
+
+def _preprocess(path):
+    return preprocessing.feature_creator(path)
+
+def run(input_path, output_path, n_cluster=5, jobs=None, plot=True):
+    input_path = Path(input_path)
+    output_path = Path(output_path)
+    output_path.mkdir(parents=True, exist_ok=True)
+    cache = StageCache(Path(output_path, '.cache'))
+    clustering.output_path = output_path
+    files = sorted(f for f in input_path.glob('**/*') if f.is_file())
+    hashes = [file_hash(f) for f in files]
+
+    # stage 1: per file preprocessing in a process pool
+    keys = [stage_key('features', [h]) for h in hashes]
+    todo = [(f, k) for f, k in zip(files, keys) if not cache.has('features', k)]
+    print('preprocessing: {} files, {} cached'.format(len(files), len(files) - len(todo)))
+    if len(todo) > 0:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for (f, k), fv in zip(todo, pool.map(_preprocess, [f for f, _ in todo])):
+                cache.put('features', k, fv, evict=False)
+    # the features of files no longer in the input are not needed anymore
+    cache.prune('features', keys)
+
+    # stage 2: concatenation
+    key = stage_key('concat', keys)
+    final_fv = cache.get('concat', key)
+    if final_fv is None:
+        final_fv = cache.put('concat', key, pd.concat([cache.get('features', k) for k in keys]))
+    final_fv.to_csv(Path(output_path, 'normal_w_attack.csv'), sep=',', index=False)
+    print('final_fv columns: ', list(final_fv.columns), final_fv.shape)
+
+    # stage 3: kmeans + PCA
+    key = stage_key('clusters', [key], n_cluster=n_cluster)
+    result = cache.get('clusters', key)
+    if result is None:
+        labels, df = clustering.km(n_cluster, final_fv)
+        coordinates, coordinates_std, df1, df1_std = clustering.pca(df, labels, n_cluster)
+        result = cache.put('clusters', key, (labels, coordinates, coordinates_std, df1, df1_std))
+    else:
+        # cached clusters: write pca_label.csv again from the cached labels
+        labelled = final_fv.copy()
+        labelled['clusters'] = result[0]
+        clustering.save_labels(labelled)
+    labels, coordinates, coordinates_std, df1, df1_std = result
+
+    # stage 4: figures
+    plot_key = stage_key('plots', [key])
+    if plot and not (cache.has('plots', plot_key) and all(Path(output_path, f).is_file() for f in FIGURES)):
+        clustering.plotting(n_cluster, coordinates, coordinates_std, df1, df1_std)
+        cache.put('plots', plot_key, True)
+    return labels
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the Detection pipeline')
+    parser.add_argument('input', type=str, help='directory with IEC104 CSV files')
+    parser.add_argument('output', type=str, help='output directory')
+    parser.add_argument('-k', '--clusters', type=int, default=5)
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='preprocessing processes (default: CPU count)')
+    parser.add_argument('--no-plot', action='store_true')
+    args = parser.parse_args()
+    run(args.input, args.output, args.clusters, args.jobs, not args.no_plot)
+    print('finished!!!')
+    sys.exit(0)
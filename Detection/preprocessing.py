@@ -25,40 +25,45 @@ def csv_viewer(csv_file):
     df50 = df[df['ASDU_Type-CauseTx'] == '50-1']
     print('type 50: ', df50.shape)
     
+FEATURE_TYPES = ['3', '36', '50']
+
+# one hot encoding of the type id of each IOA (the type of its first row) + measurement
+def _features(df, ioa_types):
+    typeid = df['ASDU_Type-CauseTx'].astype(str).str.split('-', n=1).str[0]
+    first = typeid.groupby(df.IOA, sort=False).first()
+    for ioa, t in first.items():
+        ioa_types.setdefault(ioa, t)
+    typeid = df.IOA.map(ioa_types)
+    # group the rows by IOA in order of appearance, keeping the row order within each IOA
+    codes, _ = pd.factorize(df.IOA)
+    order = np.argsort(codes, kind='stable')
+    fv = pd.DataFrame({'type' + t: (typeid == t).astype(np.int64) for t in FEATURE_TYPES}, index=df.index)
+    fv['Measurement'] = df['Measurement']
+    return fv.iloc[order]
+
 # for each single measurement csv file: 
 # prepare features; current feature: type3 type36 type50 (current voltage) measurement
-def feature_creator(csv_file):
+def feature_creator(csv_file, chunksize=None):
+    if chunksize is not None:
+        return pd.concat(iter_features(csv_file, chunksize))
     df = pd.read_csv(csv_file, delimiter=',')
     print('original dimension: ', df.shape)
-    ioa_list = df.IOA.unique()
-    fv_list = []
-    for ioa in ioa_list:
-        df0 = df[df.IOA == ioa]
-        typeid = df0.iloc[0]['ASDU_Type-CauseTx'].split('-')[0]
-        if typeid == '3':
-            df0.loc[:, 'type3'] = 1
-            df0.loc[:, 'type36'] = 0
-            df0.loc[:, 'type50'] = 0
-        elif typeid == '36':
-            df0.loc[:, 'type36'] = 1
-            df0.loc[:, 'type3'] = 0
-            df0.loc[:, 'type50'] = 0
-        elif typeid == '50':
-            df0.loc[:, 'type50'] = 1
-            df0.loc[:, 'type3'] = 0
-            df0.loc[:, 'type36'] = 0
-        fv = pd.concat([df0['type3'], df0['type36'], df0['type50'], df0['Measurement']], axis = 1)
-        fv_list.append(fv)
-    for fv in fv_list:
-        print('current dimension', fv.shape)
-    return pd.concat(fv_list)
+    return _features(df, {})
+
+# chunked mode for inputs that don't fit in memory: yields the feature matrix of each chunk
+# rows are grouped by IOA within a chunk; the type of each IOA is kept across chunks
+def iter_features(csv_file, chunksize=100000):
+    ioa_types = {}
+    for df in pd.read_csv(csv_file, delimiter=',', chunksize=chunksize):
+        yield _features(df, ioa_types)
 
 # concatenate feature vector from all 
-def concat_feature(csv_files):
+def concat_feature(csv_files, chunksize=None):
     df_list = []
     for f in csv_files:
-        df_list.append(feature_creator(f))   
+        df_list.append(feature_creator(f, chunksize))
     print('Contanetation finished!')
+    return pd.concat(df_list)
 
 if __name__ == "__main__":
     cur_path = Path()
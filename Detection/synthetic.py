@@ -0,0 +1,162 @@
+'''
+Synthetic labeled dataset generator
+drives the simplepowergrid model (Source -> Transmission -> Load, no networking) through randomized
+load profiles and breaker operations, and injects attacks:
+    falsification: the transmission voltage (IOA 1001) is replaced as mitm.py does
+    injection: every breaker is opened by an attacker with select/execute commands, as commander.py does
+output: one CSV per <srcIP>;<dstIP> in the Detection CSV schema plus a label column (1 = attack)
+
+usage:
+    python synthetic.py output --steps 1000000 --scenarios 4 --seed 0
+'''
+import sys
+import argparse
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from nefics.modules.simplepowergrid import parallel_load, transmission_output, load_current
+from nefics.pointtable import BASE_IOA, BREAKER_BASE_IOA
+from nefics.recorder import DETECTION_COLUMNS
+
+# defaults from conf/Source.json, conf/Transmission.json and conf/Load.json
+VOLTAGE = 526315.79
+LOADS = [0.394737, 0.394737, 0.394737]
+LOAD = 12.5
+STATE = 7
+
+SCADA_IP = '10.0.0.100'
+ATTACKER_IP = '10.0.0.66'
+RTU_IPS = {'source': '10.0.0.1', 'transmission': '10.0.0.2', 'load': '10.0.0.3'}
+
+class Scenario(object):
+
+    def __init__(self, steps, dt=1.0, voltage=VOLTAGE, loads=LOADS, load=LOAD, state=STATE,
+                 breaker_rate=1 / 900, falsification_rate=1 / 3600, injection_rate=1 / 7200,
+                 attack_duration=(30, 300)):
+        self.steps = steps
+        self.dt = dt
+        self.voltage = voltage
+        self.loads = loads
+        self.load = load
+        self.state = state
+        self.breaker_rate = breaker_rate            # operator breaker operations per second
+        self.falsification_rate = falsification_rate
+        self.injection_rate = injection_rate
+        self.attack_duration = attack_duration      # seconds (min, max)
+
+# random event intervals: boolean mask of the steps covered, and the start steps
+def _intervals(rng, steps, rate, duration, dt):
+    starts = np.flatnonzero(rng.random(steps) < rate * dt)
+    mask = np.zeros(steps + 1, dtype=np.int64)
+    lengths = rng.integers(int(duration[0] / dt), int(duration[1] / dt) + 1, size=len(starts))
+    np.add.at(mask, starts, 1)
+    np.add.at(mask, np.minimum(starts + lengths, steps), -1)
+    return np.cumsum(mask)[:steps] > 0, starts
+
+# breaker state per step: operator toggles a random breaker, never opening the last closed one
+def _breaker_states(rng, sc):
+    n = len(sc.loads)
+    events = np.flatnonzero(rng.random(sc.steps) < sc.breaker_rate * sc.dt)
+    states = [sc.state]
+    for bit in rng.integers(0, n, size=len(events)):
+        new = states[-1] ^ (1 << int(bit))
+        states.append(new if new != 0 else states[-1])
+    idx = np.searchsorted(events, np.arange(sc.steps), side='right')
+    return np.asarray(states, dtype=np.int64)[idx]
+
+def simulate(sc, seed=0, start=0.0):
+    rng = np.random.default_rng(seed)
+    t = start + np.arange(sc.steps) * sc.dt
+    # source voltage with small fluctuations
+    voltage = sc.voltage * (1 + 0.001 * rng.standard_normal(sc.steps))
+    # consumer load: daily profile + AR(1) noise
+    period = 86400.0
+    phase = rng.uniform(0, 2 * np.pi)
+    noise = rng.standard_normal(sc.steps) * 0.01
+    ar = pd.Series(noise).ewm(alpha=0.1).mean().values
+    load = sc.load * np.clip(1 + 0.2 * np.sin(2 * np.pi * t / period + phase) + ar, 0.1, None)
+    # breakers, and the command injection: every breaker open during the attack
+    state = _breaker_states(rng, sc)
+    injected, injections = _intervals(rng, sc.steps, sc.injection_rate, sc.attack_duration, sc.dt)
+    state = np.where(injected, 0, state)
+    # grid physics
+    tload = parallel_load(sc.loads, state)
+    vout, tamp = transmission_output(voltage, tload, load)
+    lamp = load_current(vout, load)
+    # value falsification (mitm.py): 520000 + U(1, 1000), then decreasing by 500 + U(1, 100) per new value
+    falsified, falsifications = _intervals(rng, sc.steps, sc.falsification_rate, sc.attack_duration, sc.dt)
+    reported = voltage.copy()
+    if falsified.any():
+        first = np.r_[falsified[0], falsified[1:] & ~falsified[:-1]]
+        segment = np.cumsum(first)
+        base = 520000.0 + rng.integers(100, 100000, size=segment[-1] + 1) / 100.0
+        decrement = np.where(first, 0.0, 500.0 + rng.integers(100, 10000, size=sc.steps) / 100.0)
+        # cumulative decrement restarted at the beginning of each falsified interval
+        cum = np.cumsum(np.where(falsified, decrement, 0.0))
+        offset = np.maximum.accumulate(np.where(first, cum, 0.0))
+        reported = np.where(falsified, base[segment] - (cum - offset), voltage)
+
+    columns = []
+    def add(src, dst, typecot, ioa, value, label, time=t):
+        n = len(time)
+        columns.append(pd.DataFrame({
+            'srcIP': src, 'dstIP': dst, 'Time': time, 'ASDU_Type-CauseTx': typecot,
+            'IOA': np.full(n, ioa, dtype=np.int64), 'Measurement': value, 'label': label.astype(np.int64),
+        }))
+    no = np.zeros(sc.steps, dtype=bool)
+    add(RTU_IPS['source'], SCADA_IP, '36-3', BASE_IOA, voltage, no)
+    add(RTU_IPS['transmission'], SCADA_IP, '36-3', BASE_IOA, reported, falsified)
+    add(RTU_IPS['transmission'], SCADA_IP, '36-3', BASE_IOA + 1, tamp, injected)
+    for i in range(len(sc.loads)):
+        dpi = np.where((state >> i) & 1, 0x01, 0x02)
+        add(RTU_IPS['transmission'], SCADA_IP, '3-3', BREAKER_BASE_IOA + i, dpi, injected)
+    add(RTU_IPS['load'], SCADA_IP, '36-3', BASE_IOA, vout, injected)
+    add(RTU_IPS['load'], SCADA_IP, '36-3', BASE_IOA + 1, lamp, injected)
+    # injected commands: SELECT/EXECUTE (value SE | SCS) and their ActCon
+    if len(injections) > 0:
+        yes = np.ones(len(injections), dtype=bool)
+        for i in range(len(sc.loads)):
+            for k, value in enumerate([1, 0]):
+                time = t[injections] - sc.dt / 2 + k * 0.01
+                add(ATTACKER_IP, RTU_IPS['transmission'], '45-6', BREAKER_BASE_IOA + i, np.full(len(injections), value), yes, time)
+                add(RTU_IPS['transmission'], ATTACKER_IP, '45-7', BREAKER_BASE_IOA + i, np.full(len(injections), value), yes, time + 0.005)
+    df = pd.concat(columns, ignore_index=True)
+    return df.sort_values('Time', kind='stable', ignore_index=True)
+
+def write(df, output, written):
+    for (src, dst), group in df.groupby(['srcIP', 'dstIP'], sort=False):
+        f = Path(output, '{};{}.csv'.format(src, dst))
+        group[DETECTION_COLUMNS + ['label']].to_csv(f, sep=',', index=False, mode='a' if f in written else 'w', header=f not in written)
+        written.add(f)
+
+def generate(output, steps, scenarios=1, seed=0, jobs=-1, **params):
+    Path(output).mkdir(parents=True, exist_ok=True)
+    sc = Scenario(steps, **params)
+    written = set()
+    rows = 0
+    results = Parallel(n_jobs=jobs, return_as='generator')(delayed(simulate)(sc, seed + i, i * steps * sc.dt) for i in range(scenarios))
+    for df in results:
+        write(df, output, written)
+        rows += len(df)
+    return rows, sorted(written)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a labeled IEC104 dataset from the simplepowergrid model')
+    parser.add_argument('output', type=str, help='output directory')
+    parser.add_argument('--steps', type=int, default=86400, help='time steps (seconds) per scenario')
+    parser.add_argument('--scenarios', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-j', '--jobs', type=int, default=-1)
+    parser.add_argument('--breaker-rate', type=float, default=1 / 900)
+    parser.add_argument('--falsification-rate', type=float, default=1 / 3600)
+    parser.add_argument('--injection-rate', type=float, default=1 / 7200)
+    args = parser.parse_args()
+    rows, files = generate(args.output, args.steps, args.scenarios, args.seed, args.jobs,
+                           breaker_rate=args.breaker_rate, falsification_rate=args.falsification_rate, injection_rate=args.injection_rate)
+    for f in files:
+        print(f)
+    print('{} rows generated'.format(rows))
+    sys.exit(0)
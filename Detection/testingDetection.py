@@ -1,4 +1,4 @@
-from src.Detection import preprocessing, paramDecider, clustering, isolationForest
+import preprocessing, paramDecider, clustering, isolationForest
 import csv
 import pandas as pd
 import numpy as np
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+'''
+Load generator and throughput benchmark for the simulated IEC 104 devices.
+
+A simulated Transmission device (nefics.modules.simplepowergrid behind
+an IEC104DeviceHandler, or the legacy nefics.rtu implementation) is run
+in this process on a local ephemeral port. A child process opens the
+requested amount of master sessions, sends STARTDT and then issues
+requests back to back until the end of the run:
+
+    interrogation   general interrogations (C_IC_NA_1), until ActTerm
+    command         select/execute single commands (C_SC_NA_1) on the breakers
+    testfr          TESTFR keepalives
+    mixed           all of the above, in turns
+
+The report contains the request and APDU throughput, the latency
+percentiles of every request type and the CPU time used by the device
+threads. It is written as JSON, so the results of two commits can be
+compared:
+
+    python benchmarks/loadgen.py -n 32 -d 10 -s mixed -o results.json
+    python benchmarks/loadgen.py -n 32 -d 10 -s mixed --compare results.json
+'''
+
+import os
+import sys
+import json
+import struct
+import asyncio
+import argparse
+import tempfile
+import subprocess
+import threading
+from time import time, monotonic, process_time, sleep
+from pathlib import Path
+from multiprocessing import Process, Queue
+from queue import Empty
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent))
+from nefics.pointtable import BREAKER_BASE_IOA
+
+RESULTS_VERSION = 1
+STARTDT = 0x01
+TESTFR = 0x10
+IEC104_W = 8                # Received I-frames acknowledged at once
+REQUEST_TIMEOUT = 15        # Seconds to wait for a confirmation ("T1")
+SAMPLE_INTERVAL = 0.25      # Seconds between CPU samples of the device threads
+SCENARIOS = {
+    'interrogation': ['interrogation'],
+    'command': ['command'],
+    'testfr': ['testfr'],
+    'mixed': ['interrogation', 'command', 'testfr'],
+}
+GUID = 2
+BREAKERS = 3
+LOADS = [0.394737, 0.394737, 0.394737]
+
+def _ioa(address: int) -> bytes:
+    return struct.pack('<I', address)[:3]
+
+class MasterSession(object):
+    '''
+    Minimal IEC 104 master session working on raw frames, so that the
+    load generator spends as little CPU as possible per request.
+    '''
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, ca: int):
+        self.ca = ca
+        self.tx = 0
+        self.rx = 0
+        self.received = 0           # I-frames received
+        self.received_bytes = 0
+        self._reader = reader
+        self._writer = writer
+        self._unacked = 0
+        self._pending = {}          # Expected frame -> Future
+        self._task = asyncio.ensure_future(self._receive_loop())
+
+    async def _receive_loop(self):
+        try:
+            while True:
+                header = await self._reader.readexactly(2)
+                data = await self._reader.readexactly(header[1])
+                self.received_bytes += 2 + len(data)
+                if data[0] & 0x03 == 0x03: # U-frame confirmation
+                    self._resolve(('u', data[0] >> 2), True)
+                elif data[0] & 0x01 == 0 and len(data) > 4: # I-frame
+                    self.received += 1
+                    self.rx = ((struct.unpack_from('<H', data, 0)[0] >> 1) + 1) & 0x7fff
+                    self._unacked += 1
+                    if self._unacked >= IEC104_W:
+                        self._writer.write(struct.pack('<BBBBH', 0x68, 4, 0x01, 0, self.rx << 1))
+                        self._unacked = 0
+                    typeid, cot = data[4], data[6]
+                    if typeid == 100 and cot & 0x3f == 10: # Interrogation ActTerm
+                        self._resolve(('i', 100), True)
+                    elif typeid == 100 and cot & 0x3f != 7: # Negative or unknown
+                        self._resolve(('i', 100), False)
+                    elif typeid == 45 and len(data) >= 14:
+                        self._resolve(('i', 45, data[13] >> 7), cot == 7) # PN bit and unexpected causes are failures
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as ex:
+            for future in self._pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(str(ex)))
+
+    def _resolve(self, key: tuple, result: bool):
+        future = self._pending.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(result)
+
+    async def _request(self, key: tuple, frame: bytes) -> bool:
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        self._writer.write(frame)
+        try:
+            return await asyncio.wait_for(future, REQUEST_TIMEOUT)
+        except asyncio.TimeoutError:
+            self._pending.pop(key, None)
+            return False
+
+    def _iframe(self, asdu: bytes) -> bytes:
+        frame = struct.pack('<BBHH', 0x68, len(asdu) + 4, self.tx << 1, self.rx << 1) + asdu
+        self.tx = (self.tx + 1) & 0x7fff
+        self._unacked = 0
+        return frame
+
+    async def ufunction(self, utype: int) -> bool:
+        return await self._request(('u', utype << 1), bytes([0x68, 4, (utype << 2) | 0x03, 0, 0, 0]))
+
+    async def interrogation(self, qoi: int=20) -> bool:
+        asdu = struct.pack('<BBBBH', 100, 1, 6, 0, self.ca) + _ioa(0) + bytes([qoi])
+        return await self._request(('i', 100), self._iframe(asdu))
+
+    async def command(self, ioa: int, scs: int) -> bool:
+        for se in [1, 0]: # SELECT, then EXECUTE
+            asdu = struct.pack('<BBBBH', 45, 1, 6, 0, self.ca) + _ioa(ioa) + bytes([(se << 7) | scs])
+            if not await self._request(('i', 45, se), self._iframe(asdu)):
+                return False
+        return True
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+async def _session(host: str, port: int, index: int, scenario: list, deadline: float, results: dict):
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), REQUEST_TIMEOUT)
+    except (asyncio.TimeoutError, OSError):
+        results['failed_sessions'] += 1
+        return None
+    session = MasterSession(reader, writer, GUID)
+    try:
+        if not await session.ufunction(STARTDT):
+            results['failed_sessions'] += 1
+            return session
+        ioa = BREAKER_BASE_IOA + index % BREAKERS
+        scs = 0
+        requests = {
+            'interrogation': session.interrogation,
+            'command': lambda: session.command(ioa, scs),
+            'testfr': lambda: session.ufunction(TESTFR),
+        }
+        i = 0
+        while monotonic() < deadline:
+            kind = scenario[i % len(scenario)]
+            start = monotonic()
+            try:
+                done = await requests[kind]()
+            except ConnectionError:
+                results[kind]['errors'] += 1
+                break
+            if done:
+                results[kind]['latency'].append(monotonic() - start)
+            else:
+                results[kind]['errors'] += 1
+            if kind == 'command':
+                scs ^= 1
+            i += 1
+    finally:
+        await session.close()
+    return session
+
+async def generate(host: str, port: int, sessions: int, duration: float, scenario: str) -> dict:
+    '''
+    Run the load generator. Returns the raw results: request latencies
+    per type, received APDUs and elapsed time.
+    '''
+    kinds = SCENARIOS[scenario]
+    results = {k: {'latency': [], 'errors': 0} for k in set(kinds)}
+    results['failed_sessions'] = 0
+    start = monotonic()
+    done = await asyncio.gather(*[
+        _session(host, port, i, kinds[i % len(kinds):] + kinds[:i % len(kinds)], start + duration, results) for i in range(sessions)
+    ])
+    results['elapsed'] = monotonic() - start
+    results['received'] = sum(s.received for s in done if s is not None)
+    results['received_bytes'] = sum(s.received_bytes for s in done if s is not None)
+    return results
+
+def _generator_process(queue: Queue, *args):
+    queue.put(asyncio.run(generate(*args)))
+
+def start_target(target: str, sessions: int) -> tuple:
+    '''
+    Start a simulated Transmission device on a local ephemeral port, serving
+    the given number of concurrent sessions. Returns (port, stop function).
+    '''
+    if target == 'device':
+        from nefics.modules.simplepowergrid import Transmission, IEC104DeviceHandler
+        device = Transmission(GUID, [GUID - 1], [GUID + 1], loads=list(LOADS), state=(1 << BREAKERS) - 1)
+        device._vin = 526315.79 # No source in the benchmark: fixed input voltage
+        handler = IEC104DeviceHandler(device, '127.0.0.1', 0, max_sessions=sessions)
+        handler.start()
+        def stop():
+            handler.terminate = True
+            device.terminate = True
+            handler.join()
+        return handler.port, stop
+    from nefics.rtu import Transmission, RTU_TRANSMISSION
+    cwd = os.getcwd()
+    os.chdir(tempfile.mkdtemp())
+    os.mkdir('logs')
+    rtu = Transmission(guid=GUID, type=RTU_TRANSMISSION, state=(1 << BREAKERS) - 1, loads=list(LOADS),
+                       left=GUID - 1, right=GUID + 1, confok=False, address='127.0.0.1', port=0)
+    os.chdir(cwd)
+    thread = threading.Thread(target=rtu.loop)
+    thread.start()
+    def stop():
+        rtu.terminate = True
+        thread.join()
+    return rtu.sock.getsockname()[1], stop
+
+def _thread_cpu() -> dict:
+    # CPU seconds (user + system) of every thread of this process, by native thread ID
+    ticks = os.sysconf('SC_CLK_TCK')
+    cpu = {}
+    for tid in os.listdir('/proc/self/task'):
+        try:
+            with open(f'/proc/self/task/{tid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        cpu[int(tid)] = (int(fields[11]) + int(fields[12])) / ticks
+    return cpu
+
+def _percentiles(latency: list) -> dict:
+    if len(latency) == 0:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None}
+    p50, p90, p99 = np.percentile(latency, [50, 90, 99]) * 1000
+    return {'p50': p50, 'p90': p90, 'p99': p99, 'max': max(latency) * 1000}
+
+def _commit() -> str:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).absolute().parent).stdout.strip() or None
+    except OSError:
+        return None
+
+def run(target: str='device', sessions: int=16, duration: float=10, scenario: str='mixed') -> dict:
+    '''
+    Benchmark a simulated device. Returns the report dictionary.
+    '''
+    port, stop = start_target(target, sessions)
+    sleep(0.5)
+    before = _thread_cpu()
+    cpu_start = process_time()
+    queue = Queue()
+    generator = Process(target=_generator_process, args=(queue, '127.0.0.1', port, sessions, duration, scenario))
+    generator.start()
+    # The session threads end with their connections: keep the last CPU sample of every thread
+    samples = dict(before)
+    results = None
+    while results is None:
+        samples.update(_thread_cpu())
+        try:
+            results = queue.get(timeout=SAMPLE_INTERVAL)
+        except Empty:
+            if not generator.is_alive():
+                raise RuntimeError('The load generator ended unexpectedly')
+    generator.join()
+    cpu = process_time() - cpu_start
+    stop()
+    threads = {tid: t - before.get(tid, 0.0) for tid, t in samples.items() if tid != threading.main_thread().native_id}
+    elapsed = results['elapsed']
+    requests = {k: v for k, v in results.items() if k in SCENARIOS['mixed']}
+    return {
+        'version': RESULTS_VERSION,
+        'commit': _commit(),
+        'time': time(),
+        'target': target,
+        'scenario': scenario,
+        'sessions': sessions,
+        'duration': elapsed,
+        'failed_sessions': results['failed_sessions'],
+        'throughput': {
+            'requests': sum(len(v['latency']) for v in requests.values()) / elapsed,
+            'apdus': results['received'] / elapsed,
+            'bytes': results['received_bytes'] / elapsed,
+        },
+        'requests': {k: dict(count=len(v['latency']), errors=v['errors'], **_percentiles(v['latency'])) for k, v in requests.items()},
+        'cpu': {
+            'process': cpu,
+            'utilization': cpu / elapsed,
+            'per_session': sum(threads.values()) / sessions,
+            'max_thread': max(threads.values()) if len(threads) > 0 else 0.0,
+        },
+    }
+
+def compare(report: dict, baseline: dict) -> list:
+    '''
+    Ratios (report / baseline) of the throughput and latency metrics.
+    '''
+    lines = []
+    def ratio(name: str, new, old):
+        if new is not None and old:
+            lines.append(f'{name:32s} {old:12.2f} -> {new:12.2f} ({new / old:6.2f}x)')
+    for k in ['requests', 'apdus']:
+        ratio(f'throughput.{k} (/s)', report['throughput'][k], baseline['throughput'].get(k))
+    for kind, stats in report['requests'].items():
+        for p in ['p50', 'p99']:
+            ratio(f'{kind}.{p} (ms)', stats[p], baseline['requests'].get(kind, {}).get(p))
+    ratio('cpu.per_session (s)', report['cpu']['per_session'], baseline['cpu'].get('per_session'))
+    return lines
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='IEC 104 load generator for the simulated devices')
+    parser.add_argument('-t', '--target', choices=['device', 'rtu'], default='device', help='IEC104DeviceHandler (device) or nefics.rtu (rtu)')
+    parser.add_argument('-n', '--sessions', type=int, default=16)
+    parser.add_argument('-d', '--duration', type=float, default=10, help='Seconds')
+    parser.add_argument('-s', '--scenario', choices=list(SCENARIOS.keys()), default='mixed')
+    parser.add_argument('-o', '--output', type=str, default=None, help='JSON report')
+    parser.add_argument('--compare', type=str, default=None, help='JSON report of a previous run')
+    args = parser.parse_args()
+    report = run(args.target, args.sessions, args.duration, args.scenario)
+    sys.stdout.write(json.dumps(report, indent=2) + '\n')
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            sys.stdout.write('\n'.join(compare(report, json.load(f))) + '\n')
+    sys.exit(0)
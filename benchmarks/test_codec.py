@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+'''
+Microbenchmarks of the IEC 104 dissector and builders (pytest-benchmark).
+
+Every TypeId of nefics.IEC104.ioa.IOAS is measured with a realistic ASDU
+(a single information object, or a few as sent by the devices) and with
+the worst case: 127 objects (the maximum NumIx) for the ASDU layer, and
+as many objects as an APDU can carry (253 bytes) for full APDUs.
+
+    python -m pytest benchmarks/test_codec.py --benchmark-only
+    python -m pytest benchmarks/test_codec.py --benchmark-only --benchmark-autosave
+    python -m pytest benchmarks/test_codec.py --benchmark-only --benchmark-compare --benchmark-compare-fail=mean:10%
+'''
+
+import struct
+import pytest
+
+pytest.importorskip('pytest_benchmark')
+
+from nefics.IEC104.dissector import APDU, ASDU, iterate_apdu
+from nefics.IEC104 import fast
+from nefics.IEC104.ioa import IOAS, IOALEN
+from nefics.helper104 import build_104_asdu_packet, extract_104_value
+
+IEC104_APDU_MAXLEN = 253
+IEC104_MAX_NUMIX = 127
+REALISTIC_NUMIX = 3
+TYPEIDS = sorted(IOAS.keys())
+
+def element(typeid: int, index: int, address: bool=True) -> bytes:
+    '''
+    Information object (IOA address and element) of the given type. The
+    element bytes are valid for every field type (floats, qualifiers,
+    time tags), so that every object is fully dissected.
+    '''
+    length = IOALEN[typeid] - 3
+    body = bytes((index + i) % 0x40 for i in range(length))
+    return (struct.pack('<I', 1001 + index)[:3] if address else b'') + body
+
+def asdu(typeid: int, numix: int, sq: bool=False, cot: int=3) -> bytes:
+    header = struct.pack('<BBBBH', typeid, (0x80 if sq else 0x00) | numix, cot, 0, 2)
+    return header + b''.join(element(typeid, i, not sq or i == 0) for i in range(numix))
+
+def apdu(typeid: int, numix: int, sq: bool=False, tx: int=0) -> bytes:
+    data = asdu(typeid, numix, sq)
+    return struct.pack('<BBHH', 0x68, len(data) + 4, tx << 1, 0) + data
+
+def max_numix(typeid: int, sq: bool=False) -> int:
+    # Objects fitting in an APDU
+    room = IEC104_APDU_MAXLEN - 4 - 6
+    if sq:
+        return min(IEC104_MAX_NUMIX, 1 + (room - IOALEN[typeid]) // (IOALEN[typeid] - 3))
+    return min(IEC104_MAX_NUMIX, room // IOALEN[typeid])
+
+@pytest.mark.parametrize('typeid', TYPEIDS)
+@pytest.mark.parametrize('size', ['realistic', 'max'])
+def test_apdu_dissect(benchmark, typeid, size):
+    numix = REALISTIC_NUMIX if size == 'realistic' else max_numix(typeid)
+    data = apdu(typeid, numix)
+    benchmark.group = f'APDU(data) {size:s}'
+    pkt = benchmark(APDU, data)
+    assert pkt['ASDU'].TypeId == typeid
+    assert len(pkt['ASDU'].IOA) == numix
+
+@pytest.mark.parametrize('typeid', TYPEIDS)
+@pytest.mark.parametrize('sq', [False, True], ids=['SQ0', 'SQ1'])
+@pytest.mark.parametrize('numix', [1, IEC104_MAX_NUMIX])
+def test_asdu_dissect(benchmark, typeid, sq, numix):
+    data = asdu(typeid, numix, sq)
+    benchmark.group = f'ASDU.do_dissect {"SQ1" if sq else "SQ0"} NumIx={numix:d}'
+    pkt = benchmark(ASDU, data)
+    assert len(pkt.IOA) == numix
+    assert pkt.IOA[-1].IOA == 1001 + numix - 1 if sq else True
+
+@pytest.mark.parametrize('typeid', TYPEIDS)
+@pytest.mark.parametrize('size', ['realistic', 'max'])
+def test_apdu_build(benchmark, typeid, size):
+    numix = REALISTIC_NUMIX if size == 'realistic' else max_numix(typeid)
+    data = apdu(typeid, numix)
+    pkt = APDU(data)
+    benchmark.group = f'APDU.build {size:s}'
+    assert benchmark(pkt.build) == data
+
+@pytest.mark.parametrize('typeid', TYPEIDS)
+@pytest.mark.parametrize('size', ['realistic', 'max'])
+def test_fast_apdu_dissect(benchmark, typeid, size):
+    numix = REALISTIC_NUMIX if size == 'realistic' else max_numix(typeid)
+    data = apdu(typeid, numix)
+    benchmark.group = f'fast.APDU(data) {size:s}'
+    pkt = benchmark(fast.APDU, data)
+    assert len(pkt['ASDU'].IOA) == numix
+    assert pkt.build() == data
+
+@pytest.mark.parametrize('typeid', TYPEIDS)
+@pytest.mark.parametrize('size', ['realistic', 'max'])
+def test_fast_apdu_build(benchmark, typeid, size):
+    numix = REALISTIC_NUMIX if size == 'realistic' else max_numix(typeid)
+    data = apdu(typeid, numix)
+    pkt = fast.APDU(data)
+    benchmark.group = f'fast.APDU.build {size:s}'
+    assert benchmark(pkt.build) == data
+
+@pytest.mark.parametrize('frames', [1, 8, 32])
+def test_iterate_apdu(benchmark, frames):
+    # Several APDUs received in a single TCP segment
+    data = b''.join(apdu(36 if i % 2 else 3, REALISTIC_NUMIX, tx=i) for i in range(frames))
+    pkt = APDU(data)
+    benchmark.group = 'iterate_apdu'
+    result = benchmark(lambda: list(iterate_apdu(pkt)))
+    assert len(result) == frames
+
+@pytest.mark.parametrize('frames', [1, 8, 32])
+def test_fast_apdus(benchmark, frames):
+    data = b''.join(apdu(36 if i % 2 else 3, REALISTIC_NUMIX, tx=i) for i in range(frames))
+    benchmark.group = 'iterate_apdu'
+    assert len(benchmark(lambda: list(fast.apdus(data)))) == frames
+
+BUILDERS = {
+    3: {'value': 0x02},
+    36: {'value': 526315.79},
+    45: {'SE': 1, 'QU': 0, 'SCS': 1},
+    50: {'value': 12.5},
+}
+
+@pytest.mark.parametrize('typeid', sorted(BUILDERS.keys()))
+def test_build_104_asdu_packet(benchmark, typeid):
+    benchmark.group = 'build_104_asdu_packet'
+    data = benchmark(build_104_asdu_packet, typeid, 2, 1001, 10, 20, 3, **BUILDERS[typeid])
+    assert APDU(data)['ASDU'].TypeId == typeid
+
+@pytest.mark.parametrize('typeid', sorted(BUILDERS.keys()))
+def test_extract_104_value(benchmark, typeid):
+    pkt = APDU(build_104_asdu_packet(typeid, 2, 1001, 10, 20, 3, **BUILDERS[typeid]))
+    benchmark.group = 'extract_104_value'
+    result = benchmark(extract_104_value, pkt)
+    assert result['ioa'] == 1001
+    assert (result['tx'], result['rx']) == (10, 20)
+
+@pytest.mark.parametrize('frame', [b'\x68\x04\x07\x00\x00\x00', b'\x68\x04\x01\x00\x3e\x22'], ids=['U', 'S'])
+def test_control_dissect(benchmark, frame):
+    benchmark.group = 'APDU(data) control frames'
+    assert benchmark(APDU, frame).haslayer('APCI')
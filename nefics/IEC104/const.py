@@ -1,21 +1,6 @@
-TYPEID_ASDU = {
-    0x01: 'M_SP_NA_1 (1)',
-    0x03: 'M_DP_NA_1 (3)',
-    0x05: 'M_ST_NA_1 (5)',
-    0x07: 'M_BO_NA_1 (7)',
-    0x09: 'M_ME_NA_1 (9)',
-    0x0D: 'M_ME_NC_1 (13)',
-    0x1E: 'M_SP_TB_1 (30)',
-    0x1F: 'M_DP_TB_1 (31)',
-    0x24: 'M_ME_TF_1 (36)',
-    0x25: 'M_IT_TB_1 (37)',
-    0x2D: 'C_SC_NA_1 (45)',
-    0x2E: 'C_DC_NA_1 (46)',
-    0x32: 'C_SE_NC_1 (50)',
-    0x46: 'M_EI_NA_1 (70)',
-    0x64: 'C_IC_NA_1 (100)',
-    0x67: 'C_CS_NA_1 (103)',
-}
+from .registry import TYPES
+
+TYPEID_ASDU = {typeid: f'{name:s} ({typeid:d})' for typeid, (name, _) in TYPES.items()}
 
 TYPE_APCI = {
     0x00: 'I (0x00)',
@@ -177,6 +162,13 @@ DCS_ENUM = {
     0x03: 'not permitted'
 }
 
+RCS_ENUM = {
+    0x00: 'not permitted',
+    0x01: 'next step LOWER',
+    0x02: 'next step HIGHER',
+    0x03: 'not permitted'
+}
+
 PN_ENUM = {
     0x00: 'Positive confirm',
     0x40: 'Negative confirm'
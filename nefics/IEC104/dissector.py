@@ -3,12 +3,113 @@
 from struct import unpack, pack
 from scapy.packet import NoPayload, Raw, bind_layers, Padding, Packet, conf
 from scapy.layers.inet import TCP, IP, Ether
-from scapy.fields import XByteField, ByteField, LEShortField, ShortField, PacketListField, ByteEnumField, PacketField, ConditionalField
+from scapy.fields import XByteField, ByteField, LEShortField, ShortField, PacketListField, ByteEnumField, PacketField, ConditionalField, StrField
 from .ioa import IOAS, IOALEN
 from .const import TYPE_APCI, SQ_ENUM, CAUSE_OF_TX, PN_ENUM, TYPEID_ASDU
 from scapy.all import conf
 from copy import deepcopy
 
+class IOAList(list):
+    '''
+    Information objects of a dissected ASDU, decoded when they are
+    indexed or iterated.
+
+    Undecoded objects are kept as None placeholders, and the raw ASDU is
+    referenced through a memoryview. Any modification of the list decodes
+    every object first, so it then behaves as a plain list.
+    '''
+
+    def __init__(self, typeid: int, data: bytes, offset: int, numix: int, sq: bool, parent: Packet=None):
+        super().__init__([None] * numix)
+        self._cls = IOAS[typeid]
+        self._length = IOALEN[typeid]
+        self._data = memoryview(data)
+        self._offset = offset
+        self._sq = sq and numix > 0
+        self._parent = parent
+        self._pending = numix
+        if self._sq:
+            # See 7.2.2.1 of IEC 60870-5-101: only the first object carries the address
+            self._first = unpack('<I', bytes(self._data[offset:offset + 3]).ljust(3, b'\x00') + b'\x00')[0]
+            self.size = self._length + (numix - 1) * (self._length - 3)
+        else:
+            self.size = self._length * numix
+
+    def _decode(self, index: int) -> Packet:
+        ioa = list.__getitem__(self, index)
+        if ioa is None:
+            if self._sq and index > 0:
+                start = self._offset + self._length + (index - 1) * (self._length - 3)
+                element = pack('<I', (self._first + index) & 0xffffff)[:3] + bytes(self._data[start:start + self._length - 3])
+            else:
+                start = self._offset + index * self._length
+                element = bytes(self._data[start:start + self._length])
+            ioa = self._cls(element)
+            if self._parent is not None:
+                ioa.add_parent(self._parent)
+            list.__setitem__(self, index, ioa)
+            self._pending -= 1
+            if self._pending == 0:
+                self._data = None
+        return ioa
+
+    def materialize(self) -> 'IOAList':
+        if self._pending > 0:
+            for i in range(list.__len__(self)):
+                self._decode(i)
+        return self
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._decode(i) for i in range(*index.indices(list.__len__(self)))]
+        return self._decode(index if index >= 0 else index + list.__len__(self))
+
+    def __iter__(self):
+        for i in range(list.__len__(self)):
+            yield self._decode(i)
+
+    def __reversed__(self):
+        for i in reversed(range(list.__len__(self))):
+            yield self._decode(i)
+
+    def __contains__(self, value) -> bool:
+        return any(ioa == value for ioa in self)
+
+    def __eq__(self, other) -> bool:
+        return list(self) == (list(other) if isinstance(other, IOAList) else other)
+
+    def __ne__(self, other) -> bool:
+        return not self == other
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+    def copy(self) -> list:
+        return list(self)
+
+    def index(self, *args) -> int:
+        return list.index(self.materialize(), *args)
+
+    def count(self, value) -> int:
+        return list.count(self.materialize(), value)
+
+    def __reduce_ex__(self, protocol):
+        # Copies and pickles are plain lists of the decoded objects
+        return (list, (list(self),))
+
+    __hash__ = None
+
+def _materializing(name: str):
+    method = getattr(list, name)
+    def wrapper(self, *args, **kwargs):
+        return method(self.materialize(), *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ['__setitem__', '__delitem__', '__iadd__', '__imul__', '__add__', '__mul__', '__rmul__',
+              'append', 'extend', 'insert', 'pop', 'remove', 'clear', 'sort', 'reverse']:
+    setattr(IOAList, _name, _materializing(_name))
+
 class ASDU(Packet):
 
     name = 'IEC 60870-5-104-ASDU'
@@ -21,7 +122,9 @@ class ASDU(Packet):
         ByteField('Test', None),
         ByteField('OA',None),
         LEShortField('Addr',None),
-        PacketListField('IOA', None)
+        PacketListField('IOA', None),
+        # Information objects of the types without description in nefics.IEC104.registry
+        ConditionalField(StrField('RawIOA', b''), lambda pkt: pkt.TypeId is not None and pkt.TypeId not in IOAS),
     ]
 
     def do_dissect(self, s):
@@ -35,40 +138,16 @@ class ASDU(Packet):
         self.Addr = unpack('<H',s[4:6])[0]
         # self.Addr = s[4] # NOTE: For Malformed Packets TypeId = 13
 
-        flag=True
-        list_IOA = list()
-        remain = s[6:]
-        # remain = s[5:] # NOTE: For Malformed Packets TypeId = 13 
-        idx=6
-        # idx=5 # NOTE: For Malformed Packets TypeId = 13
-        i=1
-        typeIOA = IOAS[self.TypeId]
-        lenIOA=IOALEN[self.TypeId]
-        j=0
-        if self.SQ:
-            for i in range(1,self.NumIx+1):
-                if flag:
-                    list_IOA.append(typeIOA(remain[:lenIOA]))
-                    offset= list_IOA[0].IOA
-                    remain = remain[lenIOA:]
-                    idx = idx+lenIOA
-                    lenIOA = lenIOA-3
-                else:
-                    offsetIOA = pack("<H",(i-1)+offset)+b'\x00' # See 7.2.2.1 of IEC 60870-5-101 
-                    remain2 = offsetIOA + remain[:lenIOA]
-                    list_IOA.append(typeIOA(remain2))
-                    remain = remain[lenIOA:]
-                    idx = idx+lenIOA
-                flag=False
-        else:
-            list_IOA = [typeIOA(remain[(x*lenIOA):(x*lenIOA)+lenIOA]) for x in range(self.NumIx)]
-            idx += lenIOA * self.NumIx
-            # for i in range(1,self.NumIx+1):
-            #     list_IOA.append(typeIOA(remain[:lenIOA])) 
-            #     remain = remain[lenIOA:]
-            #     idx = idx+lenIOA
-        self.IOA = list_IOA
-        return s[idx:]
+        if self.TypeId not in IOAS:
+            # Unknown type: keep the information objects as they are
+            self.fields['IOA'] = None
+            self.RawIOA = bytes(s[6:])
+            return b''
+        # The information objects are decoded on demand (see IOAList). The list is
+        # stored as is: assigning it to self.IOA would decode every object.
+        ioas = IOAList(self.TypeId, s, 6, self.NumIx, bool(self.SQ), self)
+        self.fields['IOA'] = ioas
+        return s[6 + ioas.size:]
 
     def do_build(self):
         s = bytearray()
@@ -82,6 +161,8 @@ class ASDU(Packet):
         if self.IOA is not None:
             for i in self.IOA:
                 s += i.build()
+        elif self.TypeId not in IOAS:
+            s += self.RawIOA or b''
         
         return s
 
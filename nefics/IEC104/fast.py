@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+'''
+Struct based IEC 60870-5-104 codec.
+
+A parallel implementation of the APDU, APCI and ASDU layers of
+nefics.IEC104.dissector (and the information objects of
+nefics.IEC104.ioa) on plain slotted objects, decoded and encoded with one
+precompiled struct per TypeId. Attribute names are the same as the fields
+of the scapy packets, and the layers can be looked up the same way:
+
+    apdu = APDU(data)
+    if apdu['APCI'].Type == 0x00 and apdu.haslayer('IOA45'):
+        print(apdu['IOA45'].IOA, apdu['SCO'].SCS)
+    apdu = APDU()/APCI(Type=0x00, Tx=1, Rx=1)/ASDU(TypeId=100, CauseTx=6, Addr=2, IOA=[IOA(100, IOA=0, QOI=20)])
+    sock.send(apdu.build())
+
+The APDU length is always computed when building, and APDU(data) only
+decodes the first APDU of data (see apdus to iterate over a stream).
+scapy packets can be converted with from_scapy and to_scapy.
+'''
+
+import struct
+from .registry import TYPES, FIELD_NAMES
+
+# Flags of the cause of transmission octet and the variable structure qualifier
+COT_TEST = 0x80
+COT_PN = 0x40
+ASDU_SQ = 0x80
+
+APCI_HEADER = struct.Struct('<BBHH')    # START, ApduLen, control fields 1-2, control fields 3-4
+ASDU_HEADER = struct.Struct('<BBBBH')   # TypeId, SQ | NumIx, Test | PN | CauseTx, OA, Addr
+
+DECODE_ERRORS = (IndexError, KeyError, ValueError, struct.error) # Raised when decoding a malformed APDU
+
+class Qualifier(object):
+    '''
+    Single octet made of bit fields, as (name, shift, width) tuples from
+    the most significant bit.
+    '''
+
+    __slots__ = ()
+    BITS = ()
+
+    def __init__(self, *args, **kwargs):
+        for (name, _, _), value in zip(self.BITS, args):
+            setattr(self, name, value)
+        for name, _, _ in self.BITS[len(args):]:
+            setattr(self, name, kwargs.get(name, 0))
+
+    @classmethod
+    def decode(cls, octet: int):
+        qualifier = cls.__new__(cls)
+        for name, shift, width in cls.BITS:
+            setattr(qualifier, name, (octet >> shift) & ((1 << width) - 1))
+        return qualifier
+
+    def __int__(self) -> int:
+        octet = 0
+        for name, shift, width in self.BITS:
+            octet |= (int(getattr(self, name)) & ((1 << width) - 1)) << shift
+        return octet
+
+    def build(self) -> bytes:
+        return bytes([int(self)])
+
+    __bytes__ = build
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and int(self) == int(other)
+
+    def __repr__(self) -> str:
+        return f'<{type(self).__name__:s} ' + ' '.join(f'{name:s}={getattr(self, name)!r}' for name, _, _ in self.BITS) + '>'
+
+class COI(Qualifier):
+    __slots__ = ('I', 'R')
+    BITS = (('I', 7, 1), ('R', 0, 7))
+
+class VTI(Qualifier):
+    __slots__ = ('Transient', 'Value')
+    BITS = (('Transient', 7, 1), ('Value', 0, 7))
+
+class DIQ(Qualifier):
+    # The flags keep their bit positions (IV, NT, SB, BL), as in nefics.IEC104.ioa.DIQ
+    __slots__ = ('DPI', 'flags', 'RES')
+    BITS = (('DPI', 0, 2), ('flags', 4, 4), ('RES', 2, 2))
+
+    @classmethod
+    def decode(cls, octet: int):
+        qualifier = cls.__new__(cls)
+        qualifier.DPI = octet & 0x03
+        qualifier.flags = octet & 0xf0
+        qualifier.RES = (octet >> 2) & 0x03
+        return qualifier
+
+    def __int__(self) -> int:
+        return (int(self.DPI) & 0x03) | (int(self.flags) & 0xf0) | ((self.RES & 0x03) << 2)
+
+class QOS(Qualifier):
+    __slots__ = ('SE', 'QL')
+    BITS = (('SE', 7, 1), ('QL', 0, 7))
+
+class SCO(Qualifier):
+    __slots__ = ('SE', 'QU', 'RES', 'SCS')
+    BITS = (('SE', 7, 1), ('QU', 2, 5), ('RES', 1, 1), ('SCS', 0, 1))
+
+class DCO(Qualifier):
+    __slots__ = ('SE', 'QU', 'DCS')
+    BITS = (('SE', 7, 1), ('QU', 2, 5), ('DCS', 0, 2))
+
+class RCO(Qualifier):
+    __slots__ = ('SE', 'QU', 'RCS')
+    BITS = (('SE', 7, 1), ('QU', 2, 5), ('RCS', 0, 2))
+
+class CP56Time(object):
+    '''
+    Seven octet binary time (CP56Time2a).
+    '''
+
+    __slots__ = ('MS', 'IV', 'RES1', 'Min', 'SU', 'RES2', 'Hour', 'DOW', 'Day', 'RES3', 'Month', 'RES4', 'Year')
+    STRUCT = struct.Struct('<HBBBBB')
+
+    def __init__(self, MS=0, IV=0, Min=0, SU=0, Hour=0, DOW=0, Day=0, Month=0, Year=0, RES1=0, RES2=0, RES3=0, RES4=0):
+        self.MS = MS
+        self.IV = IV
+        self.Min = Min
+        self.SU = SU
+        self.Hour = Hour
+        self.DOW = DOW
+        self.Day = Day
+        self.Month = Month
+        self.Year = Year
+        self.RES1 = RES1
+        self.RES2 = RES2
+        self.RES3 = RES3
+        self.RES4 = RES4
+
+    @classmethod
+    def decode(cls, data: bytes, offset: int=0):
+        ms, minute, hour, day, month, year = cls.STRUCT.unpack_from(data, offset)
+        time = cls.__new__(cls)
+        time.MS = ms
+        time.IV = minute >> 7
+        time.RES1 = (minute >> 6) & 0x01
+        time.Min = minute & 0x3f
+        time.SU = hour >> 7
+        time.RES2 = (hour >> 5) & 0x03
+        time.Hour = hour & 0x1f
+        time.DOW = day >> 5
+        time.Day = day & 0x1f
+        time.RES3 = month >> 4
+        time.Month = month & 0x0f
+        time.RES4 = year >> 7
+        time.Year = year & 0x7f
+        return time
+
+    def build(self) -> bytes:
+        return self.STRUCT.pack(
+            self.MS, (self.IV << 7) | ((self.RES1 & 0x01) << 6) | (self.Min & 0x3f),
+            (self.SU << 7) | ((self.RES2 & 0x03) << 5) | (self.Hour & 0x1f), (self.DOW << 5) | (self.Day & 0x1f),
+            ((self.RES3 & 0x0f) << 4) | (self.Month & 0x0f), ((self.RES4 & 0x01) << 7) | (self.Year & 0x7f)
+        )
+
+    __bytes__ = build
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, CP56Time) and self.build() == other.build()
+
+    def __repr__(self) -> str:
+        return f'<CP56Time {2000 + self.Year:04d}-{self.Month:02d}-{self.Day:02d} {self.Hour:02d}:{self.Min:02d}:{self.MS / 1000:06.3f} IV={self.IV:d} SU={self.SU:d}>'
+
+def _octet(value) -> int:
+    # Qualifiers and flags given as integers, fast qualifiers or scapy packets
+    if value is None:
+        return 0
+    if isinstance(value, int):
+        return value
+    if isinstance(value, Qualifier):
+        return int(value)
+    return bytes(value)[0]
+
+def _time(value) -> bytes:
+    return b'\x00' * 7 if value is None else bytes(value)
+
+def _int(value) -> int:
+    return int(value or 0)
+
+# Element fields of every kind of nefics.IEC104.registry: (struct format, decoder, encoder)
+KINDS = {
+    'u8': ('B', None, _octet),
+    'qds': ('B', None, _octet),
+    'siq': ('B', None, _octet),
+    'i16': ('h', None, _int),
+    'u16': ('H', None, _int),
+    'u24': ('3s', lambda b: int.from_bytes(b, 'little'), lambda v: _int(v).to_bytes(3, 'little')),
+    'i32': ('i', None, _int),
+    'u32': ('I', None, _int),
+    'be32': ('4s', lambda b: int.from_bytes(b, 'big'), lambda v: _int(v).to_bytes(4, 'big')),
+    'f32': ('f', None, lambda v: float(v or 0)),
+    'cp16': ('H', None, _int),
+    'cp56': ('7s', CP56Time.decode, _time),
+    'DIQ': ('B', DIQ.decode, _octet),
+    'VTI': ('B', VTI.decode, _octet),
+    'SCO': ('B', SCO.decode, _octet),
+    'DCO': ('B', DCO.decode, _octet),
+    'RCO': ('B', RCO.decode, _octet),
+    'QOS': ('B', QOS.decode, _octet),
+    'COI': ('B', COI.decode, _octet),
+}
+
+# Element fields of every TypeId: (name, struct format, decoder, encoder)
+ELEMENTS = {typeid: tuple((name,) + KINDS[kind] for name, kind in fields) for typeid, (_, fields) in TYPES.items()}
+
+class IOA(object):
+    '''
+    Information object of any TypeId. Only the fields of its TypeId (see
+    ELEMENTS) are set.
+    '''
+
+    __slots__ = ('TypeId', 'IOA') + FIELD_NAMES
+
+    def __init__(self, TypeId: int, IOA: int=0, **fields):
+        self.TypeId = TypeId
+        self.IOA = IOA
+        for name, _, _, _ in CODECS[TypeId].fields:
+            setattr(self, name, fields.get(name, None))
+
+    @property
+    def name(self) -> str:
+        return f'IOA{self.TypeId:d}'
+
+    @property
+    def fields(self) -> dict:
+        return {name: getattr(self, name) for name in ('IOA',) + CODECS[self.TypeId].names}
+
+    def getfieldval(self, name: str):
+        return getattr(self, name)
+
+    def build(self) -> bytes:
+        return CODECS[self.TypeId].encode(self)
+
+    __bytes__ = build
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, IOA) and self.TypeId == other.TypeId and self.build() == other.build()
+
+    def __repr__(self) -> str:
+        return f'<{self.name:s} ' + ' '.join(f'{name:s}={value!r}' for name, value in self.fields.items()) + '>'
+
+class ElementCodec(object):
+    '''
+    Decoder and encoder of the information objects of a TypeId.
+    '''
+
+    __slots__ = ('typeid', 'fields', 'names', 'struct', 'length', '_decoders', '_encoders')
+
+    def __init__(self, typeid: int, fields: tuple):
+        self.typeid = typeid
+        self.fields = fields
+        self.names = tuple(f[0] for f in fields)
+        self.struct = struct.Struct('<' + ''.join(f[1] for f in fields))
+        self.length = 3 + self.struct.size  # Including the IOA address
+        self._decoders = tuple((name, decoder) for name, _, decoder, _ in fields)
+        self._encoders = tuple((name, encoder) for name, _, _, encoder in fields)
+
+    def decode(self, data: bytes, offset: int, address: int) -> IOA:
+        # Element at data[offset:], the address is decoded by the caller (SQ=1)
+        ioa = IOA.__new__(IOA)
+        ioa.TypeId = self.typeid
+        ioa.IOA = address
+        for (name, decoder), value in zip(self._decoders, self.struct.unpack_from(data, offset)):
+            setattr(ioa, name, value if decoder is None else decoder(value))
+        return ioa
+
+    def encode(self, ioa: IOA, address: bool=True) -> bytes:
+        element = self.struct.pack(*[encoder(getattr(ioa, name)) for name, encoder in self._encoders])
+        if not address:
+            return element
+        return (int(ioa.IOA or 0) & 0xffffff).to_bytes(3, 'little') + element
+
+    def decode_all(self, data: bytes, offset: int, numix: int, sq: bool) -> list:
+        '''
+        Decode up to numix objects starting at data[offset:]. Objects
+        truncated by the end of data are ignored.
+        '''
+        ioas = []
+        length = self.length
+        end = len(data)
+        if sq and numix > 0 and offset + length <= end:
+            address = data[offset] | (data[offset + 1] << 8) | (data[offset + 2] << 16)
+            offset += 3
+            size = length - 3
+            for i in range(min(numix, (end - offset) // size) if size > 0 else numix):
+                ioas.append(self.decode(data, offset + i * size, address + i))
+        elif not sq:
+            for i in range(min(numix, (end - offset) // length)):
+                start = offset + i * length
+                ioas.append(self.decode(data, start + 3, data[start] | (data[start + 1] << 8) | (data[start + 2] << 16)))
+        return ioas
+
+CODECS = {typeid: ElementCodec(typeid, fields) for typeid, fields in ELEMENTS.items()}
+IOALEN = {typeid: codec.length for typeid, codec in CODECS.items()}
+
+class APCI(object):
+    '''
+    Application protocol control information (6 octets).
+    '''
+
+    __slots__ = ('START', 'ApduLen', 'Type', 'UType', 'Tx', 'Rx')
+
+    def __init__(self, START: int=0x68, ApduLen: int=4, Type: int=0x00, UType: int=0x01, Tx: int=0, Rx: int=0):
+        self.START = START
+        self.ApduLen = ApduLen
+        self.Type = Type
+        self.UType = UType
+        self.Tx = Tx
+        self.Rx = Rx
+
+    @classmethod
+    def decode(cls, data: bytes, offset: int=0):
+        start, length, control, rx = APCI_HEADER.unpack_from(data, offset)
+        apci = cls.__new__(cls)
+        apci.START = start
+        apci.ApduLen = length
+        apci.Type = control & 0x03 if control & 0x01 else 0x00
+        apci.UType = (control & 0xfc) >> 2 if apci.Type == 0x03 else None
+        apci.Tx = control >> 1 if apci.Type == 0x00 else 0
+        apci.Rx = rx >> 1 if apci.Type != 0x03 else 0
+        return apci
+
+    def build(self, length: int=None) -> bytes:
+        length = self.ApduLen if length is None else length
+        if self.Type == 0x03:
+            return APCI_HEADER.pack(0x68, length, ((self.UType << 2) & 0xfc) | 0x03, 0)
+        control = ((self.Tx << 1) & 0xfffe) if self.Type == 0x00 else self.Type
+        return APCI_HEADER.pack(0x68, length, control, (self.Rx << 1) & 0xfffe)
+
+    def __repr__(self) -> str:
+        if self.Type == 0x03:
+            return f'<APCI ApduLen={self.ApduLen:d} Type=U UType=0x{self.UType:02x}>'
+        if self.Type == 0x01:
+            return f'<APCI ApduLen={self.ApduLen:d} Type=S Rx={self.Rx:d}>'
+        return f'<APCI ApduLen={self.ApduLen:d} Type=I Tx={self.Tx:d} Rx={self.Rx:d}>'
+
+class ASDU(object):
+    '''
+    Application service data unit. SQ, PN and Test keep their bit
+    positions (0x80, 0x40 and 0x80), as in nefics.IEC104.dissector.ASDU.
+
+    The information objects of types without codec are not decoded: IOA
+    is None and RawIOA holds their octets.
+    '''
+
+    __slots__ = ('TypeId', 'SQ', 'NumIx', 'CauseTx', 'PN', 'Test', 'OA', 'Addr', 'IOA', 'RawIOA')
+
+    def __init__(self, TypeId: int=None, SQ: int=0, NumIx: int=0, CauseTx: int=0, PN: int=0, Test: int=0, OA: int=0, Addr: int=0, IOA: list=None, RawIOA: bytes=b''):
+        self.TypeId = TypeId
+        self.SQ = SQ
+        self.NumIx = NumIx
+        self.CauseTx = CauseTx
+        self.PN = PN
+        self.Test = Test
+        self.OA = OA
+        self.Addr = Addr
+        self.IOA = IOA if IOA is None or isinstance(IOA, list) else [IOA]
+        self.RawIOA = RawIOA
+
+    @classmethod
+    def decode(cls, data: bytes, offset: int=0, end: int=None):
+        '''
+        Decode the ASDU in data[offset:end].
+        '''
+        if end is not None and end < len(data):
+            data = data[:end]
+        typeid, vsq, cot, oa, addr = ASDU_HEADER.unpack_from(data, offset)
+        asdu = cls.__new__(cls)
+        asdu.TypeId = typeid
+        asdu.SQ = vsq & ASDU_SQ
+        asdu.NumIx = vsq & 0x7f
+        asdu.CauseTx = cot & 0x3f
+        asdu.PN = cot & COT_PN
+        asdu.Test = cot & COT_TEST
+        asdu.OA = oa
+        asdu.Addr = addr
+        codec = CODECS.get(typeid, None)
+        if codec is None:
+            asdu.IOA = None
+            asdu.RawIOA = bytes(data[offset + ASDU_HEADER.size:])
+        else:
+            asdu.IOA = codec.decode_all(data, offset + ASDU_HEADER.size, asdu.NumIx, asdu.SQ)
+            asdu.RawIOA = b''
+        return asdu
+
+    def build(self) -> bytes:
+        ioas = self.IOA or []
+        numix = len(ioas) if len(ioas) > 0 else self.NumIx
+        header = ASDU_HEADER.pack(
+            self.TypeId, (ASDU_SQ if self.SQ else 0) | (numix & 0x7f),
+            (COT_TEST if self.Test else 0) | (COT_PN if self.PN else 0) | (self.CauseTx & 0x3f),
+            self.OA or 0, int(self.Addr or 0) & 0xffff
+        )
+        if self.IOA is None:
+            return header + (self.RawIOA or b'')
+        if self.SQ and len(ioas) > 0 and isinstance(ioas[0], IOA):
+            codec = CODECS[self.TypeId]
+            return header + ioas[0].build() + b''.join(codec.encode(i, address=False) for i in ioas[1:])
+        if self.SQ and len(ioas) > 0: # scapy information objects
+            return header + ioas[0].build() + b''.join(i.build()[3:] for i in ioas[1:])
+        return header + b''.join(i.build() for i in ioas)
+
+    __bytes__ = build
+
+    def haslayer(self, name: str) -> bool:
+        return _layer(self, name) is not None
+
+    def getlayer(self, name: str):
+        return _layer(self, name)
+
+    def __getitem__(self, name: str):
+        layer = _layer(self, name)
+        if layer is None:
+            raise IndexError(f'Layer [{name:s}] not found')
+        return layer
+
+    def __repr__(self) -> str:
+        flags = (' SQ' if self.SQ else '') + (' PN' if self.PN else '') + (' Test' if self.Test else '')
+        return f'<ASDU TypeId={self.TypeId} CauseTx={self.CauseTx} Addr={self.Addr}{flags:s} IOA={self.IOA!r}>'
+
+def _layer(asdu: ASDU, name: str):
+    # Information objects (IOA<TypeId>) and their fields, looked up in the first object
+    if asdu is None or not asdu.IOA:
+        return None
+    first = asdu.IOA[0]
+    if name == f'IOA{asdu.TypeId}':
+        return first
+    if name in CODECS[asdu.TypeId].names and isinstance(first, IOA):
+        return getattr(first, name)
+    return None
+
+class APDU(object):
+    '''
+    Application protocol data unit: an APCI, followed by an ASDU for
+    I-frames. APDU(data) decodes the first APDU of data.
+    '''
+
+    __slots__ = ('APCI', 'ASDU')
+
+    def __init__(self, _pkt: bytes=None, APCI: APCI=None, ASDU: ASDU=None):
+        self.APCI = APCI
+        self.ASDU = ASDU
+        if _pkt is not None:
+            self.APCI, self.ASDU = _decode(_pkt, 0)
+
+    def __truediv__(self, layer):
+        # APDU()/APCI(...)/ASDU(...) as with the scapy layers
+        if isinstance(layer, APCI):
+            self.APCI = layer
+        elif isinstance(layer, ASDU):
+            self.ASDU = layer
+        else:
+            raise TypeError(f'Unsupported layer: {type(layer).__name__:s}')
+        return self
+
+    def build(self) -> bytes:
+        if self.APCI.Type == 0x00 and self.ASDU is not None:
+            asdu = self.ASDU.build()
+            return self.APCI.build(4 + len(asdu)) + asdu
+        return self.APCI.build(4)
+
+    __bytes__ = build
+
+    def haslayer(self, name: str) -> bool:
+        return self.getlayer(name) is not None
+
+    def getlayer(self, name: str):
+        if name == 'APCI':
+            return self.APCI
+        if name == 'ASDU':
+            return self.ASDU
+        return _layer(self.ASDU, name)
+
+    def __getitem__(self, name: str):
+        layer = self.getlayer(name)
+        if layer is None:
+            raise IndexError(f'Layer [{name:s}] not found')
+        return layer
+
+    def __repr__(self) -> str:
+        return f'<APDU {self.APCI!r}' + (f' {self.ASDU!r}>' if self.ASDU is not None else '>')
+
+def _decode(data: bytes, offset: int) -> tuple:
+    apci = APCI.decode(data, offset)
+    end = offset + 2 + apci.ApduLen
+    if apci.Type == 0x00 and apci.ApduLen > 4:
+        return apci, ASDU.decode(data, offset + 6, end)
+    return apci, None
+
+def apdus(data: bytes):
+    '''
+    Iterate over the complete APDUs of data (e.g. several APDUs received
+    in a single read). A trailing incomplete APDU is ignored.
+    '''
+    offset = 0
+    while offset + 6 <= len(data) and offset + 2 + data[offset + 1] <= len(data):
+        apdu = APDU.__new__(APDU)
+        apdu.APCI, apdu.ASDU = _decode(data, offset)
+        offset += 2 + data[offset + 1]
+        yield apdu
+
+def from_scapy(pkt):
+    '''
+    Convert a scapy APDU, APCI, ASDU or information object (see
+    nefics.IEC104.ioa.IOAS) to the equivalent object of this module.
+    '''
+    from nefics.IEC104.dissector import APDU as ScapyAPDU, APCI as ScapyAPCI, ASDU as ScapyASDU
+    from nefics.IEC104.ioa import IOAS
+    if isinstance(pkt, (ScapyAPDU, ScapyAPCI)):
+        return APDU(pkt.build())
+    if isinstance(pkt, ScapyASDU):
+        return ASDU.decode(pkt.build())
+    for typeid, cls in IOAS.items():
+        if type(pkt) is cls:
+            return CODECS[typeid].decode_all(pkt.build(), 0, 1, False)[0]
+    raise TypeError(f'Unsupported packet: {type(pkt).__name__:s}')
+
+def to_scapy(obj):
+    '''
+    Convert an APDU, ASDU or information object of this module to the
+    equivalent scapy packet.
+    '''
+    from nefics.IEC104.dissector import APDU as ScapyAPDU, ASDU as ScapyASDU
+    from nefics.IEC104.ioa import IOAS
+    if isinstance(obj, APDU):
+        return ScapyAPDU(obj.build())
+    if isinstance(obj, ASDU):
+        return ScapyASDU(obj.build())
+    if isinstance(obj, IOA):
+        return IOAS[obj.TypeId](obj.build())
+    raise TypeError(f'Unsupported object: {type(obj).__name__:s}')
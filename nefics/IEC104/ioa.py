@@ -1,26 +1,36 @@
 #!/usr/bin/env python3
 
 from struct import unpack
-from scapy.fields import PacketField, LEShortField, ShortField, FlagsField, ByteEnumField, BitEnumField, BitField, XIntField, LEIntField
+from scapy.fields import PacketField, LEShortField, ShortField, FlagsField, ByteEnumField, BitEnumField, BitField, XIntField, LEIntField, LESignedIntField, LEThreeBytesField
 from .fields import IOAID, LEFloatField, ByteField, SignedShortField
-from .const import QDS_FLAGS, DOW_ENUM, SEL_EXEC, DPI_ENUM, DIQ_FLAGS, SIQ_FLAGS, TRANSIENT, QOI_ENUM, R_ENUM, I_ENUM, QU_ENUM, SEL_EXEC, SCS_ENUM, DCS_ENUM
+from .const import QDS_FLAGS, DOW_ENUM, SEL_EXEC, DPI_ENUM, DIQ_FLAGS, SIQ_FLAGS, TRANSIENT, QOI_ENUM, R_ENUM, I_ENUM, QU_ENUM, SEL_EXEC, SCS_ENUM, DCS_ENUM, RCS_ENUM
+from .registry import TYPES, IOALEN
 from scapy.packet import Packet
 
-class COI(Packet):
+class Element(Packet):
+    '''
+    Fixed length part of an information object (qualifiers and time tags).
+    '''
+
+    def extract_padding(self, s):
+        # Leave the following fields to the enclosing information object
+        return b'', s
+
+class COI(Element):
     name = 'COI'
     fields_desc = [
         BitEnumField('I', None, 1, I_ENUM),
         BitEnumField('R', None, 7, R_ENUM),
     ]
 
-class VTI(Packet):
+class VTI(Element):
     name = 'VTI'
     fields_desc = [
         BitEnumField('Transient', None, 1, TRANSIENT),
         BitField('Value', None, 7),
     ]
 
-class DIQ(Packet):
+class DIQ(Element):
     name = 'QDS'
     fields_desc = [
         ByteEnumField('DPI', 0x00, DPI_ENUM),
@@ -37,14 +47,14 @@ class DIQ(Packet):
         s[0] = int(self.DPI) | int(self.flags)
         return bytes(s)
 
-class QOS(Packet):
+class QOS(Element):
     name = 'QOS'
     fields_desc = [
         BitEnumField('SE', 0x00, 1, SEL_EXEC),
         BitField('QL', 0x00, 7),
     ]
 
-class CP56Time(Packet):
+class CP56Time(Element):
 
     name = 'CP56Time'
     fields_desc = [
@@ -63,7 +73,7 @@ class CP56Time(Packet):
         BitField('Year', 0, 7),
     ]
 
-class SCO(Packet):
+class SCO(Element):
     name = 'SCO'
     fields_desc = [
         BitEnumField('SE', 0, 1, SEL_EXEC),
@@ -72,7 +82,7 @@ class SCO(Packet):
         BitEnumField('SCS', 0, 1, SCS_ENUM),
     ]
 
-class DCO(Packet):
+class DCO(Element):
     name = 'DCO'
     fields_desc = [
         BitEnumField('SE', 0, 1, SEL_EXEC),
@@ -80,6 +90,14 @@ class DCO(Packet):
         BitEnumField('DCS', 0, 2, DCS_ENUM)
     ]
 
+class RCO(Element):
+    name = 'RCO'
+    fields_desc = [
+        BitEnumField('SE', 0, 1, SEL_EXEC),
+        BitEnumField('QU', 0, 5, QU_ENUM),
+        BitEnumField('RCS', 0, 2, RCS_ENUM)
+    ]
+
 class IOA1(Packet):
     name = 'IOA'
     fields_desc = [
@@ -199,6 +217,13 @@ class IOA100(Packet):
         ByteEnumField('QOI', None, QOI_ENUM),
     ]
 
+class IOA101(Packet):
+    name = 'IOA'
+    fields_desc = [
+        IOAID('IOA', None),
+        ByteField('QCC', None),
+    ]
+
 class IOA103(Packet):
     name = 'IOA'
     fields_desc = [
@@ -206,40 +231,40 @@ class IOA103(Packet):
         PacketField('CP56Time', None, CP56Time)
     ]
 
-IOAS = {
-    1: IOA1,
-    3: IOA3,
-    5: IOA5,
-    7: IOA7,
-    9: IOA9,
-    13: IOA13,
-    30: IOA30,
-    31: IOA31,
-    36: IOA36,
-    37: IOA37,
-    45: IOA45,
-    46: IOA46,
-    50: IOA50,
-    70: IOA70,
-    100: IOA100,
-    103: IOA103,
+# scapy fields of every kind of nefics.IEC104.registry: (field name) -> field
+FIELDS = {
+    'u8': lambda name: ByteField(name, 0),
+    'qds': lambda name: FlagsField(name, 0x00, 8, QDS_FLAGS),
+    'siq': lambda name: FlagsField(name, 0x00, 8, SIQ_FLAGS),
+    'i16': lambda name: SignedShortField(name, 0),
+    'u16': lambda name: LEShortField(name, 0),
+    'u24': lambda name: LEThreeBytesField(name, 0),
+    'i32': lambda name: LESignedIntField(name, 0),
+    'u32': lambda name: LEIntField(name, 0),
+    'be32': lambda name: XIntField(name, 0x00000000),
+    'f32': lambda name: LEFloatField(name, None),
+    'cp16': lambda name: LEShortField(name, 0),
+    'cp56': lambda name: PacketField(name, None, CP56Time),
+    'DIQ': lambda name: PacketField(name, None, DIQ),
+    'VTI': lambda name: PacketField(name, None, VTI),
+    'SCO': lambda name: PacketField(name, None, SCO),
+    'DCO': lambda name: PacketField(name, None, DCO),
+    'RCO': lambda name: PacketField(name, None, RCO),
+    'QOS': lambda name: PacketField(name, None, QOS),
+    'COI': lambda name: PacketField(name, None, COI),
 }
 
-IOALEN = {
-    1: 4,
-    3: 4,
-    5: 5,
-    7: 8,
-    9: 6,
-    13: 8,
-    30: 10,
-    31: 11,
-    36: 15,
-    37: 25,
-    45: 4,
-    46: 4,
-    50: 8,
-    70: 4,
-    100: 4,
-    103: 10,
-}
+def ioa_class(typeid: int) -> type:
+    '''
+    Generate the information object of a TypeId from its description
+    in nefics.IEC104.registry.TYPES.
+    '''
+    return type(f'IOA{typeid:d}', (Packet,), {
+        '__module__': __name__,
+        'name': 'IOA',
+        'fields_desc': [IOAID('IOA', None)] + [FIELDS[kind](name) for name, kind in TYPES[typeid][1]],
+    })
+
+# Information objects of every registered TypeId: the classes above, or generated ones
+IOAS = {typeid: globals().get(f'IOA{typeid:d}', None) or ioa_class(typeid) for typeid in TYPES.keys()}
+globals().update({cls.__name__: cls for cls in IOAS.values()})
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+'''
+Registry of the IEC 60870-5-101/104 ASDU types.
+
+Every TypeId with fixed-length information objects is described once, as
+its name and the fields of its information element (after the 3 octet
+information object address). The scapy information objects
+(nefics.IEC104.ioa.IOAS), the struct codecs (nefics.IEC104.fast.CODECS),
+the object lengths (IOALEN) and the TypeId names (const.TYPEID_ASDU) are
+generated from it.
+
+Types that are not described here (e.g. F_SG_NA_1, whose segment has a
+variable length, or private types) are not decoded: their information
+objects are kept as raw octets and sent back unchanged.
+'''
+
+# Field kinds -> length in octets
+SIZES = {
+    'u8': 1,        # Unsigned octet (qualifiers without sub-fields)
+    'qds': 1,       # Quality descriptor (IV, NT, SB, BL, OV)
+    'siq': 1,       # Single point information with quality descriptor
+    'i16': 2,       # Little endian signed integer (normalized and scaled values)
+    'u16': 2,       # Little endian unsigned integer
+    'u24': 3,       # Little endian unsigned integer (file lengths)
+    'i32': 4,       # Little endian signed integer (binary counter readings)
+    'u32': 4,       # Little endian unsigned integer (status and change detection)
+    'be32': 4,      # Bitstring of 32 bits
+    'f32': 4,       # IEEE STD 754 short floating point
+    'cp16': 2,      # CP16Time2a: elapsed milliseconds
+    'cp56': 7,      # CP56Time2a
+    'DIQ': 1,       # Double point information with quality descriptor
+    'VTI': 1,       # Value with transient state indication
+    'SCO': 1,       # Single command
+    'DCO': 1,       # Double command
+    'RCO': 1,       # Regulating step command
+    'QOS': 1,       # Qualifier of set-point command
+    'COI': 1,       # Cause of initialization
+}
+
+_TIME = (('CP56Time', 'cp56'),)
+
+# TypeId -> (name, ((field name, kind), ...)). Field names match the existing scapy information objects.
+TYPES = {
+    # Process information in monitor direction
+    1: ('M_SP_NA_1', (('SIQ', 'siq'),)),
+    3: ('M_DP_NA_1', (('DIQ', 'DIQ'),)),
+    5: ('M_ST_NA_1', (('VTI', 'VTI'), ('QDS', 'qds'))),
+    7: ('M_BO_NA_1', (('BSI', 'be32'), ('QDS', 'qds'))),
+    9: ('M_ME_NA_1', (('Value', 'i16'), ('QDS', 'qds'))),
+    11: ('M_ME_NB_1', (('Value', 'i16'), ('QDS', 'qds'))),
+    13: ('M_ME_NC_1', (('Value', 'f32'), ('QDS', 'qds'))),
+    15: ('M_IT_NA_1', (('Binary_Counter', 'i32'), ('SQ', 'u8'))),
+    20: ('M_PS_NA_1', (('SCD', 'u32'), ('QDS', 'qds'))),
+    21: ('M_ME_ND_1', (('Value', 'i16'),)),
+    30: ('M_SP_TB_1', (('SIQ', 'siq'),) + _TIME),
+    31: ('M_DP_TB_1', (('DIQ', 'DIQ'),) + _TIME),
+    32: ('M_ST_TB_1', (('VTI', 'VTI'), ('QDS', 'qds')) + _TIME),
+    33: ('M_BO_TB_1', (('BSI', 'be32'), ('QDS', 'qds')) + _TIME),
+    34: ('M_ME_TD_1', (('Value', 'i16'), ('QDS', 'qds')) + _TIME),
+    35: ('M_ME_TE_1', (('Value', 'i16'), ('QDS', 'qds')) + _TIME),
+    36: ('M_ME_TF_1', (('Value', 'f32'), ('QDS', 'qds')) + _TIME),
+    37: ('M_IT_TB_1', (('Binary_Counter', 'i32'), ('SQ', 'u8')) + _TIME),
+    38: ('M_EP_TD_1', (('SEP', 'u8'), ('CP16Time', 'cp16')) + _TIME),
+    39: ('M_EP_TE_1', (('SPE', 'u8'), ('QDP', 'u8'), ('CP16Time', 'cp16')) + _TIME),
+    40: ('M_EP_TF_1', (('OCI', 'u8'), ('QDP', 'u8'), ('CP16Time', 'cp16')) + _TIME),
+    # Process information in control direction
+    45: ('C_SC_NA_1', (('SCO', 'SCO'),)),
+    46: ('C_DC_NA_1', (('DCO', 'DCO'),)),
+    47: ('C_RC_NA_1', (('RCO', 'RCO'),)),
+    48: ('C_SE_NA_1', (('Value', 'i16'), ('QOS', 'QOS'))),
+    49: ('C_SE_NB_1', (('Value', 'i16'), ('QOS', 'QOS'))),
+    50: ('C_SE_NC_1', (('Value', 'f32'), ('QOS', 'QOS'))),
+    51: ('C_BO_NA_1', (('BSI', 'be32'),)),
+    58: ('C_SC_TA_1', (('SCO', 'SCO'),) + _TIME),
+    59: ('C_DC_TA_1', (('DCO', 'DCO'),) + _TIME),
+    60: ('C_RC_TA_1', (('RCO', 'RCO'),) + _TIME),
+    61: ('C_SE_TA_1', (('Value', 'i16'), ('QOS', 'QOS')) + _TIME),
+    62: ('C_SE_TB_1', (('Value', 'i16'), ('QOS', 'QOS')) + _TIME),
+    63: ('C_SE_TC_1', (('Value', 'f32'), ('QOS', 'QOS')) + _TIME),
+    64: ('C_BO_TA_1', (('BSI', 'be32'),) + _TIME),
+    # System information in monitor direction
+    70: ('M_EI_NA_1', (('COI', 'COI'),)),
+    # System information in control direction
+    100: ('C_IC_NA_1', (('QOI', 'u8'),)),
+    101: ('C_CI_NA_1', (('QCC', 'u8'),)),
+    102: ('C_RD_NA_1', ()),
+    103: ('C_CS_NA_1', _TIME),
+    104: ('C_TS_NA_1', (('FBP', 'u16'),)),
+    105: ('C_RP_NA_1', (('QRP', 'u8'),)),
+    106: ('C_CD_NA_1', (('CP16Time', 'cp16'),)),
+    107: ('C_TS_TA_1', (('TSC', 'u16'),) + _TIME),
+    # Parameter in control direction
+    110: ('P_ME_NA_1', (('Value', 'i16'), ('QPM', 'u8'))),
+    111: ('P_ME_NB_1', (('Value', 'i16'), ('QPM', 'u8'))),
+    112: ('P_ME_NC_1', (('Value', 'f32'), ('QPM', 'u8'))),
+    113: ('P_AC_NA_1', (('QPA', 'u8'),)),
+    # File transfer (F_SG_NA_1, 125, carries a variable length segment)
+    120: ('F_FR_NA_1', (('NOF', 'u16'), ('LOF', 'u24'), ('FRQ', 'u8'))),
+    121: ('F_SR_NA_1', (('NOF', 'u16'), ('NOS', 'u8'), ('LOF', 'u24'), ('SRQ', 'u8'))),
+    122: ('F_SC_NA_1', (('NOF', 'u16'), ('NOS', 'u8'), ('SCQ', 'u8'))),
+    123: ('F_LS_NA_1', (('NOF', 'u16'), ('NOS', 'u8'), ('LSQ', 'u8'), ('CHS', 'u8'))),
+    124: ('F_AF_NA_1', (('NOF', 'u16'), ('NOS', 'u8'), ('AFQ', 'u8'))),
+    126: ('F_DR_TA_1', (('NOF', 'u16'), ('LOF', 'u24'), ('SOF', 'u8')) + _TIME),
+    127: ('F_SC_NB_1', (('NOF', 'u16'), ('StartTime', 'cp56'), ('StopTime', 'cp56'))),
+}
+
+# Length of the information objects of every type, including the address
+IOALEN = {typeid: 3 + sum(SIZES[kind] for _, kind in fields) for typeid, (_, fields) in TYPES.items()}
+
+# Every field name, in order of appearance
+FIELD_NAMES = tuple(dict.fromkeys(name for _, fields in TYPES.values() for name, _ in fields))
@@ -1,15 +1,23 @@
 #!/usr/bin/env python3
 
-from IEC104.dissector import ASDU, APCI, APDU
-from IEC104.ioa import *
+from nefics.IEC104.dissector import ASDU, APCI, APDU
+from nefics.IEC104.ioa import *
+from nefics.IEC104.registry import TYPES
 import time
 from datetime import datetime
 
-APDULEN = {
-    3: 14,
-    36: 25,
-    45: 14,
-    50: 18,
+# APDU length of a single information object of every type: APCI control fields (4) + ASDU header (6) + object
+APDULEN = {typeid: 10 + length for typeid, length in IOALEN.items()}
+
+# Qualifiers built from the keyword arguments of build_104_asdu_packet
+QUALIFIERS = {
+    'DIQ': DIQ,
+    'VTI': VTI,
+    'SCO': SCO,
+    'DCO': DCO,
+    'RCO': RCO,
+    'QOS': QOS,
+    'COI': COI,
 }
 
 def cp56time() -> CP56Time:
@@ -26,20 +34,37 @@ def cp56time() -> CP56Time:
     output = CP56Time(MS = ms, Min = minu, IV = iv, Hour = hour, SU = su, Day = day, DOW = dow, Month = month, Year = year)
     return output
 
+def build_104_ioa(typeASDU: int, ioa: int, **kwargs) -> Packet:
+    '''
+    Build an information object of any type in nefics.IEC104.registry.
+    Fields are taken from the keyword arguments by name, and value sets
+    the value of the type (Value, the DPI of a DIQ or the state of a
+    SIQ). Qualifiers are built from their own fields (e.g. SE, QU and
+    SCS for a SCO), and time tags default to the current time.
+    '''
+    fields = {}
+    for name, kind in TYPES[typeASDU][1]:
+        if name in kwargs:
+            fields[name] = kwargs[name]
+        elif kind == 'cp56':
+            fields[name] = cp56time()
+        elif name == 'Value' and 'value' in kwargs:
+            fields[name] = kwargs['value']
+        elif kind == 'siq' and 'value' in kwargs:
+            fields[name] = int(kwargs['value']) & 0x01
+        elif kind == 'DIQ':
+            fields[name] = DIQ(DPI=kwargs.get('value', 0), flags=0)
+        elif kind in QUALIFIERS:
+            qualifier = QUALIFIERS[kind]
+            fields[name] = qualifier(**{f.name: kwargs[f.name] for f in qualifier.fields_desc if f.name in kwargs})
+    return IOAS[typeASDU](IOA=ioa, **fields)
+
 def build_104_asdu_packet(typeASDU: int, asdu:int, ioa: int, tx: int, rx: int, causeTx:int =1, **kwargs) -> bytes: 
+    if typeASDU not in TYPES:
+        raise ValueError(f'Unsupported ASDU type: {typeASDU}')
     pkt = APDU()
     pkt /= APCI(ApduLen=APDULEN[typeASDU], Type=0x00, Tx=tx, Rx=rx)
-    if typeASDU == 3:
-        pkt /= ASDU(TypeId=typeASDU, SQ=0, NumIx=1, CauseTx=causeTx, Test=0, OA=0, Addr=asdu, IOA=[IOA3(IOA=ioa, DIQ=DIQ(DPI=kwargs['value'], flags=0))])
-    elif typeASDU == 36:
-        ct = cp56time()
-        pkt /= ASDU(TypeId=typeASDU, SQ=0, NumIx=1, CauseTx=causeTx, Test=0, OA=0, Addr=asdu, IOA=[IOA36(IOA=ioa, Value=kwargs['value'], QDS=0x00, CP56Time=ct)])
-    elif typeASDU == 45:
-        pkt /= ASDU(TypeId=typeASDU, SQ=0, NumIx=1, CauseTx=causeTx, Test=0, OA=0, Addr=asdu, IOA=[IOA45(IOA=ioa, SCO=SCO(SE=kwargs['SE'], QU=kwargs['QU'], SCS=kwargs['SCS']))])
-    elif typeASDU == 50:
-        pkt /= ASDU(TypeId=typeASDU, SQ=0, NumIx=1, CauseTx=causeTx, Test=0, OA=0, Addr=asdu, IOA=[IOA50(IOA=ioa, Value=kwargs['value'], QOS=QOS(QL=0, SE=0))])
-    else:
-        raise AttributeError
+    pkt /= ASDU(TypeId=typeASDU, SQ=0, NumIx=1, CauseTx=causeTx, Test=0, OA=0, Addr=asdu, IOA=[build_104_ioa(typeASDU, ioa, **kwargs)])
     if __name__ == '__main__':
         pkt.show()
     return pkt.build()
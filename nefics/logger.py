@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+'''
+Asynchronous logging of the simulated devices, RTUs and SCADA master.
+
+Loggers configured with configure() do not write anything in the calling
+thread: their records are put on a bounded queue and written by a single
+background thread, which formats them and writes them to their file.
+Records below the level of a logger are discarded before any formatting,
+and the arguments of a record are only formatted by the writer, so raw
+frames can be logged as Frame objects and dissected only when written:
+
+    logger = configure('rtu.2', 'logs/rtu2.jsonl', fmt='jsonl')
+    logger.debug('Sending measured data: %s', Frame(data))
+    ...
+    release(logger)
+
+The record arguments must not be modified after being logged (bytes,
+numbers, strings and Frame objects). Log files are rotated once they
+reach max_bytes. Three formats are supported:
+
+    text    <ISO time>\\t[<LEVEL>] :: <message>
+    jsonl   One JSON object per line: time, level, logger, message and,
+            for records with Frame arguments, the hex encoded frames
+    binary  Length prefixed records (see BINARY_RECORD) holding the raw
+            frames, which are not dissected. Read with records().
+
+Binary logs can be converted to JSON lines:
+
+    python -m nefics.logger logs/rtu2.bin
+'''
+
+import io
+import os
+import sys
+import json
+import struct
+import atexit
+import logging
+import argparse
+from datetime import datetime
+from queue import Queue, Full
+from threading import Lock
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LOG_PRIO = {
+    'CRITICAL': 0,
+    'ERROR': 1,
+    'WARNING': 2,
+    'INFO': 3,
+    'DEBUG': 4,
+    0: 'CRITICAL',
+    1: 'ERROR',
+    2: 'WARNING',
+    3: 'INFO',
+    4: 'DEBUG'
+}
+
+# LOG_PRIO -> logging levels
+LEVELS = {
+    0: logging.CRITICAL,
+    1: logging.ERROR,
+    2: logging.WARNING,
+    3: logging.INFO,
+    4: logging.DEBUG
+}
+
+FORMATS = {             # Supported formats -> log file extension
+    'text': 'txt',
+    'jsonl': 'jsonl',
+    'binary': 'bin'
+}
+
+QUEUE_SIZE = 65536                  # Records waiting to be written before new records are dropped
+MAX_BYTES = 16 * 1024 * 1024        # Size of a log file before it is rotated
+BACKUPS = 4                         # Rotated log files kept (<file>.1 ... <file>.4)
+DISABLED = logging.CRITICAL + 1     # Level of the loggers without output
+
+# Binary record header: time (UNIX epoch), level, logger name length, message length, frames length.
+# The frames follow the message, each one prefixed by its length (BINARY_FRAME).
+BINARY_RECORD = struct.Struct('<dBHII')
+BINARY_FRAME = struct.Struct('<H')
+
+class Frame(object):
+    '''
+    Raw APDU octets logged as a record argument. The frame is dissected
+    only when the record is formatted as text (JSON lines and binary
+    records keep the octets).
+    '''
+
+    __slots__ = ('data',)
+
+    def __init__(self, data: bytes):
+        self.data = bytes(data)
+
+    def __str__(self) -> str:
+        from nefics.IEC104.fast import APDU, DECODE_ERRORS
+        try:
+            return repr(APDU(self.data))
+        except DECODE_ERRORS:
+            return f'<Malformed APDU {self.data.hex():s}>'
+
+    __repr__ = __str__
+
+def _frames(record: logging.LogRecord) -> list:
+    args = record.args if isinstance(record.args, tuple) else ()
+    return [arg.data for arg in args if isinstance(arg, Frame)]
+
+def _message(record: logging.LogRecord, frame) -> str:
+    # Message of the record, with the Frame arguments replaced by frame(Frame)
+    if not record.args or not isinstance(record.args, tuple):
+        message = record.getMessage()
+    else:
+        message = str(record.msg) % tuple(frame(arg) if isinstance(arg, Frame) else arg for arg in record.args)
+    if record.exc_text:
+        message += f' -- {record.exc_text:s}'
+    return message.replace('\n', '').replace('\r', '')
+
+class TextFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        return f'{datetime.fromtimestamp(record.created).isoformat():s}\t[{record.levelname:s}] :: {_message(record, str):s}'
+
+class JSONFormatter(logging.Formatter):
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'message': _message(record, str)
+        }
+        frames = _frames(record)
+        if frames:
+            line['frames'] = [frame.hex() for frame in frames]
+        return json.dumps(line)
+
+class BinaryFormatter(logging.Formatter):
+    '''
+    Formats the records as bytes: a BINARY_RECORD header, followed by the
+    logger name, the message and the frames. The frames are not
+    dissected: they are shown as <frame> in the message.
+    '''
+
+    def format(self, record: logging.LogRecord) -> bytes:
+        name = record.name.encode()
+        message = _message(record, lambda frame: '<frame>').encode()
+        frames = b''.join(BINARY_FRAME.pack(len(frame)) + frame for frame in _frames(record))
+        return BINARY_RECORD.pack(record.created, record.levelno, len(name), len(message), len(frames)) + name + message + frames
+
+class RotatingBinaryFileHandler(RotatingFileHandler):
+
+    def __init__(self, filename: str, maxBytes: int=0, backupCount: int=0):
+        super().__init__(filename, mode='ab', maxBytes=maxBytes, backupCount=backupCount, delay=True)
+
+    def _open(self):
+        return open(self.baseFilename, 'ab')
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if self.stream is None:
+            self.stream = self._open()
+        return self.maxBytes > 0 and 0 < self.stream.tell() and self.stream.tell() + len(self.format(record)) >= self.maxBytes
+
+    def emit(self, record: logging.LogRecord):
+        try:
+            if self.shouldRollover(record):
+                self.doRollover()
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write(self.format(record))
+            self.stream.flush()
+        except Exception:
+            self.handleError(record)
+
+class _DeferredQueueHandler(QueueHandler):
+    '''
+    Queue handler that leaves the formatting to the writer, and drops the
+    records (counted in dropped) while the queue is full.
+    '''
+
+    dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        if record.exc_info:
+            # Tracebacks can not be formatted later
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            _DeferredQueueHandler.dropped += 1
+
+class _Dispatcher(logging.Handler):
+    '''
+    Handler of the writer thread: every record is written by the output
+    handler of its logger. A record with a _release handler closes it.
+    '''
+
+    def __init__(self):
+        super().__init__()
+        self.outputs = {}
+
+    def handle(self, record: logging.LogRecord):
+        released = getattr(record, '_release', None)
+        if released is not None:
+            if self.outputs.get(record.name) is released:
+                del self.outputs[record.name]
+            released.close()
+            return
+        output = self.outputs.get(record.name)
+        if output is not None:
+            output.handle(record)
+
+# Records of the loggers not configured are discarded, instead of written to stderr
+logging.getLogger('nefics').addHandler(logging.NullHandler())
+
+_QUEUE = Queue(QUEUE_SIZE)
+_DISPATCHER = _Dispatcher()
+_LISTENER = QueueListener(_QUEUE, _DISPATCHER)
+_LOCK = Lock()
+_started = False
+
+def output(target, fmt: str='text', max_bytes: int=MAX_BYTES, backups: int=BACKUPS) -> logging.Handler:
+    '''
+    Output handler for a file path or a text stream (text and JSON lines
+    formats only). Files are rotated once they reach max_bytes.
+    '''
+    assert fmt in FORMATS.keys()
+    if isinstance(target, io.TextIOBase):
+        assert fmt != 'binary', 'Binary logs require a file'
+        handler = logging.StreamHandler(target)
+    else:
+        directory = os.path.dirname(str(target))
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        if fmt == 'binary':
+            handler = RotatingBinaryFileHandler(target, maxBytes=max_bytes, backupCount=backups)
+        else:
+            handler = RotatingFileHandler(target, maxBytes=max_bytes, backupCount=backups, encoding='utf-8')
+    if fmt != 'binary':
+        handler.terminator = '\r\n' if fmt == 'text' else '\n'
+    handler.setFormatter({'text': TextFormatter, 'jsonl': JSONFormatter, 'binary': BinaryFormatter}[fmt]())
+    return handler
+
+def configure(name: str, target=None, fmt: str='text', level: int=LOG_PRIO['INFO'], max_bytes: int=MAX_BYTES, backups: int=BACKUPS) -> logging.Logger:
+    '''
+    Configure the logger nefics.<name> to write its records to target (a
+    file path or a text stream) through the background writer. The level
+    is a LOG_PRIO value: less important records are discarded. Without
+    target, every record of the logger is discarded.
+    '''
+    global _started
+    logger = logging.getLogger(f'nefics.{name:s}')
+    release(logger)
+    logger.propagate = False
+    if target is None:
+        logger.setLevel(DISABLED)
+        return logger
+    handler = output(target, fmt, max_bytes, backups)
+    with _LOCK:
+        _DISPATCHER.outputs[logger.name] = handler
+        if not _started:
+            _LISTENER.start()
+            _started = True
+    queue_handler = _DeferredQueueHandler(_QUEUE)
+    queue_handler.output = handler
+    logger.addHandler(queue_handler)
+    logger.setLevel(LEVELS[level])
+    return logger
+
+def release(logger: logging.Logger):
+    '''
+    Stop the output of a logger. Its pending records are written before
+    its file is closed.
+    '''
+    for handler in [h for h in logger.handlers if isinstance(h, _DeferredQueueHandler)]:
+        logger.removeHandler(handler)
+        marker = logger.makeRecord(logger.name, logging.INFO, __name__, 0, '', (), None)
+        marker._release = handler.output
+        _QUEUE.put(marker)
+    logger.setLevel(DISABLED)
+
+def flush():
+    '''
+    Wait until every queued record has been written.
+    '''
+    if _started:
+        _QUEUE.join()
+
+def dropped() -> int:
+    '''
+    Records dropped because the queue was full.
+    '''
+    return _DeferredQueueHandler.dropped
+
+@atexit.register
+def shutdown():
+    '''
+    Write the queued records and stop the writer thread.
+    '''
+    global _started
+    with _LOCK:
+        if _started:
+            _LISTENER.stop()
+            _started = False
+        for handler in _DISPATCHER.outputs.values():
+            handler.close()
+        _DISPATCHER.outputs.clear()
+
+def records(path: str):
+    '''
+    Iterate over the records of a binary log, as dictionaries: time,
+    level, logger, message and frames (list of raw frames).
+    '''
+    with open(path, 'rb') as log:
+        data = log.read()
+    offset = 0
+    while offset + BINARY_RECORD.size <= len(data):
+        created, levelno, namelen, msglen, frameslen = BINARY_RECORD.unpack_from(data, offset)
+        offset += BINARY_RECORD.size
+        name = data[offset:offset + namelen].decode()
+        message = data[offset + namelen:offset + namelen + msglen].decode()
+        offset += namelen + msglen
+        end = offset + frameslen
+        frames = []
+        while offset < end:
+            length, = BINARY_FRAME.unpack_from(data, offset)
+            frames.append(data[offset + BINARY_FRAME.size:offset + BINARY_FRAME.size + length])
+            offset += BINARY_FRAME.size + length
+        yield {'time': created, 'level': logging.getLevelName(levelno), 'logger': name, 'message': message, 'frames': frames}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a binary NEFICS log to JSON lines')
+    parser.add_argument('log', type=str, help='Binary log file')
+    args = parser.parse_args()
+    for record in records(args.log):
+        record['frames'] = [frame.hex() for frame in record['frames']]
+        sys.stdout.write(json.dumps(record) + '\n')
@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+'''
+Headless IEC 60870-5-104 master (controlling station).
+
+The master keeps one asyncio session per RTU, so a single thread can hold
+a large amount of concurrent connections. Every session reads complete
+APDUs from its stream (start byte and length prefix), correlates the
+confirmations with the pending requests, and keeps the last known value
+of every information object.
+
+    master = Master()
+    await master.connect('10.0.0.2', 2)
+    await master.startdt('10.0.0.2')
+    values = await master.interrogate('10.0.0.2')
+    done = await master.command('10.0.0.2', 101, 0)
+
+Spontaneous and interrogated values are delivered to the callables
+registered with Master.subscribe as measurement dictionaries:
+
+    {'time', 'rtu', 'ca', 'ioa', 'type', 'cot', 'value', 'quality'}
+
+Session events are logged by the nefics.master logger, and every frame
+at DEBUG level (see nefics.logger.configure).
+'''
+
+import asyncio
+import logging
+from time import time
+from nefics.IEC104.fast import APDU, APCI, ASDU, IOA, SCO, DECODE_ERRORS
+from nefics.logger import Frame
+
+IEC104_PORT = 2404
+IEC104_T1 = 15              # Seconds to wait for the confirmation of a frame ("T1", Section 9.6 of 60870-5-104 IEC:2006)
+IEC104_T3 = 10              # Seconds between keepalives (TESTFR act) on idle connections
+IEC104_W = 8                # Acknowledge the received I-frames after W frames ("w", Section 5.5 of 60870-5-104 IEC:2006)
+COMMAND_TIMEOUT = 10        # Seconds to wait for the confirmation of each stage (SELECT/EXECUTE) of a command
+
+LOGGER = logging.getLogger('nefics.master')
+
+STARTDT = 0x01
+STOPDT = 0x04
+TESTFR = 0x10
+
+# Information object fields holding the value and the quality, looked up in order: (field, extractor)
+POINT_VALUES = (
+    ('Value', lambda value: value),
+    ('DIQ', lambda diq: diq.DPI),
+    ('SIQ', lambda siq: int(siq) & 0x01),
+    ('SCO', lambda sco: (sco.SE << 7) | sco.SCS),
+)
+POINT_QUALITIES = (
+    ('QDS', int),
+    ('DIQ', lambda diq: int(diq.flags)),
+    ('SIQ', lambda siq: int(siq) & 0xf0),
+)
+
+def point_value(ioa):
+    '''
+    Extract the value of an information object, regardless of its type.
+    Returns None for objects without a value (e.g. interrogation commands).
+    '''
+    for name, value in POINT_VALUES:
+        field = getattr(ioa, name, None)
+        if field is not None:
+            return value(field)
+    return None
+
+def point_quality(ioa) -> int:
+    '''
+    Extract the quality descriptor flags of an information object.
+    '''
+    for name, quality in POINT_QUALITIES:
+        field = getattr(ioa, name, None)
+        if field is not None:
+            return quality(field)
+    return 0
+
+class RTUSession(object):
+    '''
+    IEC 60870-5-104 session with a single RTU.
+    '''
+
+    def __init__(self, master, address: str, asdu: int, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.master = master
+        self.address = address
+        self.asdu = asdu
+        self.values = {}                # IOA -> last known value
+        self.started = False
+        self.tx = 0
+        self.rx = 0
+        self.last_activity = time()
+        self.malformed = 0              # Frames dropped because they could not be handled
+        self._reader = reader
+        self._writer = writer
+        self._unacked = 0               # Received I-frames not acknowledged yet
+        self._u_pending = {}            # Expected U-frame type -> Future
+        self._i_pending = {}            # (TypeId, IOA) -> (Expected response, Future)
+        self._interrogation = None      # Values received during the running general interrogation
+        self._task = asyncio.ensure_future(self._receive_loop())
+
+    @property
+    def closed(self) -> bool:
+        return self._task.done()
+
+    async def _read_apdu(self) -> bytes:
+        header = await self._reader.readexactly(2)
+        if header[0] != 0x68 or header[1] < 4:
+            raise ConnectionError(f'Malformed APDU from {self.address:s}')
+        return header + await self._reader.readexactly(header[1])
+
+    async def _receive_loop(self):
+        try:
+            while True:
+                data = await self._read_apdu()
+                if LOGGER.isEnabledFor(logging.DEBUG):
+                    LOGGER.debug('Received from %s: %s', self.address, Frame(data))
+                try:
+                    self._handle(APDU(data))
+                except DECODE_ERRORS as ex:
+                    # The frame boundaries are known: drop the frame and keep the session
+                    self.malformed += 1
+                    LOGGER.warning('Dropped a malformed frame from %s (%s: %s): %s', self.address, type(ex).__name__, str(ex), Frame(data))
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as ex:
+            LOGGER.info('Connection with %s closed: %s', self.address, str(ex) or type(ex).__name__)
+            self._fail_pending(ConnectionError(str(ex)) if not isinstance(ex, ConnectionError) else ex)
+        except Exception as ex:
+            LOGGER.error('Session with %s failed: %s: %s', self.address, type(ex).__name__, str(ex))
+            self._fail_pending(ConnectionError(f'Session with {self.address:s} failed: {ex}'))
+        finally:
+            self._writer.close()
+
+    def _fail_pending(self, ex: Exception):
+        for future in self._u_pending.values():
+            if not future.done():
+                future.set_exception(ex)
+        for _, future in self._i_pending.values():
+            if not future.done():
+                future.set_exception(ex)
+        self._u_pending.clear()
+        self._i_pending.clear()
+
+    def _handle(self, data: APDU):
+        self.last_activity = time()
+        apci = data['APCI']
+        if apci.Type == 0x03: # U-frame
+            if apci.UType == TESTFR: # Keepalive from the RTU
+                self._send(APDU()/APCI(Type=0x03, UType=TESTFR << 1))
+                return
+            future = self._u_pending.pop(apci.UType, None)
+            if future is not None and not future.done():
+                future.set_result(apci.UType)
+        elif apci.Type == 0x00 and data.haslayer('ASDU'): # I-frame
+            self.rx = (apci.Tx + 1) & 0x7fff
+            self._unacked += 1
+            if self._unacked >= IEC104_W:
+                self._send(APDU()/APCI(Type=0x01, Rx=self.rx))
+                self._unacked = 0
+            self._handle_asdu(data['ASDU'])
+
+    def _handle_asdu(self, asdu: ASDU):
+        if asdu.TypeId in [45, 100, 101]: # Command confirmations
+            ioa = asdu.IOA[0] if asdu.IOA else None
+            key = (asdu.TypeId, ioa.IOA if ioa is not None else 0)
+            if asdu.TypeId == 100 and asdu.CauseTx == 10 and self._interrogation is not None: # ActTerm
+                key = (100, -1)
+            expected, future = self._i_pending.pop(key, (None, None))
+            if future is not None and not future.done():
+                if asdu.TypeId == 45:
+                    future.set_result(asdu.PN == 0 and expected == ((asdu.CauseTx << 8) | (ioa.SCO.SE << 7) | ioa.SCO.SCS))
+                else:
+                    future.set_result(asdu.PN == 0 and asdu.CauseTx == expected)
+            return
+        now = time()
+        for ioa in asdu.IOA or []:
+            value = point_value(ioa)
+            self.values[ioa.IOA] = value
+            if self._interrogation is not None and asdu.CauseTx == 20:
+                self._interrogation[ioa.IOA] = value
+            self.master._publish({
+                'time': now,
+                'rtu': self.address,
+                'ca': asdu.Addr,
+                'ioa': ioa.IOA,
+                'type': asdu.TypeId,
+                'cot': asdu.CauseTx,
+                'value': value,
+                'quality': point_quality(ioa)
+            })
+
+    def _send(self, pkt: APDU):
+        data = pkt.build()
+        if LOGGER.isEnabledFor(logging.DEBUG):
+            LOGGER.debug('Sent to %s: %s', self.address, Frame(data))
+        self._writer.write(data)
+
+    def _send_asdu(self, asdu: ASDU):
+        pkt = APDU()/APCI(Type=0x00, Tx=self.tx, Rx=self.rx)/asdu
+        self.tx = (self.tx + 1) & 0x7fff
+        self._unacked = 0
+        self._send(pkt)
+
+    async def _u_request(self, utype: int, timeout: float=IEC104_T1) -> bool:
+        if self.closed:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self._u_pending[utype << 1] = future
+        self._send(APDU()/APCI(Type=0x03, UType=utype))
+        try:
+            await asyncio.wait_for(future, timeout)
+            return True
+        except (asyncio.TimeoutError, ConnectionError):
+            self._u_pending.pop(utype << 1, None)
+            return False
+
+    async def _i_request(self, key: tuple, expected: int, asdu: ASDU, timeout: float) -> bool:
+        if self.closed:
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self._i_pending[key] = (expected, future)
+        self._send_asdu(asdu)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except (asyncio.TimeoutError, ConnectionError):
+            self._i_pending.pop(key, None)
+            return False
+
+    async def startdt(self) -> bool:
+        self.started = await self._u_request(STARTDT)
+        return self.started
+
+    async def stopdt(self) -> bool:
+        confirmed = await self._u_request(STOPDT)
+        self.started = self.started and not confirmed
+        return confirmed
+
+    async def testfr(self) -> bool:
+        return await self._u_request(TESTFR)
+
+    async def interrogate(self, qoi: int=20, timeout: float=IEC104_T1) -> dict:
+        '''
+        Run a general interrogation. Returns the values received with the
+        interrogation, or None if the RTU did not confirm or terminate it.
+        '''
+        asdu = ASDU(TypeId=100, SQ=0, NumIx=1, CauseTx=6, Test=0, OA=0, Addr=self.asdu, IOA=[IOA(100, IOA=0, QOI=qoi)])
+        self._interrogation = {}
+        try:
+            term = asyncio.get_running_loop().create_future()
+            self._i_pending[(100, -1)] = (10, term)
+            if not await self._i_request((100, 0), 7, asdu, timeout): # ActCon
+                self._i_pending.pop((100, -1), None)
+                return None
+            try:
+                await asyncio.wait_for(term, timeout) # ActTerm
+            except (asyncio.TimeoutError, ConnectionError):
+                self._i_pending.pop((100, -1), None)
+                return None
+            return self._interrogation
+        finally:
+            self._interrogation = None
+
+    async def counter_interrogation(self, qcc: int=5, timeout: float=IEC104_T1) -> bool:
+        asdu = ASDU(TypeId=101, SQ=0, NumIx=1, CauseTx=6, Test=0, OA=0, Addr=self.asdu, IOA=[IOA(101, IOA=0, QCC=qcc)])
+        return await self._i_request((101, 0), 7, asdu, timeout)
+
+    async def _single_command(self, ioa: int, scs: int, se: int, timeout: float) -> bool:
+        asdu = ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=6, Test=0, OA=0, Addr=self.asdu, IOA=[IOA(45, IOA=ioa, SCO=SCO(SE=se, QU=1, SCS=scs))])
+        return await self._i_request((45, ioa), (0x07 << 8) | (se << 7) | scs, asdu, timeout)
+
+    async def command(self, ioa: int, scs: int, select: bool=True, timeout: float=COMMAND_TIMEOUT) -> bool:
+        '''
+        Send a single command (C_SC_NA_1). With select, the command is
+        sent as select before operate (SELECT, then EXECUTE).
+        '''
+        if select and not await self._single_command(ioa, scs, 1, timeout):
+            LOGGER.warning('SELECT of IOA %d not confirmed by %s', ioa, self.address)
+            return False
+        done = await self._single_command(ioa, scs, 0, timeout)
+        LOGGER.info('Command %d on IOA %d of %s: %s', scs, ioa, self.address, 'executed' if done else 'not confirmed')
+        return done
+
+    async def close(self):
+        self._writer.close()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+
+class Master(object):
+    '''
+    IEC 60870-5-104 master handling concurrent sessions with several RTUs,
+    indexed by address.
+    '''
+
+    def __init__(self, port: int=IEC104_PORT, keepalive: float=IEC104_T3):
+        self.port = port
+        self.keepalive = keepalive
+        self.sessions = {}          # RTU address -> RTUSession
+        self._subscribers = []
+        self._keepalive_task = None
+
+    def __contains__(self, address: str) -> bool:
+        return address in self.sessions
+
+    def __getitem__(self, address: str) -> RTUSession:
+        return self.sessions[address]
+
+    def subscribe(self, callback):
+        '''
+        Register a callable receiving every measurement dictionary.
+        '''
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def _publish(self, measurement: dict):
+        for callback in self._subscribers:
+            try:
+                callback(measurement)
+            except Exception as ex:
+                # A failing subscriber must not break the session delivering the measurement
+                LOGGER.error('Subscriber %s failed: %s: %s', repr(callback), type(ex).__name__, str(ex))
+
+    async def _keepalive_loop(self):
+        # A single task for every session: send TESTFR act on idle connections
+        while len(self.sessions) > 0:
+            await asyncio.sleep(self.keepalive / 2)
+            now = time()
+            for session in list(self.sessions.values()):
+                if not session.closed and now - session.last_activity >= self.keepalive:
+                    session.last_activity = now
+                    asyncio.ensure_future(session.testfr())
+
+    async def connect(self, address: str, asdu: int, timeout: float=2) -> RTUSession:
+        '''
+        Open a connection with an RTU. Raises ConnectionError if the RTU
+        cannot be reached.
+        '''
+        if address in self.sessions and not self.sessions[address].closed:
+            return self.sessions[address]
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_connection(address, self.port), timeout)
+        except (asyncio.TimeoutError, OSError) as ex:
+            raise ConnectionError(f'Unable to connect to {address:s}') from ex
+        session = RTUSession(self, address, int(asdu), reader, writer)
+        self.sessions[address] = session
+        LOGGER.info('Connected to %s (ASDU %d)', address, int(asdu))
+        if self._keepalive_task is None or self._keepalive_task.done():
+            self._keepalive_task = asyncio.ensure_future(self._keepalive_loop())
+        return session
+
+    async def disconnect(self, address: str) -> bool:
+        '''
+        Stop the data transfer and close the connection with an RTU.
+        Returns whether the STOPDT was confirmed.
+        '''
+        session = self.sessions.pop(address, None)
+        if session is None:
+            return False
+        confirmed = await session.stopdt() if session.started else True
+        await session.close()
+        return confirmed
+
+    # Requests to an unknown RTU fail as unconfirmed requests do: False (None for interrogations)
+
+    async def startdt(self, address: str) -> bool:
+        if address not in self.sessions:
+            return False
+        return await self.sessions[address].startdt()
+
+    async def stopdt(self, address: str) -> bool:
+        if address not in self.sessions:
+            return False
+        return await self.sessions[address].stopdt()
+
+    async def interrogate(self, address: str, qoi: int=20) -> dict:
+        if address not in self.sessions:
+            return None
+        return await self.sessions[address].interrogate(qoi)
+
+    async def command(self, address: str, ioa: int, scs: int, select: bool=True) -> bool:
+        if address not in self.sessions:
+            return False
+        return await self.sessions[address].command(ioa, scs, select)
+
+    async def commands(self, commands: list) -> dict:
+        '''
+        Send (RTU address, IOA, SCS) single commands concurrently. Returns
+        a dictionary mapping each (RTU address, IOA) to whether the command
+        was executed.
+        '''
+        results = await asyncio.gather(*[self.command(address, ioa, scs) for address, ioa, scs in commands])
+        return {(address, ioa): done for (address, ioa, _), done in zip(commands, results)}
+
+    async def close(self):
+        await asyncio.gather(*[self.disconnect(address) for address in list(self.sessions.keys())])
+        if self._keepalive_task is not None:
+            self._keepalive_task.cancel()
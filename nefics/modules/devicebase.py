@@ -15,8 +15,10 @@ if sys.platform not in ['win32']:
 
 # NEFICS imports
 import nefics.simproto as simproto
-from nefics.IEC104.dissector import APDU
-from nefics.IEC104.ioa import CP56Time
+from nefics.pointtable import Point, PointTable
+from nefics.IEC104.fast import APDU, APCI, ASDU
+from nefics.IEC104.ioa import CP56Time, IOALEN
+from nefics.logger import LOG_PRIO, LEVELS, Frame, configure
 
 # Try to determine the main broadcast address
 try:
@@ -33,18 +35,9 @@ except IndexError:
 
 
 BUFFER_SIZE = 512
-LOG_PRIO = {
-    'CRITICAL': 0,
-    'ERROR': 1,
-    'WARNING': 2,
-    'INFO': 3,
-    'DEBUG': 4,
-    0: 'CRITICAL',
-    1: 'ERROR',
-    2: 'WARNING',
-    3: 'INFO',
-    4: 'DEBUG'
-}
+
+IEC104_ASDU_MAXLEN = 249  # 253-byte APDU minus the 4 control octets of the APCI
+IEC104_MAX_NUMIX = 127    # Seven bits of the variable structure qualifier
 
 def cp56time() -> CP56Time:
     now = datetime.now()
@@ -68,6 +61,14 @@ class IEDBase(Thread):
 
     If a device requires additional arguments, use kwargs to
     extract any additional values.
+
+    The IEC104 points of the device can be declared with the "points"
+    keyword argument (see nefics/pointtable.py).
+
+    The device logs to the file path or text stream given with the "log"
+    keyword argument, in the "log_format" format (see nefics/logger.py)
+    and discarding the messages less important than "log_level" (a
+    LOG_PRIO name).
     '''
 
     def __init__(self, guid: int, neighbors_in: list=list(), neighbors_out: list=list(), **kwargs):
@@ -90,10 +91,16 @@ class IEDBase(Thread):
         self._sock.bind(('', simproto.SIM_PORT))                                # Bind to simulation port on all addresses
         self._sock.settimeout(0.333)                                            # Set socket timeout (seconds)
         self._msgqueue = deque(maxlen=simproto.QUEUE_SIZE//simproto.DATA_LEN)   # Simulation message queue (64KB)
-        if 'log' in kwargs.keys() and isinstance(kwargs['log'], io.TextIOBase):
-            self._logfile = kwargs['log']
+        self._log_format = kwargs.get('log_format', 'text')                     # Log format (nefics.logger.FORMATS)
+        self._log_level = LOG_PRIO[kwargs.get('log_level', 'INFO')]             # Least important messages logged
+        self._logfile = None
+        self._logger = None
+        self.logfile = kwargs.get('log', None)
+        self._snapshot = None                                                   # Cached interrogation snapshot (packed ASDUs)
+        if 'points' in kwargs.keys():
+            self._points = PointTable.from_config(kwargs['points'])             # IEC104 point table (IOA registry)
         else:
-            self._logfile = None
+            self._points = PointTable()
     
     @property
     def guid(self) -> int:
@@ -130,30 +137,175 @@ class IEDBase(Thread):
         self._tx = 0 if value < 0 or value > 0xffff else value
     
     @property
-    def logfile(self) -> io.TextIOBase:
+    def points(self) -> PointTable:
+        return self._points
+
+    @property
+    def logfile(self):
         return self._logfile
     
     @logfile.setter
-    def logfile(self, value: io.TextIOBase):
+    def logfile(self, value):
+        '''
+        Log to a file path or text stream. None disables the log.
+        '''
+        assert value is None or isinstance(value, (str, io.TextIOBase))
         self._logfile = value
+        self._logger = configure(f'device.{self._guid:d}', value, self._log_format, self._log_level)
+
+    def _load_points(self, default: list):
+        '''
+        Use the given point declaration if no points were configured for
+        the device, and bind the point table to the device.
+        '''
+        if len(self._points) == 0:
+            self._points = PointTable.from_config(default)
+        self._points.bind(self)
+
+    def point_source(self, point: Point):
+        '''
+        Override this method to resolve additional value sources.
 
-    def poll_values_IEC104(self) -> list:
+        By default, the source of a point names a device attribute.
+        Returns a callable providing the current value of the point.
         '''
-        Override this method to return the appropriate values of
-        IEC104 according to the device's functionality.
+        return lambda: getattr(self, point.source)
+
+    def point_command(self, point: Point):
+        '''
+        Resolve the command handler of a point to the device method
+        named "command_<command>". The handler is called with the point
+        and the command state.
+        '''
+        return getattr(self, f'command_{point.command}')
+
+    def poll_values_IEC104(self, last: dict=None) -> list:
+        '''
+        Return the appropriate values of IEC104 according to the
+        device's functionality.
 
         This method must return a list comprised of
-        nefics.IEC104.APDU objects.
+        nefics.IEC104.APDU objects. By default, one spontaneous
+        I-Frame is returned for each point reported by the point
+        table in the current pass. The last reported values of the
+        polling session are kept in last (see PointTable.report).
         '''
-        return []
+        return [self._iframe_IEC104(typeid, [ioa], 3) for typeid, ioa in self._points.report(cp56time(), last)]
     
-    def handle_IEC104_IFrame(self, packet: APDU) -> APDU:
+    def handle_IEC104_IFrame(self, packet: APDU, session: int=None) -> APDU:
         '''
         Override this method to return the appropriate APDU for the
         received I-Frame according to the device's functionality.
+
+        The session identifies the IEC104 connection the I-Frame was
+        received from.
         '''
         return None
 
+    def points_IEC104(self) -> list:
+        '''
+        Return the current value of every information object of the
+        device, as provided by the point table.
+
+        This method must return a list of (TypeId, IOA) tuples, where
+        IOA is a nefics.IEC104.ioa information object. It is used to
+        answer general interrogations (C_IC_NA_1).
+        '''
+        return self._points.snapshot(cp56time())
+
+    def counters_IEC104(self) -> list:
+        '''
+        Override this method to return the integrated totals of the
+        device as a list of nefics.IEC104.ioa.IOA37 objects. It is used
+        to answer counter interrogations (C_CI_NA_1).
+        '''
+        return []
+
+    def _iframe_IEC104(self, typeid: int, ioas: list, cot: int) -> APDU:
+        '''
+        Build a single I-Frame carrying the given information objects
+        and advance the transmission counter.
+        '''
+        pkt = APDU()
+        pkt /= APCI(ApduLen=10 + IOALEN[typeid] * len(ioas), Type=0x00, Tx=self.tx, Rx=self.rx)
+        pkt /= ASDU(TypeId=typeid, SQ=0, NumIx=len(ioas), CauseTx=cot, Test=0, OA=0, Addr=self.guid, IOA=ioas)
+        self.tx += 1
+        return pkt
+
+    def _pack_asdus(self, typeid: int, ioas: list, cot: int) -> list:
+        '''
+        Pack the given information objects into as few ASDUs as the
+        maximum APDU length allows. Returns the encoded ASDUs.
+        '''
+        per_asdu = min(IEC104_MAX_NUMIX, (IEC104_ASDU_MAXLEN - 6) // IOALEN[typeid])
+        asdus = []
+        for i in range(0, len(ioas), per_asdu):
+            chunk = ioas[i:i + per_asdu]
+            asdus.append(ASDU(TypeId=typeid, SQ=0, NumIx=len(chunk), CauseTx=cot, Test=0, OA=0, Addr=self.guid, IOA=chunk).build())
+        return asdus
+
+    def snapshot_IEC104(self) -> list:
+        '''
+        Return the encoded ASDUs (CoT 20, inrogen) for a station
+        interrogation.
+
+        The snapshot is cached until the next simulation step, so any
+        number of interrogations within a step are answered without
+        rebuilding the information objects.
+        '''
+        snapshot = self._snapshot
+        if snapshot is None:
+            grouped = {}
+            for typeid, ioa in self.points_IEC104():
+                grouped.setdefault(typeid, []).append(ioa)
+            snapshot = []
+            for typeid, ioas in grouped.items():
+                snapshot += self._pack_asdus(typeid, ioas, 20)
+            self._snapshot = snapshot
+        return snapshot
+
+    def handle_IEC104_interrogation(self, packet: APDU) -> list:
+        '''
+        Answer a general (C_IC_NA_1) or counter (C_CI_NA_1)
+        interrogation.
+
+        Returns the raw frames to be sent in order: the activation
+        confirmation, the requested information objects and the
+        activation termination.
+        '''
+        assert packet.haslayer('APCI')
+        assert packet.haslayer('ASDU')
+        apci:APCI = packet['APCI']
+        asdu:ASDU = packet['ASDU']
+        self.rx = apci.Tx + 1
+        if asdu.CauseTx != 6 or asdu.Addr not in [self.guid, 0xffff]:
+            # Only activations addressed to this device (or broadcasted) are supported
+            self._log('Received an unsupported interrogation: %s', Frame(packet.build()), prio=LOG_PRIO['WARNING'])
+            cot = 45 if asdu.CauseTx != 6 else 46 # Unknown CoT / Unknown common address of ASDU
+            return [self._iframe_IEC104(asdu.TypeId, asdu.IOA, cot).build()]
+        asdus = []
+        if asdu.TypeId == 100:
+            # Type 100: C_IC_NA_1 (Interrogation command) -- 60870-5-101 IEC:2003 Section 7.3.4.1
+            qoi = asdu.IOA[0].QOI
+            if qoi == 20:
+                asdus = self.snapshot_IEC104()
+            # Group interrogations (21 ... 36) are confirmed, but no groups are defined
+        else:
+            # Type 101: C_CI_NA_1 (Counter interrogation command) -- 60870-5-101 IEC:2003 Section 7.3.4.2
+            qcc = asdu.IOA[0].QCC
+            rqt = qcc & 0x3f
+            if qcc >> 6 == 0 and rqt in range(1, 6):
+                # Read request: general (RQT 5, CoT 37) or group (RQT 1 ... 4, CoT 38 ... 41)
+                counters = self.counters_IEC104()
+                if len(counters) > 0:
+                    asdus = self._pack_asdus(37, counters, 37 if rqt == 5 else 37 + rqt)
+        frames = [self._iframe_IEC104(asdu.TypeId, asdu.IOA, 7).build()] # ActCon
+        for encoded in asdus:
+            frames.append(APCI(ApduLen=4 + len(encoded), Type=0x00, Tx=self.tx, Rx=self.rx).build() + encoded)
+            self.tx += 1
+        frames.append(self._iframe_IEC104(asdu.TypeId, asdu.IOA, 10).build()) # ActTerm
+        return frames
+
     def simulate(self):
         '''
         Override this method with the physical simulation of the
@@ -176,6 +328,7 @@ class IEDBase(Thread):
             sleep(1)
         while not self._terminate:
             self.simulate()
+            self._snapshot = None # Values may have changed: invalidate the interrogation snapshot
 
     def handle_specific(self, message: simproto.NEFICSMSG):
         '''
@@ -252,17 +405,13 @@ class IEDBase(Thread):
                 self._sock.sendto(pkt.build(), (SIM_BCAST, simproto.SIM_PORT))
             sleep(0.333)
 
-    def _log(self, message:str, prio:int=LOG_PRIO['INFO']):
-        if self._logfile is not None and isinstance(self._logfile, io.TextIOBase):
-            line = datetime.now().ctime()
-            msg = message.replace("\n", "").replace("\r","")
-            line += f'\t[{LOG_PRIO[prio]}] :: {msg}\r\n'
-            try:
-                self._logfile.write(line)
-                self._logfile.flush()
-            except IOError:
-                sys.stderr.write(f'{line[:-2]} -- IOError\r\n')
-                sys.stderr.flush()
+    def _log(self, message:str, *args, prio:int=LOG_PRIO['INFO']):
+        '''
+        Log a message (with %-style args, formatted by the log writer
+        thread, e.g. Frame objects) if prio is enabled.
+        '''
+        if self._logger.isEnabledFor(LEVELS[prio]):
+            self._logger.log(LEVELS[prio], message, *args)
 
     def run(self):
         msghandler = Thread(target=self.msg_handler)
@@ -15,39 +15,113 @@ and an output neighbor, to which the output voltage is supplied..
 The consumer load has one transmission substation as its input.
 '''
 
+from datetime import datetime
 import signal
-from socket import AF_INET, IPPROTO_TCP, SOCK_STREAM, socket, timeout
+from socket import AF_INET, IPPROTO_TCP, SOCK_STREAM, SOL_SOCKET, SO_REUSEADDR, socket, timeout
+import struct
 import sys
-from threading import Thread
-from time import sleep
+from threading import Lock, Thread
+from time import monotonic, sleep
 from types import FrameType
 from Crypto.Random.random import randint
+import numpy as np
 
 # NEFICS imports
 from nefics.IEC104.dissector import *
 from nefics.IEC104.ioa import *
+from nefics.IEC104.fast import APDU, APCI, ASDU
+from nefics.logger import Frame
 import nefics.modules.devicebase as devicebase
 import nefics.simproto as simproto
-
-BASE_IOA = 1001
+from nefics.pointtable import Point, BREAKER_BASE_IOA, measurement_points, breaker_points
 
 IEC104_T1 = 15
+IEC104_SELECT_TIMEOUT = 10 # Seconds a SELECT remains valid while waiting for its EXECUTE
 IEC104_PORT = 2404
 IEC104_BUFFER_SIZE = 65536 # 64K
+IEC104_MAX_SESSIONS = 16    # Concurrent connections served by a device
+IEC104_FRAME_ERRORS = (IndexError, KeyError, ValueError, struct.error) # Raised when decoding a malformed frame
+IEC104_COUNTERS = [
+    'accepted',             # Sessions started
+    'rejected',             # Connections closed because the session table was full
+    'failed',               # Sessions closed because of an error handling a frame
+    'frames',               # Frames received
+    'malformed',            # Frames that could not be decoded
+    'dropped',              # Frames discarded without being handled (state errors, incomplete frames)
+]
+
+# Grid physics. These functions accept scalars or numpy arrays (one value per time step),
+# so that the same model drives the simulated devices and the offline dataset generator.
+
+def parallel_load(loads: list, state):
+    '''
+    Equivalent resistance of the loads connected by the breakers in state
+    (a set bit connects the corresponding load). Infinite when every
+    breaker is open, zero when a failed (zero-valued) load is connected.
+    '''
+    loads = np.asarray(loads, dtype=np.float64)
+    connected = (np.asarray(state)[..., None] >> np.arange(len(loads))) & 1
+    with np.errstate(divide='ignore'):
+        conductance = np.where(connected > 0, 1.0 / loads, 0.0).sum(axis=-1)
+        return 1.0 / conductance
+
+def transmission_output(vin, load, rload):
+    '''
+    Output voltage and current of a transmission substation with the given
+    input voltage, local load and downstream (remote) load.
+    '''
+    vin, load, rload = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in [vin, load, rload]])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vout = np.where(np.isinf(rload), vin, vin * rload / (rload + load))    # Breakers OPEN downstream ==> No voltage drop
+        amp = np.where(load == 0, np.inf, (vin - vout) / load)                  # Short circuit ==> Current increases toward infinity
+        vout = np.where(np.isinf(load), 0.0, vout)                              # All breakers OPEN ==> No output, no current
+        amp = np.where(np.isinf(load), 0.0, amp)
+    return vout, amp
+
+def load_current(vin, load):
+    '''
+    Current drawn by a consumer load.
+    '''
+    vin, load = np.broadcast_arrays(np.asarray(vin, dtype=np.float64), np.asarray(load, dtype=np.float64))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(load == 0, np.inf, vin / load)
 
 class IEC104DeviceHandler(Thread):
+    '''
+    IEC 60870-5-104 server of a simulated device.
+
+    Every accepted connection is served by its own session thread. Errors
+    are confined to the session that caused them: a frame that can not be
+    decoded is counted and discarded, and a session that fails is closed
+    (socket and data transfer thread) without affecting the other ones.
+    At most max_sessions connections are served at once, further
+    connections are closed right after being accepted.
+    '''
 
-    def __init__(self, device: devicebase.IEDBase):
+    def __init__(self, device: devicebase.IEDBase, address: str='', port: int=IEC104_PORT, max_sessions: int=IEC104_MAX_SESSIONS):
         super().__init__()
         self._terminate = False
         self._device = device
-        self._connections = []
-        self._data_transfer_status = {}
+        self._max_sessions = max_sessions
+        self._connections = {}                  # Session ID -> Session thread
+        self._data_transfer_status = {}         # Session ID -> Data transfer enabled (STARTED connection)
+        self._sessions_lock = Lock()
+        self._counters = dict.fromkeys(IEC104_COUNTERS, 0)
+        # Listen at instantiation, so the actual port is known when an ephemeral one (0) is requested
+        # and connections are queued until the handler starts
+        self._listening_sock = socket(AF_INET, SOCK_STREAM, IPPROTO_TCP)
+        self._listening_sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self._listening_sock.bind((address, port))
+        self._listening_sock.listen()
+        self.port = self._listening_sock.getsockname()[1]
     
     def __str__(self) -> str:
+        counters = self.counters
         iecstr = f'### IEC-104 Simulated device\r\n'
         iecstr += f' ## Class: {self._device.__class__.__name__}\r\n'
         iecstr += f'  # Status at: {datetime.now().ctime()}\r\n'
+        iecstr += f'  # Sessions: {self.sessions:d}/{self._max_sessions:d} active, {counters["accepted"]:d} accepted, {counters["rejected"]:d} rejected, {counters["failed"]:d} failed\r\n'
+        iecstr += f'  # Frames: {counters["frames"]:d} received, {counters["malformed"]:d} malformed, {counters["dropped"]:d} dropped\r\n'
         iecstr += f'----------------------------\r\n'
         iecstr += str(self._device)
         iecstr += f'----------------------------'
@@ -60,6 +134,26 @@ class IEC104DeviceHandler(Thread):
     @terminate.setter
     def terminate(self, value: bool):
         self._terminate = value
+
+    @property
+    def sessions(self) -> int:
+        '''
+        Number of active sessions.
+        '''
+        with self._sessions_lock:
+            return len(self._connections)
+
+    @property
+    def counters(self) -> dict:
+        '''
+        Snapshot of the session and frame counters (see IEC104_COUNTERS).
+        '''
+        with self._sessions_lock:
+            return dict(self._counters)
+
+    def _count(self, counter: str, amount: int=1):
+        with self._sessions_lock:
+            self._counters[counter] += amount
     
     def set_terminate(self, signum: int, stack_frame: FrameType):
         if signum in [signal.SIGINT, signal.SIGTERM]:
@@ -83,29 +177,89 @@ class IEC104DeviceHandler(Thread):
         the values to be sent, and sends one value each second while in a
         STARTED connection.
         '''
-        while self._data_transfer_status[connid] and not self._terminate:
-            values = self._device.poll_values_IEC104()
-            for apdu in values:
-                isock.send(apdu.build())
-                sleep(1)
-
-    def _connection_loop(self, isock: socket):
-        connection_id = randint(0, 65535)
-        while connection_id in self._data_transfer_status.keys():
+        reported = {}   # Last values reported to this session (deadbands)
+        try:
+            while self._data_transfer_status[connid] and not self._terminate:
+                values = self._device.poll_values_IEC104(reported)
+                for apdu in values:
+                    if not self._data_transfer_status[connid]:
+                        break
+                    isock.send(apdu.build())
+                    sleep(1)
+        except OSError:
+            # Connection closed or broken: the session loop closes the session
+            pass
+
+    def _register_session(self, isock: socket) -> int:
+        '''
+        Register a new session in the session table and start its thread.
+        Returns the session ID, or None when the session table is full.
+        '''
+        with self._sessions_lock:
+            if len(self._connections) >= self._max_sessions:
+                self._counters['rejected'] += 1
+                return None
             connection_id = randint(0, 65535)
+            while connection_id in self._connections.keys():
+                connection_id = randint(0, 65535)
+            self._data_transfer_status[connection_id] = False
+            self._connections[connection_id] = Thread(target=self._connection_loop, args=[isock, connection_id])
+            self._counters['accepted'] += 1
+            self._connections[connection_id].start()
+        return connection_id
+
+    def _unregister_session(self, connection_id: int):
+        with self._sessions_lock:
+            self._connections.pop(connection_id, None)
+            self._data_transfer_status.pop(connection_id, None)
+
+    def _connection_loop(self, isock: socket, connection_id: int):
+        '''
+        Session loop: receives the frames of a connection and handles them
+        in order. Frames that can not be decoded are discarded; the session
+        is closed when the stream can not be resynchronized (no START
+        octet), on socket errors, when the peer closes the connection, and
+        when the handling of a frame fails. The socket is always closed and
+        the session removed from the session table.
+        '''
         datatransfer:Thread = None
-        self._data_transfer_status[connection_id] = False
         keepconn = True
-        while keepconn and not self._terminate:
-            try:
-                data = isock.recv(IEC104_BUFFER_SIZE)
-                if len(data) > 0:
-                    data = APDU(data)
-                    frame_type = data['APCI'].Type
+        buffer = b''
+        try:
+            while keepconn and not self._terminate:
+                try:
+                    data = isock.recv(IEC104_BUFFER_SIZE)
+                except timeout:
+                    break
+                if not data:
+                    # Connection closed by the peer
+                    break
+                buffer += data
+                # Handle every complete APDU received (several frames may arrive in a single read)
+                while keepconn and len(buffer) >= 2 and len(buffer) >= buffer[1] + 2:
+                    frame = buffer[:buffer[1] + 2]
+                    buffer = buffer[buffer[1] + 2:]
+                    self._count('frames')
+                    if frame[0] != 0x68 or frame[1] < 4:
+                        # The frame boundaries are lost, there is no way to find the next frame
+                        self._count('malformed')
+                        self._device._log('IEC-104 session %d: invalid APCI (%s). Closing the connection', connection_id, frame[:6].hex(), prio=devicebase.LOG_PRIO['WARNING'])
+                        keepconn = False
+                        break
+                    try:
+                        data = APDU(frame)
+                        frame_type = data['APCI'].Type
+                        if frame_type == 0x00 and not data.haslayer('ASDU'):
+                            raise ValueError('I-frame without ASDU')
+                    except IEC104_FRAME_ERRORS as ex:
+                        self._count('malformed')
+                        self._device._log('IEC-104 session %d: discarded a malformed frame %s: %s: %s', connection_id, Frame(frame), type(ex).__name__, ex, prio=devicebase.LOG_PRIO['WARNING'])
+                        continue
                     if datatransfer is None:
                         # STOPPED connection
                         if frame_type in [0x00, 0x01]:
                             # I-Frame (0x00) OR S-Frame (0x01)
+                            self._count('dropped')
                             keepconn = False
                         else:
                             # U-Frame (0x03)
@@ -124,7 +278,12 @@ class IEC104DeviceHandler(Thread):
                         # STARTED connection
                         if frame_type == 0x00:
                             # I-Frame
-                            apdu = self._device.handle_IEC104_IFrame(data)
+                            if data['ASDU'].TypeId in [100, 101]:
+                                # C_IC_NA_1 / C_CI_NA_1: ActCon, snapshot and ActTerm in a single send
+                                isock.sendall(b''.join(self._device.handle_IEC104_interrogation(data)))
+                                apdu = None
+                            else:
+                                apdu = self._device.handle_IEC104_IFrame(data, connection_id)
                         elif frame_type == 0x01:
                             # S-Frame
                             self._device.tx = data['APCI'].Rx
@@ -146,31 +305,40 @@ class IEC104DeviceHandler(Thread):
                                 datatransfer = None
                         if apdu is not None:
                             isock.send(apdu.build())
-            except (timeout, BrokenPipeError) as ex:
-                keepconn = False
-        if datatransfer is not None:
-            self._data_transfer_status[connection_id] = False
-            datatransfer.join()
-        isock.close()
+        except OSError:
+            # Connection reset, broken pipe or send timeout
+            pass
+        except Exception as ex:
+            # A failure handling a frame: close this session only
+            self._count('failed')
+            self._device._log('IEC-104 session %d failed: %s: %s', connection_id, type(ex).__name__, ex, prio=devicebase.LOG_PRIO['ERROR'])
+        finally:
+            if buffer:
+                # Incomplete frame left when the session ended
+                self._count('dropped')
+            if datatransfer is not None:
+                self._data_transfer_status[connection_id] = False
+                datatransfer.join()
+            isock.close()
+            self._unregister_session(connection_id)
 
     def run(self):
-        listening_sock = socket(AF_INET, SOCK_STREAM, IPPROTO_TCP)
-        listening_sock.bind(('', IEC104_PORT))
+        listening_sock = self._listening_sock
         listening_sock.settimeout(2)
-        listening_sock.listen()
         self._device.start()
         while not self._terminate:
             try:
                 incoming, iaddr = listening_sock.accept()
-                incoming.settimeout(IEC104_T1)
-                new_conn = Thread(target=self._connection_loop, args=[incoming])
-                self._connections.append(new_conn)
-                new_conn.start()
             except timeout:
                 continue
-        while any(thr.is_alive() for thr in self._connections):
-            for thr in self._connections:
-                thr.join(1)
+            incoming.settimeout(IEC104_T1)
+            if self._register_session(incoming) is None:
+                self._device._log('IEC-104 session limit (%d) reached. Rejected the connection from %s:%d', self._max_sessions, iaddr[0], iaddr[1], prio=devicebase.LOG_PRIO['WARNING'])
+                incoming.close()
+        with self._sessions_lock:
+            sessions = list(self._connections.values())
+        for thr in sessions:
+            thr.join()
         self._device.join()
         listening_sock.close()
 
@@ -194,9 +362,14 @@ class Source(devicebase.IEDBase):
         assert isinstance(kwargs['voltage'], float)
         super().__init__(guid, neighbors_in=[], neighbors_out=neighbors_out[:1], **kwargs)
         self._voltage = kwargs['voltage']
+        self._load_points(measurement_points('voltage', None))
     
     def __str__(self) -> str:
         return f'Vout: {self._voltage:6.3f} V\r\n'
+
+    @property
+    def voltage(self) -> float:
+        return self._voltage
     
     def handle_specific(self, message: simproto.NEFICSMSG):
         if message.SenderID in self._n_out_addr.keys():
@@ -210,7 +383,7 @@ class Source(devicebase.IEDBase):
                         FloatArg0=self._voltage
                     )
                 else:
-                    self._log(f'Received a NEFICS message not supported by simplepowergrid.Source from {addr}: {repr(message)}')
+                    self._log('Received a NEFICS message not supported by simplepowergrid.Source from %s: %r', addr, message)
                     pkt = simproto.NEFICSMSG(
                         SenderID=self.guid,
                         ReceiverID=message.SenderID,
@@ -218,15 +391,7 @@ class Source(devicebase.IEDBase):
                     )
                 self._sock.sendto(pkt.build(), addr)
     
-    def poll_values_IEC104(self):
-        ioa = IOA36(IOA=BASE_IOA, Value=self._voltage, QDS=0, CP56Time=devicebase.cp56time())
-        pkt = APDU()
-        pkt /= APCI(ApduLen=25, Type=0x00, Tx=self.tx, Rx=self.rx)
-        pkt /= ASDU(TypeId=36, SQ=0, NumIx=1, CauseTx=3, Test=0, OA=0, Addr=self.guid, IOA=[ioa])
-        self.tx += 1
-        return [pkt]
-
-    def handle_IEC104_IFrame(self, packet: APDU) -> APDU:
+    def handle_IEC104_IFrame(self, packet: APDU, session: int=None) -> APDU:
         # A source device shouldn't receive any I-Frames
         assert packet.haslayer('APCI')
         assert packet.haslayer('ASDU')
@@ -269,13 +434,37 @@ class Transmission(devicebase.IEDBase):
         self._vout:float = None
         self._amp:float = None
         self._rload:float = None
-        self._wait_exec = None
+        self._selected = {}                     # Selected IOA -> (Session, SELECT deadline)
+        self._select_lock = Lock()
+        self._load_points(measurement_points() + breaker_points(len(self._loads)))
     
     def __str__(self) -> str:
         if all(x is not None for x in [self._vin, self._vout, self._amp, self._load, self._rload]):
             return f'Vin:  {self._vin:6.3f} V\r\nVout: {self._vout:6.3f} V\r\nI:    {self._amp:6.3f} A\r\nBreakers: {self._state:b}\r\nR:    {self._load:6.3f} Ohm\r\nLoad: {self._rload:6.3f} Ohm\r\n'
         return 'Awaiting data from configured neighbors ...\r\n'
 
+    @property
+    def vin(self) -> float:
+        return self._vin
+
+    @property
+    def amp(self) -> float:
+        return self._amp
+
+    def point_source(self, point: Point):
+        if point.source == 'breaker':
+            # Breaker status: DPI 0x01 (OFF/CLOSED) if the breaker bit is set, 0x02 (ON/OPEN) otherwise
+            return lambda: (0x01 if (self._state & (2 ** point.index)) > 0 else 0x02) if self._vin is not None else None
+        return super().point_source(point)
+
+    def command_breaker(self, point: Point, scs: int):
+        if bool(scs):
+            # STATE OR BREAKER
+            self._state = self._state | (2 ** point.index)
+        else:
+            # STATE AND (BREAKER XOR 1...11)
+            self._state = self._state & ((2 ** point.index) ^ ((2 ** len(self._loads)) - 1))
+
     def handle_specific(self, message: simproto.NEFICSMSG):
         if message.SenderID in list(self._n_in_addr.keys()) + list(self._n_out_addr.keys()):
             addr = self._n_in_addr[message.SenderID] if message.SenderID in self._n_in_addr.keys() else self._n_out_addr[message.SenderID]
@@ -302,10 +491,10 @@ class Transmission(devicebase.IEDBase):
                         pkt.MessageID = simproto.MESSAGE_ID['MSG_NRDY']
                 elif message.MessageID == simproto.MESSAGE_ID['MSG_TREQ'] and not isinput:
                     self._rload = message.FloatArg0
-                    self._log(f'Received REQ {self._rload:f} from {addr[0]:s}')
+                    self._log('Received REQ %f from %s', self._rload, addr[0], prio=devicebase.LOG_PRIO['DEBUG'])
                     return
                 else:
-                    self._log(f'Received a NEFICS message not supported by simplepowergrid.Transmission from {addr[0]}: {repr(message)}')
+                    self._log('Received a NEFICS message not supported by simplepowergrid.Transmission from %s: %r', addr[0], message)
                     pkt.MessageID = simproto.MESSAGE_ID['MSG_UKWN']
                 if pkt is not None:
                     self._sock.sendto(pkt.build(), addr)
@@ -338,66 +527,28 @@ class Transmission(devicebase.IEDBase):
         # Check for any state changes in the substation
         if self._state != self._laststate:
             self._laststate = self._state
+            self._load = float(parallel_load(self._loads, self._state))
             if self._state == 0:
-                self._log('All breakers are OPEN', devicebase.LOG_PRIO['WARNING'])
-                self._load = float('inf')
-            else:
-                self._load = None
-                for i in range(len(self._loads)):       # Iterate over substation breakers
-                    if (self._state & (2 ** i)) > 0:    # If the current breaker is 'OFF/CLOSED' ==> Corresponding load is connected
-                        if self._loads[i] == 0:         # Failure condition ==> Simulate a broken breaker
-                            #TODO: Failure condition
-                            self._log(f'Failure condition: short circuit detected on breaker {(BASE_IOA // 10) + 1 +i}', devicebase.LOG_PRIO['CRITICAL'])
-                            self._load = 0
-                            break
-                        else:
-                            self._load = self._loads[i] if self._load is None else (self._load * self._loads[i]) / (self._load + self._loads[i])
+                self._log('All breakers are OPEN', prio=devicebase.LOG_PRIO['WARNING'])
+            elif self._load == 0:                       # Failure condition ==> Simulate a broken breaker
+                #TODO: Failure condition
+                broken = [i for i in range(len(self._loads)) if (self._state & (2 ** i)) > 0 and self._loads[i] == 0][0]
+                self._log('Failure condition: short circuit detected on breaker %d', BREAKER_BASE_IOA + broken, prio=devicebase.LOG_PRIO['CRITICAL'])
         # Determine new local values
         if self._load == float('inf'):                  # Failure condition ==> No output, no current
             self._vout = 0
             self._amp = 0
         elif all(x is not None for x in [self._vin, self._load, self._rload]):
             if self._rload == float('inf'):             # Failure in another substation
-                self._log('Breakers OPEN somewhere on the grid', devicebase.LOG_PRIO['WARNING'])
-                self._vout = self._vin
-            else:
-                self._vout = self._vin * self._rload / (self._rload + self._load)
-            try:
-                self._amp = (self._vin - self._vout) / self._load
-            except ZeroDivisionError:
-                self._log('Short circuit somewhere on the grid', devicebase.LOG_PRIO['CRITICAL'])
-                self._amp = float('inf')                # Failure condition - Short circuit in the system ==> Current increases toward infinity
+                self._log('Breakers OPEN somewhere on the grid', prio=devicebase.LOG_PRIO['WARNING'])
+            vout, amp = transmission_output(self._vin, self._load, self._rload)
+            self._vout = float(vout)
+            self._amp = float(amp)
+            if self._amp == float('inf'):
+                self._log('Short circuit somewhere on the grid', prio=devicebase.LOG_PRIO['CRITICAL'])
         sleep(0.333)
 
-    def poll_values_IEC104(self) -> list:
-        iframes = []
-        if all(x is not None for x in [self._vin, self._amp] + self._loads):
-            # Input voltage
-            ioa = IOA36(IOA=BASE_IOA, Value=self._vin, QDS=0, CP56Time=devicebase.cp56time())
-            pkt = APDU()
-            pkt /= APCI(ApduLen=25, Type=0x00, Tx=self.tx, Rx=self.rx)
-            pkt /= ASDU(TypeId=36, SQ=0, NumIx=1, CauseTx=3, Test=0, OA=0, Addr=self.guid, IOA=[ioa])
-            self.tx += 1
-            iframes.append(pkt)
-            # Measured current
-            ioa = IOA36(IOA=BASE_IOA + 1, Value=self._amp, QDS=0, CP56Time=devicebase.cp56time())
-            pkt = APDU()
-            pkt /= APCI(ApduLen=25, Type=0x00, Tx=self.tx, Rx=self.rx)
-            pkt /= ASDU(TypeId=36, SQ=0, NumIx=1, CauseTx=3, Test=0, OA=0, Addr=self.guid, IOA=[ioa])
-            self.tx += 1
-            iframes.append(pkt)
-            # Breaker status
-            for i in range(len(self._loads)):
-                brvalue = 0x01 if (self._state & (2 ** i)) > 0 else 0x02
-                ioa = IOA3(IOA=(BASE_IOA // 10) + i + 1, DIQ=DIQ(DPI=brvalue, flags=0x00))
-                pkt = APDU()
-                pkt /= APCI(ApduLen=14, Type=0x00, Tx=self.tx, Rx=self.rx)
-                pkt /= ASDU(TypeId=3, SQ=0, NumIx=1, CauseTx=3, Test=0, OA=0, Addr=self.guid, IOA=[ioa])
-                self.tx += 1
-                iframes.append(pkt)
-        return iframes
-    
-    def handle_IEC104_IFrame(self, packet: APDU) -> APDU:
+    def handle_IEC104_IFrame(self, packet: APDU, session: int=None) -> APDU:
         assert packet.haslayer('APCI')
         assert packet.haslayer('ASDU')
         apci:APCI = packet['APCI']
@@ -406,47 +557,55 @@ class Transmission(devicebase.IEDBase):
         if asdu.TypeId == 45:
             # Type 45: C_SC_NA_1 (Single command) -- 60870-5-101 IEC:2003 Section 7.3.2.1
             ioa:IOA45 = asdu['IOA45']
+            point:Point = self._points.get(ioa.IOA)
             self.tx = apci.Tx + 1
             self.rx = apci.Rx + 1
             response = APDU()
             response /= APCI(ApduLen=14, Type=0x00, Tx=self.tx, Rx=self.rx)
-            if self._wait_exec is None and ioa.SCO.SE == 1 and asdu.CauseTx == 6:
-                # SCO: Select; CoT: Act
-                if ioa.IOA in [(BASE_IOA // 10) + 1 + i for i in range(len(self._loads))]:
-                    # SCO: Select; CoT: ActCon
-                    self._wait_exec = ioa.IOA
-                    response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=7, Test=0, OA=0, Addr=self.guid, IOA=ioa)
-                else:
-                    # SCO: Select; CoT: Unknown IOA
-                    self._log(f'Received ASDU type 45 SELECT using an unknown IOA: {repr(packet)}', devicebase.LOG_PRIO['WARNING'])
-                    response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=47, Test=0, OA=0, Addr=self.guid, IOA=ioa)
-            elif self._wait_exec is not None and ioa.SCO.SE == 0 and asdu.CauseTx == 6:
-                # SCO: Execute; CoT: Act
-                if self._wait_exec == ioa.IOA:
-                    # SCO: Execute; CoT: ActCon
-                    response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=7, Test=0, OA=0, Addr=self.guid, IOA=ioa)
-                    self._wait_exec = None
-                    if bool(ioa.SCO.SCS):
-                        # STATE OR IOA
-                        self._state = self._state | (ioa.IOA - 1 - (BASE_IOA // 10))
+            with self._select_lock:
+                now = monotonic()
+                selected = self._selected.get(ioa.IOA, None)
+                if selected is not None and selected[1] < now:
+                    # The SELECT timed out before receiving an EXECUTE
+                    self._selected.pop(ioa.IOA)
+                    selected = None
+                if ioa.SCO.SE == 1 and asdu.CauseTx == 6:
+                    # SCO: Select; CoT: Act
+                    if point is None or point.handler is None:
+                        # SCO: Select; CoT: Unknown IOA
+                        self._log('Received ASDU type 45 SELECT using an unknown IOA: %s', Frame(packet.build()), prio=devicebase.LOG_PRIO['WARNING'])
+                        response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=47, Test=0, OA=0, Addr=self.guid, IOA=ioa)
+                    elif selected is not None and selected[0] != session:
+                        # SCO: Select; CoT: ActCon (Negative) -- The IOA is selected by another session
+                        self._log('Received ASDU type 45 SELECT for an IOA selected by another session: %s', Frame(packet.build()), prio=devicebase.LOG_PRIO['WARNING'])
+                        response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=7, PN=0x40, Test=0, OA=0, Addr=self.guid, IOA=ioa)
+                    else:
+                        # SCO: Select; CoT: ActCon
+                        self._selected[ioa.IOA] = (session, now + IEC104_SELECT_TIMEOUT)
+                        response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=7, Test=0, OA=0, Addr=self.guid, IOA=ioa)
+                elif ioa.SCO.SE == 0 and asdu.CauseTx == 6:
+                    # SCO: Execute; CoT: Act
+                    if selected is not None and selected[0] == session:
+                        # SCO: Execute; CoT: ActCon
+                        response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=7, Test=0, OA=0, Addr=self.guid, IOA=ioa)
+                        self._selected.pop(ioa.IOA)
+                        self._snapshot = None
+                        point.handler(point, ioa.SCO.SCS)
                     else:
-                        # STATE AND (IOA XOR 1...11)
-                        self._state = self._state & ((ioa.IOA - 1 - (BASE_IOA // 10)) ^ ((2 ** len(self._loads)) - 1))
+                        # SCO: Execute; CoT: Unknown IOA
+                        self._log('Received ASDU type 45 EXECUTE using an unexpected IOA: %s', Frame(packet.build()), prio=devicebase.LOG_PRIO['WARNING'])
+                        response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=47, Test=0, OA=0, Addr=self.guid, IOA=ioa)
+                elif selected is not None and selected[0] == session and ioa.SCO.SE == 1 and asdu.CauseTx == 8:
+                    # SCO: Select; CoT: Deact
+                    # Reply -- SCO: Select; CoT: DeactCon
+                    self._selected.pop(ioa.IOA)
+                    response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=9, Test=0, OA=0, Addr=self.guid, IOA=ioa)
                 else:
-                    # SCO: Execute; CoT: Unknown IOA
-                    self._log(f'Received ASDU type 45 EXECUTE using an unexpected IOA: {repr(packet)}', devicebase.LOG_PRIO['WARNING'])
-                    response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=47, Test=0, OA=0, Addr=self.guid, IOA=ioa)
-            elif self._wait_exec is not None and ioa.SCO.SE == 1 and asdu.CauseTx == 8:
-                # SCO: Select; CoT: Deact
-                # Reply -- SCO: Select; CoT: DeactCon
-                self._wait_exec = None
-                response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=9, Test=0, OA=0, Addr=self.guid, IOA=ioa)
-            else:
-                # CoT: Unknown CoT
-                self._log(f'Received an unexpected ASDU type 45: {repr(packet)}', devicebase.LOG_PRIO['WARNING'])
-                response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=45, Test=0, OA=0, Addr=self.guid, IOA=ioa)
+                    # CoT: Unknown CoT
+                    self._log('Received an unexpected ASDU type 45: %s', Frame(packet.build()), prio=devicebase.LOG_PRIO['WARNING'])
+                    response /= ASDU(TypeId=45, SQ=0, NumIx=1, CauseTx=45, Test=0, OA=0, Addr=self.guid, IOA=ioa)
         if response is None:
-            self._log(f'Received an unexpected I-Frame: {repr(packet)}', devicebase.LOG_PRIO['WARNING'])
+            self._log('Received an unexpected I-Frame: %s', Frame(packet.build()), prio=devicebase.LOG_PRIO['WARNING'])
             response = packet
             response['APCI'].Rx = self.rx
             response['APCI'].Tx = self.tx
@@ -472,6 +631,7 @@ class Load(devicebase.IEDBase):
         self._load = kwargs['load']
         self._vin = None
         self._amp = None
+        self._load_points(measurement_points())
     
     def __str__(self) -> str:
         if all(x is not None for x in [self._vin, self._load, self._amp]):
@@ -487,6 +647,14 @@ class Load(devicebase.IEDBase):
         self._load = value if value >= 0 else self._load
         # A zero-valued load represents a failure
 
+    @property
+    def vin(self) -> float:
+        return self._vin
+
+    @property
+    def amp(self) -> float:
+        return self._amp
+
     def handle_specific(self, message: simproto.NEFICSMSG):
         if message.SenderID in self._n_in_addr.keys():
             addr = self._n_in_addr[message.SenderID]
@@ -502,7 +670,7 @@ class Load(devicebase.IEDBase):
                     pkt = None
                     self._vin = message.FloatArg0
                 else:
-                    self._log(f'Received a NEFICS message not supported by simplepowergrid.Load from {addr}: {repr(message)}')
+                    self._log('Received a NEFICS message not supported by simplepowergrid.Load from %s: %r', addr, message)
                     pkt = simproto.NEFICSMSG(
                         SenderID=self.guid,
                         ReceiverID=message.SenderID,
@@ -524,37 +692,13 @@ class Load(devicebase.IEDBase):
             self._sock.sendto(pkt.build(), addr)
             sleep(0.5)
         if all(x is not None for x in [self._load, self._vin]):
-            if self.load == float('inf'):
-                # Failure condition - Open circuit
-                self._amp = 0
-            else:
-                try:
-                    self._amp = self._vin / self.load
-                except ZeroDivisionError:
-                    # Short-circuit on load
-                    self._log(f'Load (GUID:{self.guid}) is in short circuit condition', devicebase.LOG_PRIO['CRITICAL'])
-                    self._amp = float('inf')
-
-    def poll_values_IEC104(self) -> list:
-        iframes = []
-        if all(x is not None for x in [self._vin, self._amp]):
-            # Input voltage
-            ioa = IOA36(IOA=BASE_IOA, Value=self._vin, QDS=0, CP56Time=devicebase.cp56time())
-            pkt = APDU()
-            pkt /= APCI(ApduLen=25, Type=0x00, Tx=self.tx, Rx=self.rx)
-            pkt /= ASDU(TypeId=36, SQ=0, NumIx=1, CauseTx=3, Test=0, OA=0, Addr=self.guid, IOA=[ioa])
-            self.tx += 1
-            iframes.append(pkt)
-            # Measured current
-            ioa = IOA36(IOA=BASE_IOA + 1, Value=self._amp, QDS=0, CP56Time=devicebase.cp56time())
-            pkt = APDU()
-            pkt /= APCI(ApduLen=25, Type=0x00, Tx=self.tx, Rx=self.rx)
-            pkt /= ASDU(TypeId=36, SQ=0, NumIx=1, CauseTx=3, Test=0, OA=0, Addr=self.guid, IOA=[ioa])
-            self.tx += 1
-            iframes.append(pkt)
-        return iframes
-
-    def handle_IEC104_IFrame(self, packet: APDU) -> APDU:
+            # An infinite load is an open circuit (no current)
+            self._amp = float(load_current(self._vin, self.load))
+            if self.load == 0:
+                # Short-circuit on load
+                self._log('Load (GUID:%d) is in short circuit condition', self.guid, prio=devicebase.LOG_PRIO['CRITICAL'])
+
+    def handle_IEC104_IFrame(self, packet: APDU, session: int=None) -> APDU:
         # A load device shouldn't receive any I-Frames
         assert packet.haslayer('APCI')
         assert packet.haslayer('ASDU')
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+'''
+IEC 60870-5-104 feature extractor for packet captures.
+
+Streams a pcap or pcapng capture, reassembles the TCP flows of port 2404
+and writes every information object of the received I-frames as the CSV
+files used by the Detection scripts (one file per "<srcIP>;<dstIP>.csv").
+
+The capture is read once by the main process, which only decodes the
+link, IP and TCP headers. TCP payloads are dispatched to worker processes
+by IP address pair, so every connection is reassembled and written by a
+single worker. Rows are written in chunks, so memory usage does not
+depend on the size of the capture.
+
+    python -m nefics.pcap2csv capture.pcapng output/ -j 8
+'''
+
+import os
+import sys
+import argparse
+import struct
+from multiprocessing import Process, Queue
+from socket import inet_ntoa
+from nefics.IEC104.fast import CODECS, IOALEN
+from nefics.master import point_value
+from nefics.recorder import DETECTION_COLUMNS
+
+IEC104_PORT = 2404
+BATCH_SIZE = 1024           # TCP segments sent to a worker at once
+CHUNK_ROWS = 65536          # Rows buffered by a worker before writing them
+MAX_OUT_OF_ORDER = 256      # Out of order segments kept per flow before skipping the gap
+
+# Link types (http://www.tcpdump.org/linktypes.html) -> offset of the IP header, ethertype offset
+LINKTYPE_NULL = 0
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+
+# Fast decoders of the most common information object values: (IOA bytes) -> value
+FAST_VALUES = {
+    1: lambda b: b[3] & 0x01,
+    3: lambda b: b[3] & 0x03,
+    9: lambda b: struct.unpack_from('<h', b, 3)[0],
+    13: lambda b: struct.unpack_from('<f', b, 3)[0],
+    30: lambda b: b[3] & 0x01,
+    31: lambda b: b[3] & 0x03,
+    36: lambda b: struct.unpack_from('<f', b, 3)[0],
+    45: lambda b: b[3] & 0x81,    # (SE << 7) | SCS, as nefics.master.point_value
+    50: lambda b: struct.unpack_from('<f', b, 3)[0],
+}
+
+def read_pcap(f):
+    '''
+    Iterate over the (timestamp, link type, frame) records of a pcap or
+    pcapng file object.
+    '''
+    magic = f.read(4)
+    if magic == b'\x0a\x0d\x0d\x0a':
+        yield from _read_pcapng(f, magic)
+        return
+    if magic in [b'\xd4\xc3\xb2\xa1', b'\x4d\x3c\xb2\xa1']:
+        endian = '<'
+    elif magic in [b'\xa1\xb2\xc3\xd4', b'\xa1\xb2\x3c\x4d']:
+        endian = '>'
+    else:
+        raise ValueError('Unknown capture file format')
+
+    resolution = 1e-9 if magic in [b'\x4d\x3c\xb2\xa1', b'\xa1\xb2\x3c\x4d'] else 1e-6
+    header = f.read(20)
+    linktype = struct.unpack(endian + 'I', header[16:20])[0] & 0x0fffffff
+    record = struct.Struct(endian + 'IIII')
+    while True:
+        data = f.read(16)
+        if len(data) < 16:
+            break
+        sec, frac, caplen, _ = record.unpack(data)
+        frame = f.read(caplen)
+        if len(frame) < caplen:
+            break
+        yield sec + frac * resolution, linktype, frame
+
+def _read_pcapng(f, magic: bytes):
+    interfaces = []  # Interface ID -> (link type, timestamp resolution)
+    endian = '<'
+    block = magic
+    while len(block) == 4:
+        length = f.read(4)
+        if len(length) < 4:
+            break
+        if block == b'\x0a\x0d\x0d\x0a': # Section header block: byte order and new interfaces
+            bom = f.read(4)
+            endian = '<' if bom == b'\x4d\x3c\x2b\x1a' else '>'
+            length = struct.unpack(endian + 'I', length)[0]
+            f.read(length - 12)
+            interfaces = []
+        else:
+            btype = struct.unpack(endian + 'I', block)[0]
+            length = struct.unpack(endian + 'I', length)[0]
+            body = f.read(length - 8)
+            if len(body) < length - 8:
+                break
+            if btype == 1: # Interface description block
+                linktype = struct.unpack_from(endian + 'H', body, 0)[0]
+                resolution = 1e-6
+                offset = 8
+                while offset + 4 <= len(body) - 4:
+                    code, olen = struct.unpack_from(endian + 'HH', body, offset)
+                    if code == 0:
+                        break
+                    if code == 9 and olen == 1: # if_tsresol
+                        tsresol = body[offset + 4]
+                        resolution = 2.0 ** -(tsresol & 0x7f) if tsresol & 0x80 else 10.0 ** -tsresol
+                    offset += 4 + olen + (-olen % 4)
+                interfaces.append((linktype, resolution))
+            elif btype == 6: # Enhanced packet block
+                ifid, tshigh, tslow, caplen = struct.unpack_from(endian + 'IIII', body, 0)
+                linktype, resolution = interfaces[ifid]
+                yield ((tshigh << 32) | tslow) * resolution, linktype, body[20:20 + caplen]
+            elif btype == 3: # Simple packet block
+                linktype, _ = interfaces[0]
+                caplen = min(struct.unpack_from(endian + 'I', body, 0)[0], len(body) - 8)
+                yield 0.0, linktype, body[4:4 + caplen]
+        block = f.read(4)
+
+def decode_tcp(linktype: int, frame: bytes) -> tuple:
+    '''
+    Decode the IPv4 and TCP headers of a frame. Returns (source, source
+    port, destination, destination port, sequence number, flags,
+    payload), or None if the frame is not an IPv4 TCP segment.
+    '''
+    if linktype == LINKTYPE_ETHERNET:
+        offset = 14
+        ethertype = struct.unpack_from('!H', frame, 12)[0] if len(frame) >= 14 else 0
+        while ethertype in [0x8100, 0x88a8] and len(frame) >= offset + 4: # VLAN tags
+            ethertype = struct.unpack_from('!H', frame, offset + 2)[0]
+            offset += 4
+        if ethertype != 0x0800:
+            return None
+    elif linktype == LINKTYPE_LINUX_SLL:
+        offset = 16
+        if len(frame) < 16 or struct.unpack_from('!H', frame, 14)[0] != 0x0800:
+            return None
+    elif linktype == LINKTYPE_NULL:
+        offset = 4
+    elif linktype in [LINKTYPE_RAW, LINKTYPE_IPV4]:
+        offset = 0
+    else:
+        return None
+    if len(frame) < offset + 20 or frame[offset] >> 4 != 4 or frame[offset + 9] != 6:
+        return None
+    ihl = (frame[offset] & 0x0f) * 4
+    total = struct.unpack_from('!H', frame, offset + 2)[0]
+    src = inet_ntoa(frame[offset + 12:offset + 16])
+    dst = inet_ntoa(frame[offset + 16:offset + 20])
+    tcp = offset + ihl
+    if len(frame) < tcp + 20:
+        return None
+    sport, dport, seq = struct.unpack_from('!HHI', frame, tcp)
+    dataofs = (frame[tcp + 12] >> 4) * 4
+    flags = frame[tcp + 13]
+    payload = frame[tcp + dataofs:offset + total] if total > 0 else frame[tcp + dataofs:]
+    return src, sport, dst, dport, seq, flags, payload
+
+class TCPStream(object):
+    '''
+    Reassembly of one direction of a TCP connection.
+    '''
+
+    def __init__(self):
+        self.next_seq = None
+        self.buffer = bytearray()
+        self.pending = {}   # Sequence number -> Out of order payload
+
+    def add(self, seq: int, flags: int, payload: bytes):
+        if flags & 0x02: # SYN
+            self.next_seq = (seq + 1) & 0xffffffff
+            return
+        if len(payload) == 0:
+            return
+        if self.next_seq is None: # Capture started within the connection
+            self.next_seq = seq
+        diff = (seq - self.next_seq) & 0xffffffff
+        if diff >= 0x80000000: # Retransmission, possibly overlapping new data
+            overlap = (self.next_seq - seq) & 0xffffffff
+            if overlap >= len(payload):
+                return
+            payload = payload[overlap:]
+            diff = 0
+        if diff > 0:
+            self.pending[seq] = payload
+            if len(self.pending) > MAX_OUT_OF_ORDER: # Lost segment: skip the gap
+                self.next_seq = min(self.pending.keys(), key=lambda s: (s - self.next_seq) & 0xffffffff)
+                self.buffer.clear()
+            else:
+                return
+        else:
+            self.buffer += payload
+            self.next_seq = (self.next_seq + len(payload)) & 0xffffffff
+        while self.next_seq in self.pending:
+            payload = self.pending.pop(self.next_seq)
+            self.buffer += payload
+            self.next_seq = (self.next_seq + len(payload)) & 0xffffffff
+
+    def apdus(self):
+        '''
+        Iterate over the complete APDUs in the reassembled data.
+        '''
+        buf = self.buffer
+        start = 0
+        while len(buf) - start >= 2:
+            if buf[start] != 0x68: # Out of sync: look for the next start byte
+                start = buf.find(b'\x68', start + 1)
+                if start < 0:
+                    start = len(buf)
+                continue
+            end = start + 2 + buf[start + 1]
+            if end > len(buf):
+                break
+            yield bytes(buf[start:end])
+            start = end
+        del buf[:start]
+
+def decode_asdu(apdu: bytes):
+    '''
+    Iterate over the (TypeId, cause of transmission, IOA, value) tuples of
+    the information objects within an I-frame.
+    '''
+    if len(apdu) < 12 or apdu[2] & 0x01:
+        return
+    typeid = apdu[6]
+    sq = apdu[7] & 0x80
+    numix = apdu[7] & 0x7f
+    cot = apdu[8] & 0x3f
+    if typeid not in IOALEN:
+        return
+    length = IOALEN[typeid]
+    fast = FAST_VALUES.get(typeid, None)
+    offset = 12
+    ioa = None
+    for i in range(numix):
+        if sq and i > 0: # Sequence of elements: only the first object carries the address
+            ioa += 1
+            element = struct.pack('<I', ioa)[:3] + apdu[offset:offset + length - 3]
+            offset += length - 3
+        else:
+            element = apdu[offset:offset + length]
+            offset += length
+            ioa = struct.unpack('<I', element[:3] + b'\x00')[0]
+        if len(element) < length:
+            break
+        value = fast(element) if fast is not None else point_value(CODECS[typeid].decode(element, 3, ioa))
+        yield typeid, cot, ioa, value
+
+def _write_rows(output: str, key: tuple, rows: list, written: set):
+    filename = os.path.join(output, f'{key[0]:s};{key[1]:s}.csv')
+    with open(filename, 'a' if key in written else 'w') as f:
+        if key not in written:
+            f.write(','.join(DETECTION_COLUMNS) + '\n')
+            written.add(key)
+        f.writelines(f'{src:s},{dst:s},{ts:.6f},{typeid:d}-{cot:d},{ioa:d},{"" if value is None else value}\n' for src, dst, ts, typeid, cot, ioa, value in rows)
+
+def _flow_worker(queue: Queue, results: Queue, output: str):
+    streams = {}    # (source, source port, destination, destination port) -> TCPStream
+    rows = {}       # (source, destination) -> Buffered rows
+    written = set()
+    count = 0
+    while True:
+        batch = queue.get()
+        if batch is None:
+            break
+        for ts, src, sport, dst, dport, seq, flags, payload in batch:
+            stream = streams.setdefault((src, sport, dst, dport), TCPStream())
+            stream.add(seq, flags, payload)
+            if flags & 0x05: # FIN or RST
+                streams.pop((src, sport, dst, dport))
+            for apdu in stream.apdus():
+                for typeid, cot, ioa, value in decode_asdu(apdu):
+                    buffered = rows.setdefault((src, dst), [])
+                    buffered.append((src, dst, ts, typeid, cot, ioa, value))
+                    count += 1
+                    if len(buffered) >= CHUNK_ROWS:
+                        _write_rows(output, (src, dst), buffered, written)
+                        buffered.clear()
+    for key, buffered in rows.items():
+        if len(buffered) > 0:
+            _write_rows(output, key, buffered, written)
+    results.put((count, sorted(written)))
+
+def convert(capture: str, output: str, jobs: int=None, port: int=IEC104_PORT) -> list:
+    '''
+    Convert a capture into Detection CSV files. Returns the list of
+    written files.
+    '''
+    jobs = jobs if jobs is not None else os.cpu_count() or 1
+    os.makedirs(output, exist_ok=True)
+    queues = [Queue(8) for _ in range(jobs)]
+    results = Queue()
+    workers = [Process(target=_flow_worker, args=(q, results, output), daemon=True) for q in queues]
+    for w in workers:
+        w.start()
+    batches = [[] for _ in range(jobs)]
+    with open(capture, 'rb') as f:
+        for ts, linktype, frame in read_pcap(f):
+            segment = decode_tcp(linktype, frame)
+            if segment is None:
+                continue
+            src, sport, dst, dport, seq, flags, payload = segment
+            if port not in [sport, dport]:
+                continue
+            worker = hash((src, dst)) % jobs
+            batches[worker].append((ts, src, sport, dst, dport, seq, flags, payload))
+            if len(batches[worker]) >= BATCH_SIZE:
+                queues[worker].put(batches[worker])
+                batches[worker] = []
+    for q, batch in zip(queues, batches):
+        if len(batch) > 0:
+            q.put(batch)
+        q.put(None)
+    written = []
+    for _ in workers:
+        _, keys = results.get()
+        written += [os.path.join(output, f'{src:s};{dst:s}.csv') for src, dst in keys]
+    for w in workers:
+        w.join()
+    return sorted(written)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Extract IEC 60870-5-104 measurements from a capture as Detection CSV files')
+    parser.add_argument('capture', type=str, help='pcap or pcapng capture file')
+    parser.add_argument('output', type=str, help='Output directory')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Worker processes (default: CPU count)')
+    parser.add_argument('-p', '--port', type=int, default=IEC104_PORT, help='IEC 60870-5-104 TCP port')
+    args = parser.parse_args()
+    for filename in convert(args.capture, args.output, args.jobs, args.port):
+        sys.stdout.write(f'{filename:s}\n')
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+Point table (IOA registry) for IEC 60870-5-104 devices.
+
+A point table maps every information object address (IOA) of a device to
+its declaration: ASDU type, value source, deadband and command handler.
+Lookups are backed by a dictionary, so command dispatch and interrogation
+do not depend on the amount of points configured in the device.
+
+Point tables are declared as a list of JSON objects, which can be included
+in the launcher configuration as the "points" parameter of a device:
+
+    "points": [
+        {"ioa": 1001, "type": 36, "name": "Voltage", "unit": "V", "source": "vin"},
+        {"ioa": 101, "type": 3, "name": "Breaker", "unit": "Open/Close", "source": "breaker", "index": 0, "command": "breaker"}
+    ]
+
+Available point attributes:
+
+    ioa         Information object address (required)
+    type        ASDU type used to report the value (required)
+    name        Human readable name of the point
+    unit        Unit of the reported value
+    source      Name of the value source, resolved by the device
+    index       Index within the value source (e.g. the breaker number)
+    deadband    Minimum change required to report the value. Without a
+                deadband, the point is reported on every pass. The last
+                reported values are kept by each reporting session (see
+                PointTable.report).
+    command     Name of the command handler, resolved by the device
+'''
+
+from nefics.IEC104.ioa import DIQ, IOA1, IOA3, IOA9, IOA13, IOA30, IOA31, IOA36, CP56Time
+
+BASE_IOA = 1001             # Lowest IOA used by the simulation to store measurement values
+BREAKER_BASE_IOA = 101      # Lowest IOA used by the simulation to store breaker status
+
+POINT_DIRECTIVES = [
+    'ioa',
+    'type',
+    'name',
+    'unit',
+    'source',
+    'index',
+    'deadband',
+    'command'
+]
+
+# Information object builders for every supported monitoring type: (IOA, value, time tag) -> IOA packet
+IOA_BUILDERS = {
+    1: lambda ioa, value, ct: IOA1(IOA=ioa, SIQ=int(value) & 0x01),
+    3: lambda ioa, value, ct: IOA3(IOA=ioa, DIQ=DIQ(DPI=int(value), flags=0x00)),
+    9: lambda ioa, value, ct: IOA9(IOA=ioa, Value=int(value), QDS=0),
+    13: lambda ioa, value, ct: IOA13(IOA=ioa, Value=float(value), QDS=0),
+    30: lambda ioa, value, ct: IOA30(IOA=ioa, SIQ=int(value) & 0x01, CP56Time=ct),
+    31: lambda ioa, value, ct: IOA31(IOA=ioa, DIQ=DIQ(DPI=int(value), flags=0x00), CP56Time=ct),
+    36: lambda ioa, value, ct: IOA36(IOA=ioa, Value=float(value), QDS=0, CP56Time=ct),
+}
+
+class Point(object):
+    '''
+    Declaration of a single information object.
+
+    The value getter and the command handler are bound by the device
+    owning the point (see PointTable.bind).
+    '''
+
+    __slots__ = ['ioa', 'typeid', 'name', 'unit', 'source', 'index', 'deadband', 'command', 'getter', 'handler']
+
+    def __init__(self, ioa: int, typeid: int, name: str='', unit: str='', source: str=None, index: int=None, deadband: float=None, command: str=None):
+        assert isinstance(ioa, int) and ioa in range(0x1000000)
+        assert typeid in IOA_BUILDERS.keys() or source is None
+        assert deadband is None or deadband >= 0
+        self.ioa = ioa
+        self.typeid = typeid
+        self.name = name
+        self.unit = unit
+        self.source = source
+        self.index = index
+        self.deadband = deadband
+        self.command = command
+        self.getter = None      # Callable returning the current value of the point
+        self.handler = None     # Callable executing a command on the point
+
+    def __repr__(self) -> str:
+        return f'Point({self.ioa:d}, {self.typeid:d}, {self.name!r})'
+
+    def build(self, value, ct: CP56Time):
+        '''
+        Build the information object reporting the given value.
+        '''
+        return IOA_BUILDERS[self.typeid](self.ioa, value, ct)
+
+    @classmethod
+    def from_config(cls, config: dict):
+        assert isinstance(config, dict)
+        assert all(k in POINT_DIRECTIVES for k in config.keys())
+        assert all(k in config.keys() for k in ['ioa', 'type'])
+        return cls(
+            config['ioa'],
+            config['type'],
+            name=config.get('name', ''),
+            unit=config.get('unit', ''),
+            source=config.get('source', None),
+            index=config.get('index', None),
+            deadband=config.get('deadband', None),
+            command=config.get('command', None)
+        )
+
+class PointTable(object):
+    '''
+    IOA registry of a device.
+
+    Points are kept in declaration order for reporting, and indexed by
+    IOA for constant time lookups.
+    '''
+
+    def __init__(self, points: list=list()):
+        self._points = {}   # IOA -> Point
+        self._order = []    # Points in declaration (report) order
+        self._last = {}     # IOA -> last value reported without a session state (see report)
+        for point in points:
+            self.add(point)
+
+    def __len__(self) -> int:
+        return len(self._order)
+
+    def __iter__(self):
+        return iter(self._order)
+
+    def __contains__(self, ioa: int) -> bool:
+        return ioa in self._points
+
+    def __getitem__(self, ioa: int) -> Point:
+        return self._points[ioa]
+
+    def get(self, ioa: int, default: Point=None) -> Point:
+        return self._points.get(ioa, default)
+
+    def add(self, point: Point):
+        assert isinstance(point, Point)
+        assert point.ioa not in self._points, f'Duplicated IOA: {point.ioa:d}'
+        self._points[point.ioa] = point
+        self._order.append(point)
+
+    def bind(self, device):
+        '''
+        Resolve the value source and command handler of every point
+        using the given device (see IEDBase.point_source and
+        IEDBase.point_command).
+        '''
+        for point in self._order:
+            point.getter = device.point_source(point) if point.source is not None else None
+            point.handler = device.point_command(point) if point.command is not None else None
+
+    def snapshot(self, ct: CP56Time) -> list:
+        '''
+        Return the (TypeId, IOA) tuples of every readable point with
+        a value.
+        '''
+        output = []
+        for p in self._order:
+            if p.getter is None:
+                continue
+            value = p.getter()
+            if value is not None:
+                output.append((p.typeid, p.build(value, ct)))
+        return output
+
+    def report(self, ct: CP56Time, last: dict=None) -> list:
+        '''
+        Return the (TypeId, IOA) tuples of the points to be reported in
+        the current pass: points without deadband are always reported,
+        the remaining points only when their value changed by more than
+        the deadband since the last report. Points without a value yet
+        are not reported.
+
+        The last reported values (IOA -> value) are kept in the given
+        dictionary, so that every session reporting the points keeps its
+        own state. Without it, a state shared by every caller is used.
+        '''
+        if last is None:
+            last = self._last
+        output = []
+        for p in self._order:
+            if p.getter is None:
+                continue
+            value = p.getter()
+            if value is None:
+                continue
+            if p.deadband is not None:
+                previous = last.get(p.ioa, None)
+                if previous is not None and abs(value - previous) <= p.deadband:
+                    continue
+                last[p.ioa] = value
+            output.append((p.typeid, p.build(value, ct)))
+        return output
+
+    @classmethod
+    def from_config(cls, config: list):
+        '''
+        Create a point table from its JSON declaration.
+        '''
+        assert isinstance(config, list)
+        return cls([Point.from_config(p) for p in config])
+
+def measurement_points(voltage_source: str='vin', current_source: str='amp') -> list:
+    '''
+    Point declaration of the measurement values used in the simulation.
+    If a source is None, the corresponding point is not declared.
+    '''
+    points = []
+    if voltage_source is not None:
+        points.append({'ioa': BASE_IOA, 'type': 36, 'name': 'Voltage', 'unit': 'V', 'source': voltage_source})
+    if current_source is not None:
+        points.append({'ioa': BASE_IOA + 1, 'type': 36, 'name': 'Current', 'unit': 'A', 'source': current_source})
+    return points
+
+def breaker_points(breakers: int) -> list:
+    '''
+    Point declaration of the breakers of a transmission substation. Each
+    breaker reports its status (M_DP_NA_1) and accepts single commands
+    (C_SC_NA_1) on the same IOA.
+    '''
+    return [{'ioa': BREAKER_BASE_IOA + i, 'type': 3, 'name': 'Breaker', 'unit': 'Open/Close', 'source': 'breaker', 'index': i, 'command': 'breaker'} for i in range(breakers)]
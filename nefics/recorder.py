@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+'''
+Time-series recorder for the values received by the SCADA master.
+
+Every measurement delivered by the master (see nefics.master) is appended
+to fixed size column buffers. Full buffers are written by a background
+thread as numbered segments of a columnar file format: Parquet when
+pyarrow is available, compressed NumPy archives otherwise. Memory usage
+is bounded by the chunk size and the amount of segments waiting to be
+written: the recorder never blocks its caller (the master event loop),
+so segments are dropped (counted in dropped) while the writer falls
+behind. A failure of the writer is raised by the next flush or close.
+
+    recorder = Recorder('capture/')
+    master.subscribe(recorder)
+    ...
+    recorder.close()
+
+The recorded segments can be exported as the per-connection CSV files
+used by the Detection scripts:
+
+    python -m nefics.recorder capture/ output/ --master 10.0.0.1
+'''
+
+import os
+import sys
+import argparse
+import numpy as np
+from queue import Queue, Full
+from threading import Thread
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+CHUNK_SIZE = 65536          # Measurements per segment
+MAX_PENDING_SEGMENTS = 4    # Full segments waiting to be written before new segments are dropped
+
+COLUMNS = [
+    ('time', np.float64),
+    ('rtu', object),
+    ('ca', np.uint16),
+    ('ioa', np.uint32),
+    ('type', np.uint8),
+    ('cot', np.uint8),
+    ('value', np.float64),
+    ('quality', np.uint8),
+]
+
+# Columns of the CSV files consumed by the Detection scripts
+DETECTION_COLUMNS = ['srcIP', 'dstIP', 'Time', 'ASDU_Type-CauseTx', 'IOA', 'Measurement']
+
+class Recorder(object):
+    '''
+    Chunked columnar recorder of measurement dictionaries.
+
+    The recorder is callable, so it can be registered directly as a
+    master subscriber.
+    '''
+
+    def __init__(self, path: str, chunk_size: int=CHUNK_SIZE, fmt: str=None):
+        assert chunk_size > 0
+        assert fmt in [None, 'parquet', 'npz']
+        if fmt is None:
+            fmt = 'parquet' if pq is not None else 'npz'
+        assert fmt != 'parquet' or pq is not None, 'Parquet output requires pyarrow'
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.format = fmt
+        self.chunk_size = chunk_size
+        self.segments = len([f for f in os.listdir(path) if f.startswith('segment-')])
+        self.dropped = 0            # Segments dropped because the writer fell behind
+        self.error = None           # Exception raised by the writer thread
+        self._buffers = self._allocate()
+        self._count = 0
+        self._queue = Queue(MAX_PENDING_SEGMENTS)
+        self._writer = Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def _allocate(self) -> dict:
+        return {name: np.empty(self.chunk_size, dtype=dtype) for name, dtype in COLUMNS}
+
+    def __call__(self, measurement: dict):
+        self.append(measurement)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def append(self, measurement: dict):
+        i = self._count
+        for name, _ in COLUMNS:
+            value = measurement[name]
+            self._buffers[name][i] = np.nan if value is None else value
+        self._count += 1
+        if self._count == self.chunk_size:
+            self.flush()
+
+    def flush(self, block: bool=False):
+        '''
+        Hand the buffered measurements to the writer thread. Unless block
+        is set, the measurements are dropped if MAX_PENDING_SEGMENTS
+        segments are already waiting. Raises OSError if the writer failed.
+        '''
+        self._check()
+        if self._count == 0:
+            return
+        columns = {name: buffer[:self._count] for name, buffer in self._buffers.items()}
+        columns['rtu'] = columns['rtu'].astype(str)
+        try:
+            self._queue.put((self.segments, columns), block=block)
+            self.segments += 1
+        except Full:
+            self.dropped += 1
+        self._buffers = self._allocate()
+        self._count = 0
+
+    def _check(self):
+        if self.error is not None:
+            raise OSError(f'Unable to write the segments in {self.path:s}: {self.error}') from self.error
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                # Discard the remaining segments until the recorder is closed
+                continue
+            segment, columns = item
+            filename = os.path.join(self.path, f'segment-{segment:06d}.{self.format:s}')
+            try:
+                if self.format == 'parquet':
+                    pq.write_table(pa.table(columns), filename)
+                else:
+                    np.savez_compressed(filename, **columns)
+            except Exception as ex:
+                self.error = ex
+
+    def close(self):
+        '''
+        Write the remaining measurements and stop the writer thread.
+        Raises OSError if the writer failed.
+        '''
+        try:
+            self.flush(block=True)
+        finally:
+            self._queue.put(None)
+            self._writer.join()
+        self._check()
+
+def segments(path: str):
+    '''
+    Iterate over the recorded segments as dictionaries of column arrays.
+    '''
+    for filename in sorted(f for f in os.listdir(path) if f.startswith('segment-')):
+        filename = os.path.join(path, filename)
+        if filename.endswith('.parquet'):
+            table = pq.read_table(filename)
+            yield {name: table.column(name).to_numpy() for name, _ in COLUMNS}
+        elif filename.endswith('.npz'):
+            with np.load(filename) as data:
+                yield {name: data[name] for name, _ in COLUMNS}
+
+def load(path: str):
+    '''
+    Load every recorded segment in a single pandas DataFrame.
+    '''
+    import pandas as pd
+    frames = [pd.DataFrame(columns) for columns in segments(path)]
+    if len(frames) == 0:
+        return pd.DataFrame({name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS})
+    return pd.concat(frames, ignore_index=True)
+
+def to_detection(df, master: str):
+    '''
+    Convert recorded measurements to the columns used by the Detection
+    scripts (see DETECTION_COLUMNS). The RTU is the source of every
+    measurement and the master is the destination.
+    '''
+    import pandas as pd
+    return pd.DataFrame({
+        'srcIP': df['rtu'].values,
+        'dstIP': master,
+        'Time': df['time'].values,
+        'ASDU_Type-CauseTx': df['type'].astype(str) + '-' + df['cot'].astype(str),
+        'IOA': df['ioa'].values,
+        'Measurement': df['value'].values,
+    }, columns=DETECTION_COLUMNS)
+
+def export_csv(path: str, output: str, master: str) -> list:
+    '''
+    Export the recorded segments as one CSV file per connection, named
+    "<srcIP>;<dstIP>.csv". Returns the list of written files.
+    '''
+    os.makedirs(output, exist_ok=True)
+    written = []
+    df = to_detection(load(path), master)
+    for (src, dst), group in df.groupby(['srcIP', 'dstIP'], sort=True):
+        filename = os.path.join(output, f'{src:s};{dst:s}.csv')
+        group.to_csv(filename, sep=',', index=False)
+        written.append(filename)
+    return written
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export recorded SCADA measurements as Detection CSV files')
+    parser.add_argument('path', type=str, help='Directory with the recorded segments')
+    parser.add_argument('output', type=str, help='Output directory')
+    parser.add_argument('--master', type=str, default='0.0.0.0', help='Address of the SCADA master (dstIP column)')
+    args = parser.parse_args()
+    for filename in export_csv(args.path, args.output, args.master):
+        sys.stdout.write(f'{filename:s}\n')
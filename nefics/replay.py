@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+'''
+Offline replay of captured IEC 60870-5-104 sessions.
+
+Loads the I-frames sent by every RTU from a pcap/pcapng capture (see
+nefics.pcap2csv) or from the segments written by nefics.recorder, and
+serves them again over TCP, so the SCADA master, the pollers and the
+Detection tools can be exercised without the emulated network.
+
+Every RTU is served on its own loopback address (127.0.0.1, 127.0.0.2,
+... by default) and the IEC 104 port. The ASDUs are sent after STARTDT
+with the original timing, scaled by a speed factor, or as fast as the
+client reads them. Send and receive sequence numbers are re-stamped for
+every connection.
+
+    python -m nefics.replay capture.pcapng --speed 10
+    python -m nefics.replay recording/ --max
+'''
+
+import os
+import sys
+import struct
+import asyncio
+import argparse
+import ipaddress
+from datetime import datetime
+from nefics.pcap2csv import read_pcap, decode_tcp, TCPStream, IEC104_PORT
+
+STARTDT = 0x01
+STOPDT = 0x04
+TESTFR = 0x10
+IEC104_W = 8                # Received I-frames acknowledged at once
+DRAIN_FRAMES = 256          # Frames written before waiting for the client at maximum speed
+
+def load_capture(capture: str, port: int=IEC104_PORT) -> dict:
+    '''
+    Load the I-frames sent by the RTUs of a capture. Returns a dictionary
+    mapping every RTU address to its list of (timestamp, ASDU) tuples.
+    Only the first master connected to every RTU is kept.
+    '''
+    streams = {}    # (source, source port, destination, destination port) -> TCPStream
+    masters = {}    # RTU address -> master address
+    asdus = {}
+    with open(capture, 'rb') as f:
+        for ts, linktype, frame in read_pcap(f):
+            segment = decode_tcp(linktype, frame)
+            if segment is None:
+                continue
+            src, sport, dst, dport, seq, flags, payload = segment
+            if sport != port or masters.setdefault(src, dst) != dst:
+                continue
+            stream = streams.setdefault((src, sport, dst, dport), TCPStream())
+            stream.add(seq, flags, payload)
+            if flags & 0x05: # FIN or RST
+                streams.pop((src, sport, dst, dport))
+            for apdu in stream.apdus():
+                if len(apdu) > 6 and apdu[2] & 0x01 == 0: # I-frame
+                    asdus.setdefault(src, []).append((ts, apdu[6:]))
+    return asdus
+
+def _cp56time(ts: float) -> bytes:
+    t = datetime.fromtimestamp(ts)
+    return struct.pack('<HBBBBB', t.second * 1000 + t.microsecond // 1000, t.minute, t.hour,
+                       t.day | ((t.weekday() + 1) << 5), t.month, t.year % 100)
+
+# Information object elements (without IOA) rebuilt from recorded values: (value, quality, time) -> bytes
+ELEMENTS = {
+    1: lambda v, q, ts: bytes([(q & 0xf0) | (int(v) & 0x01)]),
+    3: lambda v, q, ts: bytes([(q & 0xf0) | (int(v) & 0x03)]),
+    9: lambda v, q, ts: struct.pack('<hB', int(v), q),
+    13: lambda v, q, ts: struct.pack('<fB', v, q),
+    30: lambda v, q, ts: bytes([(q & 0xf0) | (int(v) & 0x01)]) + _cp56time(ts),
+    31: lambda v, q, ts: bytes([(q & 0xf0) | (int(v) & 0x03)]) + _cp56time(ts),
+    36: lambda v, q, ts: struct.pack('<fB', v, q) + _cp56time(ts),
+}
+
+def load_recording(path: str) -> dict:
+    '''
+    Rebuild the ASDUs of a recording (see nefics.recorder). Consecutive
+    measurements of an RTU with the same time, type, cause and common
+    address are packed in a single ASDU. Returns the same dictionary as
+    load_capture.
+    '''
+    from nefics.recorder import load
+    df = load(path)
+    asdus = {}
+    current = {}    # RTU address -> (time, TypeId, CoT, common address, elements)
+    def pack(rtu: str):
+        ts, typeid, cot, ca, elements = current.pop(rtu)
+        asdus.setdefault(rtu, []).append((ts, struct.pack('<BBBBH', typeid, len(elements), cot, 0, ca) + b''.join(elements)))
+    for ts, rtu, ca, ioa, typeid, cot, value, quality in zip(df['time'], df['rtu'], df['ca'], df['ioa'], df['type'],
+                                                             df['cot'], df['value'], df['quality']):
+        element = ELEMENTS.get(int(typeid), None)
+        if element is None or value != value: # Unsupported type or no value (NaN)
+            continue
+        key = (float(ts), int(typeid), int(cot), int(ca))
+        if rtu in current and (current[rtu][:4] != key or len(current[rtu][4]) == 127):
+            pack(rtu)
+        if rtu not in current:
+            current[rtu] = key + ([],)
+        current[rtu][4].append(struct.pack('<I', int(ioa))[:3] + element(value, int(quality), float(ts)))
+    for rtu in list(current.keys()):
+        pack(rtu)
+    return asdus
+
+def load_asdus(path: str, port: int=IEC104_PORT) -> dict:
+    return load_recording(path) if os.path.isdir(path) else load_capture(path, port)
+
+class ReplaySession(object):
+    '''
+    Replay of the ASDUs of one RTU over a single connection.
+    '''
+
+    def __init__(self, asdus: list, speed: float, repeat: bool, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.asdus = asdus
+        self.speed = speed
+        self.repeat = repeat
+        self.tx = 0
+        self.rx = 0
+        self.sent = 0
+        self._reader = reader
+        self._writer = writer
+        self._unacked = 0
+        self._started = asyncio.Event()
+        self._last = {}     # (TypeId, first IOA) -> Last ASDU sent, used to answer interrogations
+
+    def _send_u(self, utype: int):
+        self._writer.write(struct.pack('<BBBBBB', 0x68, 4, (utype << 2) | 0x03, 0, 0, 0))
+
+    def _send_i(self, asdu: bytes):
+        self._writer.write(struct.pack('<BBHH', 0x68, len(asdu) + 4, self.tx << 1, self.rx << 1) + asdu)
+        self.tx = (self.tx + 1) & 0x7fff
+        self._unacked = 0
+
+    def _confirm(self, asdu: bytes, cot: int, negative: bool=False) -> bytes:
+        return asdu[:2] + bytes([(asdu[2] & 0x80) | (0x40 if negative else 0) | cot]) + asdu[3:]
+
+    def _handle_asdu(self, asdu: bytes):
+        typeid = asdu[0]
+        if typeid == 100: # General interrogation: last ASDU of every type and object
+            self._send_i(self._confirm(asdu, 7))
+            for last in self._last.values():
+                self._send_i(self._confirm(last, 20))
+            self._send_i(self._confirm(asdu, 10))
+        else: # Commands are not executed by a replay
+            self._send_i(self._confirm(asdu, 7, negative=True))
+
+    async def _receive_loop(self):
+        while True:
+            header = await self._reader.readexactly(2)
+            data = await self._reader.readexactly(header[1])
+            if header[0] != 0x68 or len(data) < 4:
+                raise ConnectionError('Malformed APDU')
+            if data[0] & 0x03 == 0x03: # U-frame
+                utype = data[0] >> 2
+                if utype == STARTDT:
+                    self._started.set()
+                elif utype == STOPDT:
+                    self._started.clear()
+                if utype in [STARTDT, STOPDT, TESTFR]:
+                    self._send_u(utype << 1)
+            elif data[0] & 0x01 == 0: # I-frame
+                self.rx = ((struct.unpack_from('<H', data, 0)[0] >> 1) + 1) & 0x7fff
+                self._unacked += 1
+                if len(data) > 4:
+                    self._handle_asdu(data[4:])
+                if self._unacked >= IEC104_W:
+                    self._writer.write(struct.pack('<BBBBH', 0x68, 4, 0x01, 0, self.rx << 1))
+                    self._unacked = 0
+
+    async def _replay(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._started.wait()
+            start = loop.time()
+            first = self.asdus[0][0] if len(self.asdus) > 0 else 0.0
+            for i, (ts, asdu) in enumerate(self.asdus):
+                if not self._started.is_set():
+                    await self._started.wait()
+                if self.speed is not None:
+                    delay = start + (ts - first) / self.speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                self._send_i(asdu)
+                self._last[(asdu[0], asdu[6:9])] = asdu
+                self.sent += 1
+                if self.speed is None and i % DRAIN_FRAMES == DRAIN_FRAMES - 1:
+                    await self._writer.drain()
+            await self._writer.drain()
+            if not self.repeat:
+                break
+
+    async def run(self):
+        receive = asyncio.ensure_future(self._receive_loop())
+        replay = asyncio.ensure_future(self._replay())
+        try:
+            # Keep answering the client after the replay ends, until it disconnects
+            await asyncio.wait([receive, replay], return_when=asyncio.FIRST_EXCEPTION)
+            await receive
+        except (asyncio.IncompleteReadError, ConnectionError, OSError):
+            pass
+        finally:
+            replay.cancel()
+            receive.cancel()
+            self._writer.close()
+
+class ReplayServer(object):
+    '''
+    Serve the ASDUs of several RTUs, each one on its own address.
+
+    speed is the time scale of the replay (1 for the original timing),
+    or None to send the frames as fast as possible.
+    '''
+
+    def __init__(self, asdus: dict, speed: float=1.0, repeat: bool=False, host: str='127.0.0.1', port: int=IEC104_PORT):
+        assert speed is None or speed > 0, 'The replay speed must be positive'
+        self.asdus = asdus
+        self.speed = speed
+        self.repeat = repeat
+        base = ipaddress.ip_address(host)
+        self.addresses = {rtu: str(base + i) for i, rtu in enumerate(sorted(asdus.keys()))}
+        self.port = port
+        self.endpoints = {}     # RTU address -> (address, port) being served
+        self.sessions = []
+        self._servers = []
+
+    async def start(self):
+        for rtu, address in self.addresses.items():
+            def connected(reader, writer, rtu=rtu):
+                session = ReplaySession(self.asdus[rtu], self.speed, self.repeat, reader, writer)
+                self.sessions.append(session)
+                return session.run()
+            server = await asyncio.start_server(connected, address, self.port, reuse_address=True)
+            self.endpoints[rtu] = server.sockets[0].getsockname()[:2]
+            self._servers.append(server)
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+
+    async def serve_forever(self):
+        await self.start()
+        await asyncio.gather(*[server.serve_forever() for server in self._servers])
+
+def positive(value: str) -> float:
+    speed = float(value)
+    if not speed > 0:
+        raise argparse.ArgumentTypeError(f'{value:s} is not a positive time scale')
+    return speed
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay captured IEC 60870-5-104 sessions')
+    parser.add_argument('path', type=str, help='pcap or pcapng capture, or directory with recorded segments')
+    timing = parser.add_mutually_exclusive_group()
+    timing.add_argument('-s', '--speed', type=positive, default=1.0, help='Time scale (default: original timing)')
+    timing.add_argument('--max', action='store_true', help='Send the frames as fast as possible')
+    parser.add_argument('-r', '--repeat', action='store_true', help='Restart the replay when it ends')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address of the first RTU')
+    parser.add_argument('-p', '--port', type=int, default=IEC104_PORT, help='IEC 60870-5-104 TCP port')
+    args = parser.parse_args()
+    replay = ReplayServer(load_asdus(args.path, args.port), None if args.max else args.speed, args.repeat, args.host, args.port)
+    for rtu, address in replay.addresses.items():
+        sys.stdout.write(f'{rtu:s} ({len(replay.asdus[rtu]):d} ASDUs) -> {address:s}:{args.port:d}\n')
+    try:
+        asyncio.run(replay.serve_forever())
+    except KeyboardInterrupt:
+        pass
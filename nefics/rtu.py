@@ -2,14 +2,16 @@
 
 import socket
 import errno
+import struct
 from Crypto.Random.random import randint
 from threading import Thread
-from datetime import datetime
 from time import sleep
 from binascii import hexlify
-from IEC104.dissector import APDU
-from IEC104.const import *
-from helper104 import *
+from nefics.IEC104.const import *
+from nefics.helper104 import *
+from nefics.IEC104.fast import APDU
+from nefics.logger import LOG_PRIO, LEVELS, FORMATS, Frame, configure, release
+from nefics.pointtable import PointTable, BASE_IOA, BREAKER_BASE_IOA, breaker_points
 
 RTU_TYPES = [           # Supported RTU types
     'SOURCE',
@@ -24,11 +26,11 @@ RTU_LOAD = 2            # RTU_TYPES index for a "LOAD" RTU
 RTU_TIMEOUT = 15        # 15-second "T1", as specified in Section 9.6 of 60870-5-104 IEC:2006
 SOCK_TIMEOUT = 0.25     # Socket timeout for incoming TCP connections, prevents a blocking listen() in the main thread
 
-RTU_BASE_IOA = 1001     # Arbitrary value indicating the lowest IOA used by the simulation to store measurement values
-RTU_BREAKER_BASE = 101  # Arbitrary value indicating the lowest IOA used by the simulation to store breaker status
-RTU_NUM_BREAKERS = 3    # Arbitrary value indicating the amount of breakers managed by a Transmission RTU
+RTU_BASE_IOA = BASE_IOA                 # Lowest IOA used by the simulation to store measurement values
+RTU_BREAKER_BASE = BREAKER_BASE_IOA     # Lowest IOA used by the simulation to store breaker status
+RTU_NUM_BREAKERS = 3                    # Arbitrary value indicating the amount of breakers managed by a Transmission RTU
 
-BREAKERS = dict([(RTU_BREAKER_BASE + i, 2 ** i) for i in range(RTU_NUM_BREAKERS)]) # Breaker status values for a "TRANSMISSION" RTU. The status is handled as a bitfield, one bit per breaker.
+BREAKERS = PointTable.from_config(breaker_points(RTU_NUM_BREAKERS)) # Breakers of a "TRANSMISSION" RTU. The status is handled as a bitfield, one bit (point index) per breaker.
 
 IEC104_PORT = 2404      # Standard TCP port used for IEC 60870-5-104
 BUFFER_SIZE = 8192      # Receiving buffer size. At most 128 64-byte IOA in a single APDU
@@ -55,9 +57,10 @@ class RTU:
         self.__confok = False
         self.__socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
         self.__socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.__socket.bind(('0.0.0.0', IEC104_PORT))
-        self.__log = open(f'logs/rtu{self.__guid:d}.txt', 'w')
-        self.__log.write(f'Instantiated a new {RTU_TYPES[self.__type]:s} RTU.\r\n')
+        self.__socket.bind((kwargs.get('address', '0.0.0.0'), kwargs.get('port', IEC104_PORT)))
+        fmt = kwargs.get('log_format', 'text')    # Log format (nefics.logger.FORMATS)
+        self.__logger = configure(f'rtu.{self.__guid:d}', f'logs/rtu{self.__guid:d}.{FORMATS[fmt]:s}', fmt, LOG_PRIO[kwargs.get('log_level', 'INFO')])
+        self.log('Instantiated a new %s RTU.', RTU_TYPES[self.__type])
 
     @property
     def guid(self) -> int:
@@ -101,12 +104,10 @@ class RTU:
     def rx(self, value: int):
         self.__rx = value
     
-    def log(self, msg:str):
-        self.__log.write(datetime.now().isoformat() + ' :: ')
-        self.__log.write(msg)
-        if msg[-2:] != '\r\n':
-            self.__log.write('\r\n')
-        self.__log.flush()
+    def log(self, msg:str, *args, prio:int=LOG_PRIO['INFO']):
+        'Log a message (with %-style args, formatted by the log writer thread) if prio is enabled'
+        if self.__logger.isEnabledFor(LEVELS[prio]):
+            self.__logger.log(LEVELS[prio], msg, *args)
     
     def __measure(self, wsock:socket.socket, connid:int):
         'Override this method with the appripriate measurement procedure for the specific RTU'
@@ -122,15 +123,18 @@ class RTU:
         msr = None
         self.__startdt[connid] = False
         wsock.settimeout(RTU_TIMEOUT)
-        self.log(f'Initiating state handler with ID {connid:d}')
+        self.log('Initiating state handler with ID %d', connid)
         while not self.terminate:
             try:
-                data = wsock.recv(BUFFER_SIZE)
-                data = APDU(data)
+                raw = wsock.recv(BUFFER_SIZE)
+                if not raw:
+                    self.log('Connection closed by the peer')
+                    break
+                data = APDU(raw)
                 atype = data['APCI'].Type
                 if msr is None: # STOPPED connection as shown in figure 17 from 60870-5-104 IEC:2006
                     if atype in [0x00, 0x01]: # I-frame (0x00) or S-frame (0x01)
-                        self.log(f'Received an unexpected frame ({TYPE_APCI[atype]:s}) in "STOPPED connection" state. Terminating thread ...')
+                        self.log('Received an unexpected frame (%s) in "STOPPED connection" state. Terminating thread ...', TYPE_APCI[atype], prio=LOG_PRIO['WARNING'])
                         self.__terminate = True
                     elif atype == 0x03: # U-frame (0x03)
                         ut = data['APCI'].UType
@@ -168,25 +172,25 @@ class RTU:
                             data = testfr(True) # TESTFR actcon
                         wsock.send(data)
                     elif atype == 0x01: # S-frame (0x01)
-                        self.log('Received an S-frame')
+                        self.log('Received an S-frame', prio=LOG_PRIO['DEBUG'])
                         self.__tx = data['APCI'].Rx
                     else: # I-frame (0x00)
-                        self.log('Received an I-frame. Initiating handler ...')
+                        self.log('Received an I-frame: %s. Initiating handler ...', Frame(raw), prio=LOG_PRIO['DEBUG'])
                         self.__handle_iframe(wsock, data)
                 # NOTE: In this particular simulation, we are not considering the 'Pending UNCONFIRMED STOPPED connection' state, as our responses are faster
             except socket.timeout:
-                self.log('ERROR: T1 timeout')
+                self.log('T1 timeout', prio=LOG_PRIO['ERROR'])
                 self.__terminate = True # RTU T1 timeout => terminate connection
             except BrokenPipeError:
-                self.log('ERROR: Connection ended unexpectedly')
+                self.log('Connection ended unexpectedly', prio=LOG_PRIO['ERROR'])
                 self.__terminate = True # Connection ended unexpectedly.
             except socket.error as e:
                 if e.errno != errno.ECONNRESET:
-                    self.log(f'ERROR: Unknown socket error: {e.errno:d}')
+                    self.log('Unknown socket error: %d', e.errno, prio=LOG_PRIO['ERROR'])
                     raise # Other unknown error
                 self.__terminate = True
-            except IndexError:
-                self.log('ERROR: Index error')
+            except (IndexError, struct.error):
+                self.log('Malformed frame', prio=LOG_PRIO['ERROR'])
         if msr is not None: # The connection was still measuring
             self.__startdt[connid] = False # Change measurement state
             msr.join() # Stop measuring
@@ -196,29 +200,29 @@ class RTU:
 
     def loop(self):
         'This method handles the raw TCP listening socket, accepting new incoming connections.'
-        self.log(f'Listening for incoming connections ...')
+        self.log('Listening for incoming connections ...')
         self.sock.settimeout(SOCK_TIMEOUT)
         self.sock.listen()
         threads = []
         while not self.terminate:
             try:
                 wsock, addr = self.sock.accept() # Accept a new connection
-                self.log(f'Incoming connection from {str(addr):s}')
+                self.log('Incoming connection from %s', str(addr))
                 if not self.__confok or len(threads) == 0:
                     wsock.settimeout(SOCK_TIMEOUT)
-                    self.log(f'Creating state transition handler for {str(addr):s}')
+                    self.log('Creating state transition handler for %s', str(addr))
                     t = Thread(target=self.__subloop, kwargs={'wsock': wsock}) # Create a state transition handler
                     threads.append(t) # Keep track of all the incoming connections
                     t.start() # Start the state transition handler for this new connection
                 else:
-                    self.log(f'Connection from {str(addr):s} rejected. only one connection allowed.')
+                    self.log('Connection from %s rejected. only one connection allowed.', str(addr), prio=LOG_PRIO['WARNING'])
                     wsock.close()
             except socket.timeout:
                 pass
         for t in threads:
             t.join()
         self.sock.close()
-        self.__log.close()
+        release(self.__logger)
     
     def __str__(self):
         return 'RTU\r\n------------------\r\nID: {0:11d}\r\nType: {1:12s}'.format(self.__guid, RTU_TYPES[self.__type])
@@ -249,12 +253,12 @@ class Source(RTU):
         return 'Source RTU ({0:d}, {1:.2f})'.format(self.guid, self.__voltage)
 
     def _RTU__measure(self, connid: int, wsock: socket.socket):
-        self.log(f'Measurement thread started')
+        self.log('Measurement thread started')
         while self._RTU__startdt[connid]:
             if all(x is not None for x in [self.tx, self.rx]):
                 # ASDU Type 36: M_ME_TF_1
                 data = build_104_asdu_packet(36, self.guid, RTU_BASE_IOA, self.tx, self.rx, 3, value=self.__voltage)
-                self.log(f'Sending measured data: {repr(APDU(data))}')
+                self.log('Sending measured data: %s', Frame(data), prio=LOG_PRIO['DEBUG'])
                 self.tx += 1
                 if self.tx == 65536:
                     self.tx = 0
@@ -276,7 +280,7 @@ class Source(RTU):
         self.tx += 1
         data['APCI'].Rx = self.rx
         data['ASDU'].CauseTx = 45       # Cause of transmission: Unknown cause of transmission. A source RTU should not receive any commands.
-        wsock.send(data)
+        wsock.send(data.build())
     
     def loop(self):
         super().loop()
@@ -388,53 +392,52 @@ class Transmission(RTU):
 
     def _RTU__handle_iframe(self, wsock, apdu):
         try:
-            self.log(f'Handling {repr(apdu)} ...')
             asdu = apdu['ASDU']
             if asdu.TypeId == 45: # C_SC_NA_1 defined in section 7.3.2.1 of 60870-5-101 IEC:2003
-                self.log(f'Identified an type 45 ASDU (C_SC_NA_1) SELECT={asdu["IOA45"].SCO.SE} CTX={asdu.CauseTx}.')
+                self.log('Identified an type 45 ASDU (C_SC_NA_1) SELECT=%d CTX=%d.', asdu['IOA45'].SCO.SE, asdu.CauseTx, prio=LOG_PRIO['DEBUG'])
                 self.__increment_counters(apdu['APCI'].Rx + 1, apdu['APCI'].Tx + 1)
                 if self.__wait_exec is None and asdu['IOA45'].SCO.SE == 1 and asdu.CauseTx == 6: # SCO: Select; Cause of transmission: Activation
-                    self.log(f'Received a new C_SC_NA_1 (ASDU type 45) SELECT - Activation. Checking IOA ID ...')
-                    if asdu['IOA45'].IOA in BREAKERS.keys():
-                        self.log(f'Received an appropriate new C_SC_NA_1 (ASDU type 45) SELECT - Activation')
+                    self.log('Received a new C_SC_NA_1 (ASDU type 45) SELECT - Activation. Checking IOA ID ...', prio=LOG_PRIO['DEBUG'])
+                    if asdu['IOA45'].IOA in BREAKERS:
+                        self.log('Received an appropriate new C_SC_NA_1 (ASDU type 45) SELECT - Activation')
                         self.__wait_exec = asdu['IOA45'].IOA
                         data = build_104_asdu_packet(45, self.guid, asdu['IOA45'].IOA, self.tx, self.rx, 7, SE=asdu['IOA45'].SCO.SE, QU=asdu['IOA45'].SCO.QU, SCS=asdu['IOA45'].SCO.SCS) # SCO: Select; Cause of transmission: Activation Confirmation
                     else:
-                        self.log(f'''WARNING: Received a new C_SC_NA_1 (ASDU type 45) SELECT - Activation with an unknown IOA: {asdu['IOA45'].IOA}''')
+                        self.log('Received a new C_SC_NA_1 (ASDU type 45) SELECT - Activation with an unknown IOA: %d', asdu['IOA45'].IOA, prio=LOG_PRIO['WARNING'])
                         data = build_104_asdu_packet(45, self.guid, asdu['IOA45'].IOA, self.tx, self.rx, 47, SE=asdu['IOA45'].SCO.SE, QU=asdu['IOA45'].SCO.QU, SCS=asdu['IOA45'].SCO.SCS) # SCO: Select; Cause of transmission: Unknown information object address
                 elif self.__wait_exec is not None and asdu['IOA45'].SCO.SE == 0x00 and asdu.CauseTx == 6: # SCO: Execute; Cause of transmission: Activation
                     if self.__wait_exec == asdu['IOA45'].IOA:
-                        self.log(f'''Received a new C_SC_NA_1 (ASDU type 45) EXECUTE - Activation''')
+                        self.log('Received a new C_SC_NA_1 (ASDU type 45) EXECUTE - Activation')
                         data = build_104_asdu_packet(45, self.guid, asdu['IOA45'].IOA, self.tx, self.rx, 7, SE=asdu['IOA45'].SCO.SE, QU=asdu['IOA45'].SCO.QU, SCS=asdu['IOA45'].SCO.SCS) # SCO: Execute; Cause of transmission: Activation Confirmation
                         if bool(asdu['IOA45'].SCO.SCS):
-                            self.__state = self.__state | BREAKERS[self.__wait_exec] # STATE OR IOA
+                            self.__state = self.__state | (2 ** BREAKERS[self.__wait_exec].index) # STATE OR IOA
                         else: 
-                            self.__state = self.__state & (BREAKERS[self.__wait_exec] ^ ((2 ** RTU_NUM_BREAKERS) - 1)) # STATE AND (IOA XOR 1...11)
+                            self.__state = self.__state & ((2 ** BREAKERS[self.__wait_exec].index) ^ ((2 ** RTU_NUM_BREAKERS) - 1)) # STATE AND (IOA XOR 1...11)
                     else:
-                        self.log(f'''WARNING: Received a new C_SC_NA_1 (ASDU type 45) EXECUTE - Activation for an unexpected IOA: {asdu['IOA45'].IOA}''')
+                        self.log('Received a new C_SC_NA_1 (ASDU type 45) EXECUTE - Activation for an unexpected IOA: %d', asdu['IOA45'].IOA, prio=LOG_PRIO['WARNING'])
                         data = build_104_asdu_packet(45, self.guid, asdu['IOA45'].IOA, self.tx, self.rx, 47, SE=asdu['IOA45'].SCO.SE, QU=asdu['IOA45'].SCO.QU, SCS=asdu['IOA45'].SCO.SCS) # SCO: Execute; Cause of transmission: Unknown information object address
                 elif self.__wait_exec is not None and asdu['IOA45'].SCO.SE == 1 and asdu.CauseTx == 8: # SCO: Select; Cause of transmission: Deactivation
-                    self.log(f'''Received a new C_SC_NA_1 (ASDU type 45) SELECT - Deactivation''')
+                    self.log('Received a new C_SC_NA_1 (ASDU type 45) SELECT - Deactivation')
                     data = build_104_asdu_packet(45, self.guid, asdu['IOA45'].IOA, self.tx, self.rx, 9, SE=asdu['IOA45'].SCO.SE, QU=asdu['IOA45'].SCO.QU, SCS=asdu['IOA45'].SCO.SCS) # SCO: Select; Cause of transmission: Deactivation Confirmation
                     self.__wait_exec = None
                 else:
-                    self.log(f'''WARNING: Received an unexpected C_SC_NA_1 (ASDU type 45) EXECUTE''')
+                    self.log('Received an unexpected C_SC_NA_1 (ASDU type 45) EXECUTE', prio=LOG_PRIO['WARNING'])
                     data = apdu
                     data['APCI'].Rx = self.rx
                     data['APCI'].Tx = self.tx
                     data['ASDU'].CauseTx = 45 # Cause of transmission: Unknown cause of transmission
                     data = data.build()
             else:
-                self.log(f'''WARNING: Received an unexpected ASDU (type {asdu.TypeId}''')
+                self.log('Received an unexpected ASDU (type %d)', asdu.TypeId, prio=LOG_PRIO['WARNING'])
                 data = apdu
                 data['APCI'].Rx = self.rx
                 data['APCI'].Tx = self.tx
                 data['ASDU'].CauseTx = 45 # Cause of transmission: Unknown cause of transmission
                 data = data.build()
-            self.log(f'Sending I-frame response: {repr(APDU(data))}')
+            self.log('Sending I-frame response: %s', Frame(data), prio=LOG_PRIO['DEBUG'])
             wsock.send(data)
         except socket.timeout:
-            self.log('T1 timeout')
+            self.log('T1 timeout', prio=LOG_PRIO['ERROR'])
             self.terminate =  True
         except BrokenPipeError:
             pass
@@ -442,28 +445,28 @@ class Transmission(RTU):
             if e.errno != errno.ECONNRESET:
                 raise
         except IndexError as e:
-            self.log(f'IndexError: {str(e)}')
+            self.log('IndexError: %s', str(e), prio=LOG_PRIO['ERROR'])
     
     def _RTU__measure(self, wsock: socket.socket, connid:int):
         while self._RTU__startdt[connid]:
             if all(x is not None for x in [self.tx, self.rx]):
                 try:
-                    self.log(f'Sending measured input voltage ...')
+                    self.log('Sending measured input voltage ...', prio=LOG_PRIO['DEBUG'])
                     data = build_104_asdu_packet(36, self.guid, RTU_BASE_IOA, self.tx, self.rx, 3, value=self.__vin)
                     self.tx += 1
                     if self.tx == 65536:
                         self.tx = 0
                     wsock.send(data)
-                    self.log(f'Sending measured current ...')
+                    self.log('Sending measured current ...', prio=LOG_PRIO['DEBUG'])
                     data = build_104_asdu_packet(36, self.guid, RTU_BASE_IOA + 1, self.tx, self.rx, 3, value=self.__amp)
                     self.tx += 1
                     if self.tx == 65536:
                         self.tx = 0
                     wsock.send(data)
-                    self.log(f'Sending breaker states ... ')
-                    for i in range(len(self.__loads)):
-                        data = build_104_asdu_packet(3, self.guid, RTU_BREAKER_BASE + i, self.tx, self.rx, 3, value=int(0x01 if ((self.__state & BREAKERS[RTU_BREAKER_BASE + i]) > 0) else 0x02))
-                        self.log(f'Sending breaker {RTU_BREAKER_BASE + i}: {repr(APDU(data))}')
+                    self.log('Sending breaker states ... ', prio=LOG_PRIO['DEBUG'])
+                    for breaker in BREAKERS:
+                        data = build_104_asdu_packet(3, self.guid, breaker.ioa, self.tx, self.rx, 3, value=int(0x01 if ((self.__state & (2 ** breaker.index)) > 0) else 0x02))
+                        self.log('Sending breaker %d: %s', breaker.ioa, Frame(data), prio=LOG_PRIO['DEBUG'])
                         self.tx += 1
                         if self.tx == 65536:
                             self.tx = 0
@@ -475,7 +478,7 @@ class Transmission(RTU):
                         raise
                     break
                 except Exception as e:
-                    self.log(str(e))
+                    self.log('%s', str(e), prio=LOG_PRIO['ERROR'])
             sleep(1)
     
 class Load(RTU):
@@ -524,13 +527,13 @@ class Load(RTU):
             if all(x is not None for x in [self.tx, self.rx]):
                 try:
                     data = build_104_asdu_packet(36, self.guid, RTU_BASE_IOA, self.tx, self.rx, 3, value=self.__vin)
-                    self.log(f'Sending measured voltage ... {repr(APDU(data))}')
+                    self.log('Sending measured voltage ... %s', Frame(data), prio=LOG_PRIO['DEBUG'])
                     self.tx += 1
                     if self.tx == 65536:
                         self.tx = 0
                     wsock.send(data)
                     data = build_104_asdu_packet(36, self.guid, RTU_BASE_IOA + 1, self.tx, self.rx, 3, value=self.__amp)
-                    self.log(f'Sending measured current ... {repr(APDU(data))}')
+                    self.log('Sending measured current ... %s', Frame(data), prio=LOG_PRIO['DEBUG'])
                     self.tx += 1
                     if self.tx == 65536:
                         self.tx = 0
@@ -551,4 +554,4 @@ class Load(RTU):
         self.tx += 1
         data['APCI'].Rx = self.rx
         data['ASDU'].CauseTx = 45
-        wsock.send(data)
+        wsock.send(data.build())
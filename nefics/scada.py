@@ -1,190 +1,136 @@
 #!/usr/bin/env python3
 
 import re
-import socket
+import asyncio
+import concurrent.futures
 from prompt_toolkit.shortcuts import run_application as runprompt
 from PyInquirer.prompts.list import question as listq
 from threading import Thread
 from cmd import Cmd
-from time import sleep
-from helper104 import *
-from IEC104.dissector import APDU, APCI
+from nefics.master import Master
+from nefics.logger import LOG_PRIO, FORMATS, configure
+from nefics.pointtable import PointTable, measurement_points, breaker_points
 
-BUFFER_SIZE = 512
-IEC104_PORT = 2404
 IPv4_REGEX = re.compile(r'^(?:(?:2(?:5[0-5]|[0-4]\d)|1\d\d|[1-9]?\d)\.){3}(?:2(?:5[0-5]|[0-4]\d)|1\d\d|[1-9]?\d)(?:\/\d\d)?$', re.DOTALL | re.MULTILINE)
 
-IOAS = {
-    1001: ['Voltage', 'V'],
-    1002: ['Current', 'A'],
-    101: ['Breaker', 'Open/Close'],
-    102: ['Breaker', 'Open/Close'],
-    103: ['Breaker', 'Open/Close'],
-}
+IOAS = PointTable.from_config(measurement_points() + breaker_points(3))
+
+CALL_TIMEOUT = 60   # Seconds to wait for the master event loop (its requests are bounded by the IEC 104 timeouts)
 
 class SCADACLI(Cmd):
+    '''
+    Interactive client of the IEC 60870-5-104 master.
+
+    The master runs in an asyncio event loop within a background thread,
+    and every command is submitted to that loop.
+    '''
 
     def __init__(self):
         super(SCADACLI, self).__init__()
         self.prompt = 'SCADA>'
-        self.__rtu_comms = {}
-        self.__threads = {}
-        self.__keepalive = {}
-        self.__keepalive_kill = {}
-        self.__killsignals = {}
-        self.__rtu_data = {}
-        self.__rtu_u_state = {}
-        self.__rtu_i_state = {}
-        self.__rtu_asdu = {}
-        self.__done  = False
+        self.__master = Master()
+        self.__loop = asyncio.new_event_loop()
+        self.__thread = Thread(target=self.__loop.run_forever, daemon=True)
+        self.__thread.start()
+        self.__recorder = None
     
     def emptyline(self):
         pass
 
-    def __keepalive_handler(self, s: socket.socket, k:str):
-        while not self.__done and not self.__keepalive_kill[k]:
-            sleep(10) # Send a keepalive every 10 seconds
-            self.__rtu_u_state[k] = 0x20 # Expect a TESTFR con
-            pkt = APDU()/APCI(ApduLen=4, Type=0x03, UType=0x10) # 'TESTFR act' as a keepalive
-            self.__rtu_comms[k].send(pkt.build())
-            while self.__rtu_u_state[k] is not None and self.__rtu_u_state[k] > 0:
-                sleep(0.33)
+    def __call(self, coro):
+        'Run a coroutine in the master event loop and wait for its result'
+        future = asyncio.run_coroutine_threadsafe(coro, self.__loop)
+        try:
+            return future.result(CALL_TIMEOUT)
+        except concurrent.futures.TimeoutError:
+            # Not the builtin TimeoutError before Python 3.11
+            future.cancel()
+            raise ConnectionError(f'The master did not answer within {CALL_TIMEOUT:d} seconds')
 
-    def __handle_rtu(self, s: socket.socket, k: str):
-        if k not in self.__rtu_data.keys():
-            self.__rtu_data[k] = {'ioas': {}}
-        while not self.__done and not self.__killsignals[k]:
-            try:
-                data = s.recv(BUFFER_SIZE)
-                data = APDU(data)
-                if data['APCI'].Type == 0x03: # U-frame
-                    if data['APCI'].UType in [1, 4, 16]: # All the 'act' variants => Shouldn't happen. Do nothing
-                        pass
-                    elif data['APCI'].UType == self.__rtu_u_state[k]: # Correct expected U-frame response
-                        self.__rtu_u_state[k] = 0
-                    else: # Unexpected U-frame response => Shouldn't happen. Alert user.
-                        print(f'**** WARNING: Received an unexpected U-frame from {str(self.__rtu_comms[k].getpeername()):s} ****')
-                        self.__rtu_u_state[k] = None
-                elif data['APCI'].Type == 0x01: # S-frame => Shouldn't happen. Alert user.
-                    print(f'**** WARNING: Received an S-frame from {str(self.__rtu_comms[k].getpeername()):s} ****')
-                elif data['APCI'].Type == 0x00: # I-frame
-                    asdu = data['ASDU']
-                    data = extract_104_value(data)
-                    self.__rtu_data[k]['tx'] = data['rx']
-                    self.__rtu_data[k]['rx'] = data['tx']
-                    if asdu.TypeId in [3, 36]: # Measurement value
-                        value = data['value']
-                        if isinstance(value, str):
-                            if value == 'determined state OFF':
-                                value = 0
-                            else:
-                                value = 1
-                        self.__rtu_data[k]['ioas'][data['ioa']] = value
-                    elif asdu.TypeId == 45: # Single command
-                        print(f'''Received: {((asdu.CauseTx << 8) | (asdu['IOA45'].SCO.SE << 7) | asdu['IOA45'].SCO.SCS):04x} Expected: {self.__rtu_i_state[k]:04x}''')
-                        if self.__rtu_i_state[k] is not None and self.__rtu_i_state[k] == ((asdu.CauseTx << 8) | (asdu['IOA45'].SCO.SE << 7) | asdu['IOA45'].SCO.SCS): # Expected single command response
-                            self.__rtu_i_state[k] = 0x0000
-                        else: # Unexpected single command response => Alert user.
-                            self.__rtu_i_state[k] = None
-                            print(f'**** WARNING: Received an unexpected I-frame from {str(self.__rtu_comms[k].getpeername()):s} ****')
-                    else: # Received an I-frame that has not been implemented => Alert user.
-                        print(f'**** WARNING: Received an unknown I-frame from {str(self.__rtu_comms[k].getpeername()):s} ****')
-                else: # Received a malformed packet => Alert user.
-                    print(f'**** WARNING: Received a malformed packet from {str(self.__rtu_comms[k].getpeername()):s} ****')
-            except (socket.timeout, KeyError, IndexError):
-                self.__rtu_i_state[k] = None
-                self.__rtu_u_state[k] = None
-            except ConnectionResetError:
-                self.__rtu_i_state[k] = None
-                self.__rtu_u_state[k] = None
+    def onecmd(self, line: str) -> bool:
+        try:
+            return super(SCADACLI, self).onecmd(line)
+        except ConnectionError as ex:
+            print(f'Error: {ex}')
+            return False
+
+    @property
+    def rtus(self) -> list:
+        return [k for k, s in self.__master.sessions.items() if not s.closed]
+
+    def send_commands(self, commands: list) -> dict:
+        '''
+        Send single commands (select before operate) to several RTUs.
+
+        Each command is a (RTU address, IOA, SCS) tuple. All the commands
+        are sent concurrently. Returns a dictionary mapping each (RTU
+        address, IOA) to whether the command was executed.
+        '''
+        return self.__call(self.__master.commands(commands))
+
+    def connect(self, address: str, asdu: int) -> bool:
+        '''
+        Connect to an RTU and start the data transfer.
+
+        Returns whether the STARTDT was confirmed.
+        '''
+        try:
+            self.__call(self.__master.connect(address, asdu))
+        except ConnectionError:
+            return False
+        if not self.__call(self.__master.startdt(address)):
+            self.__call(self.__master.disconnect(address))
+            return False
+        return True
+
+    def disconnect(self, address: str) -> bool:
+        '''
+        Stop the data transfer and close the connection with an RTU.
+
+        Returns whether the STOPDT was confirmed.
+        '''
+        return self.__call(self.__master.disconnect(address))
 
     def do_connect(self, arg: str):
         'Connect to a new RTU'
         try:
-            arg = arg.split(';')
-            self.__rtu_asdu[arg[0]] = arg[1]
-            arg = arg[0]
-            assert IPv4_REGEX.match(arg) is not None
-            if '/' in arg:
-                prefix = int(arg.split('/')[1])
+            address, asdu = arg.split(';')
+            assert IPv4_REGEX.match(address) is not None
+            if '/' in address:
+                prefix = int(address.split('/')[1])
                 assert prefix > 0 and prefix <= 32
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-            s.settimeout(2)
-            s.connect((arg, IEC104_PORT))
-            self.__rtu_comms[arg] = s
-            self.__killsignals[arg] = False
-            self.__rtu_u_state[arg] = 0x02 # Expect a STARTDT con U-frame
-            self.__rtu_i_state[arg] = None # Don't expect any I-frames
-            t = Thread(target=self.__handle_rtu, kwargs={'s': s, 'k': arg}) # Create a receiving thread for this RTU.
-            t.start()
-            self.__threads[arg] = t
-            pkt = APDU()/APCI(ApduLen=4, Type=0x03, UType=0x01) # STARTDT act
-            s.send(pkt.build())
-            while self.__rtu_u_state[arg] is not None and self.__rtu_u_state[arg] > 0:
-                print(f'\rInitiating connection with peer {arg:s} ... ', end='')
-                sleep(0.33)
-            print('')
-            if self.__rtu_u_state[arg] is None:
-                print(f'Unable to connect to {arg:s}')
-                self.__killsignals[arg] = True
-                t = self.__threads.pop(arg)
-                t.join()
-                s.close()
-                self.__rtu_asdu.pop(arg)
-                self.__rtu_comms.pop(arg)
-                self.__killsignals.pop(arg)
-                self.__rtu_i_state.pop(arg)
-                self.__rtu_u_state.pop(arg)
-                if arg in self.__rtu_data.keys():
-                    self.__rtu_data.pop(arg)
-            else:
-                self.__keepalive_kill[arg] = False
-                t = Thread(target=self.__keepalive_handler, kwargs={'s': s, 'k': arg}) # Create a keepalive thread for this RTU.
-                t.start()
-                self.__keepalive[arg] = t
-        except AssertionError:
-            print('Invalid IPv4 address: %s' % arg)
-        except socket.timeout:
-            print('Unable to connect to %s' % arg)
+            asdu = int(asdu)
+            assert asdu > 0 and asdu < 0xFFFF # Common address (0 and 0xFFFF are not station addresses)
+        except (AssertionError, ValueError):
+            print('Invalid command. Usage: connect <IPv4 address>;<ASDU common address>')
+            return False
+        print(f'Initiating connection with peer {address:s} ... ')
+        if not self.connect(address, asdu):
+            print(f'Unable to connect to {address:s}')
         return False
     
     def do_disconnect(self, arg:str):
         'Disconnect from an RTU'
-        if len(self.__rtu_comms) > 0:
-            rtuaddr = runprompt(listq(message='Disconnect from which RTU?', choices=self.__rtu_comms.keys()))
-            self.__keepalive_kill[rtuaddr] = True # Stop keepalive
-            t = self.__keepalive[rtuaddr]
-            t.join()
-            self.__rtu_u_state[rtuaddr] = 0x08 # Expect STOPDT con
-            pkt = APDU()/APCI(ApduLen=4, Type=0x03, UType=0x04) # STOPDT act
-            self.__rtu_comms[rtuaddr].send(pkt.build())
-            while self.__rtu_u_state[rtuaddr] is not None and self.__rtu_u_state[rtuaddr] > 0:
-                print(f'\rTerminating connection with {rtuaddr:s} ... ', end='')
-                sleep(0.33)
-            print('')
-            self.__killsignals[rtuaddr] = True
-            t = self.__threads.pop(rtuaddr)
-            t.join()
-            s = self.__rtu_comms.pop(rtuaddr)
-            d = self.__rtu_data.pop(rtuaddr)
-            k = self.__killsignals.pop(rtuaddr)
-            self.__rtu_asdu.pop(rtuaddr)
-            s.close()
+        if len(self.rtus) > 0:
+            rtuaddr = runprompt(listq(message='Disconnect from which RTU?', choices=self.rtus))
+            print(f'Terminating connection with {rtuaddr:s} ... ')
+            if not self.disconnect(rtuaddr):
+                print(f'STOPDT not confirmed by {rtuaddr:s}')
         else:
             print('Not connected to any RTUs')
 
     def do_send(self, arg):
         'Send a command to an RTU'
-        if len(self.__rtu_comms) > 0:
-            rtuaddr = runprompt(listq(message='Send a command to which RTU?', choices=self.__rtu_comms.keys()))
+        if len(self.rtus) > 0:
+            rtuaddr = runprompt(listq(message='Send a command to which RTU?', choices=self.rtus))
             breakers = []
-            for i in self.__rtu_data[rtuaddr]['ioas'].keys():
-                if IOAS[i][0] == 'Breaker':
+            values = self.__master[rtuaddr].values
+            for i in values.keys():
+                if i in IOAS and IOAS[i].command is not None:
                     breakers.append(str(i))
             if len(breakers) > 0:
                 ioa = int(runprompt(listq(message='Send command to which IOA?', choices=breakers)))
-                status = int(self.__rtu_data[rtuaddr]['ioas'][ioa]) >> 1
-                print(f"{self.__rtu_data[rtuaddr]['ioas']} {status}")
+                status = int(values[ioa]) >> 1
                 if status == 0:
                     print('The last known state is CLOSED')
                     ans = runprompt(listq(message='Would you like to OPEN this IOA?', choices=['Yes', 'No']))
@@ -192,68 +138,111 @@ class SCADACLI(Cmd):
                     print('The last known state is OPEN')
                     ans = runprompt(listq(message='Would you like to CLOSE this IOA?', choices=['Yes', 'No']))
                 if ans == 'Yes':
-                    status = 1 if status > 0 else 2
-                    self.__rtu_data[rtuaddr]['tx'] += 1
-                    self.__rtu_i_state[rtuaddr] = (0x07 << 8) | 0x80 | status
-                    pkt = build_104_asdu_packet(45, self.__rtu_asdu[rtuaddr], ioa, self.__rtu_data[rtuaddr]['tx'], self.__rtu_data[rtuaddr]['rx'], 6, SE=1, QU=1, SCS=status)
-                    self.__rtu_comms[rtuaddr].send(pkt)
-                    while self.__rtu_i_state[rtuaddr] is not None and self.__rtu_i_state[rtuaddr] > 0:
-                        print(f'\rSending single command (SELECT) to {rtuaddr:s} ... ', end='')
-                        sleep(0.25)
-                    print('')
-                    if self.__rtu_i_state[rtuaddr] is None:
-                        print(f'Error sending command to {rtuaddr:s}')
+                    scs = 1 if status > 0 else 0 # CLOSE / OPEN
+                    print(f'\rSending single command (SELECT/EXECUTE) to {rtuaddr:s} ... ', end='')
+                    if self.send_commands([(rtuaddr, ioa, scs)])[(rtuaddr, ioa)]:
+                        print('Done')
                     else:
-                        self.__rtu_i_state[rtuaddr] = (0x07 << 8) | status
-                        pkt = build_104_asdu_packet(45, self.__rtu_asdu[rtuaddr], ioa, self.__rtu_data[rtuaddr]['tx'], self.__rtu_data[rtuaddr]['rx'], 6, SE=0, QU=1, SCS=status)
-                        self.__rtu_comms[rtuaddr].send(pkt)
-                        while self.__rtu_i_state[rtuaddr] is not None and self.__rtu_i_state[rtuaddr] > 0:
-                            print(f'\rSending single command (EXECUTE) to {rtuaddr:s} ... ')
-                            sleep(0.25)
                         print('')
+                        print(f'Error sending command to {rtuaddr:s}')
             else:
                 print('This RTU cannot receive any commands')
         else:
             print('''Not connected to any RTUs''')
         return False
     
+    def do_batch(self, arg: str):
+        'Send commands to several breakers: batch <RTU>:<IOA>:<OPEN|CLOSE> ...'
+        commands = []
+        try:
+            for cmd in arg.split():
+                rtuaddr, ioa, action = cmd.split(':')
+                assert action.upper() in ['OPEN', 'CLOSE']
+                commands.append((rtuaddr, int(ioa), 1 if action.upper() == 'CLOSE' else 0))
+        except (ValueError, AssertionError):
+            print('Invalid command. Usage: batch <RTU>:<IOA>:<OPEN|CLOSE> ...')
+            return False
+        if len(commands) > 0:
+            for (rtuaddr, ioa), done in self.send_commands(commands).items():
+                print(f'{rtuaddr:s} IOA {ioa:d}: {"Done" if done else "Error"}')
+        return False
+
     def do_status(self, arg):
         'Get the status of an RTU'
-        if len(self.__rtu_comms) > 0:
-            if arg and arg not in self.__rtu_data.keys():
+        if len(self.rtus) > 0:
+            if arg and arg not in self.rtus:
                 print('RTU %s not found' % arg)
                 return False
             elif arg:
                 addr = arg
             else:
-                addr = runprompt(listq(message='Get the status of which RTU?', choices=self.__rtu_comms.keys()))
-            data = self.__rtu_data[addr]['ioas']
+                addr = runprompt(listq(message='Get the status of which RTU?', choices=self.rtus))
+            data = self.__master[addr].values
             print('\r\nCurrent status of RTU %s:' % addr)
             print('='*40)
             for k, v in data.items():
+                if k not in IOAS:
+                    continue
                 print('IOA %d:' % k)
                 print('-'*15)
-                print('Type: %s' % IOAS[k][0])
+                print('Type: %s' % IOAS[k].name)
                 value = v
-                if IOAS[k][0] is not 'Breaker':
-                    print('Value: {0:5.12f} {1:s}'.format(value, IOAS[k][1]))
+                if IOAS[k].command is None:
+                    print('Value: {0:5.12f} {1:s}'.format(value, IOAS[k].unit))
                 else:
-                    value = 'CLOSED' if value == 0 else 'OPEN'
+                    value = 'CLOSED' if int(value) >> 1 == 0 else 'OPEN'
                     print('Value: %s' % value)
             print('='*40 + '\r\n')
         else:
             print('''Not connected to any RTUs''')
         return False
 
+    async def __subscribe(self, callback, subscribe: bool=True):
+        'Change the master subscribers from within its event loop'
+        if subscribe:
+            self.__master.subscribe(callback)
+        else:
+            self.__master.unsubscribe(callback)
+
+    def do_record(self, arg: str):
+        'Record every received measurement: record <DIRECTORY>. Without arguments, stop recording'
+        if self.__recorder is not None:
+            self.__call(self.__subscribe(self.__recorder, False))
+            try:
+                self.__recorder.close()
+                print(f'Recorded {self.__recorder.segments:d} segments in {self.__recorder.path:s} ({self.__recorder.dropped:d} dropped)')
+            except OSError as ex:
+                print(f'Recording failed: {ex}')
+            self.__recorder = None
+        if arg:
+            from nefics.recorder import Recorder
+            self.__recorder = Recorder(arg)
+            self.__call(self.__subscribe(self.__recorder))
+            print(f'Recording measurements in {arg:s} ({self.__recorder.format:s})')
+        return False
+
+    def do_log(self, arg: str):
+        'Log the master events (and frames at DEBUG level): log <FILE> [text|jsonl|binary] [LEVEL]. Without arguments, stop logging'
+        args = arg.split()
+        if not args:
+            configure('master')
+            return False
+        fmt = args[1] if len(args) > 1 else 'text'
+        level = args[2].upper() if len(args) > 2 else 'INFO'
+        if fmt not in FORMATS.keys() or level not in LOG_PRIO.keys():
+            print('Invalid command. Usage: log <FILE> [text|jsonl|binary] [CRITICAL|ERROR|WARNING|INFO|DEBUG]')
+            return False
+        configure('master', args[0], fmt, LOG_PRIO[level])
+        print(f'Logging the master events in {args[0]:s} ({fmt:s}, {level:s})')
+        return False
+
     def do_exit(self, arg):
         'Close RTU connections and exit'
-        self.__done = True
-        for k, t in self.__threads.items():
-            t.join()
-        for k, t in self.__keepalive.items():
-            t.join()
-        for k, s in self.__rtu_comms.items():
-            s.close()
+        self.do_record('')
+        self.__call(self.__master.close())
+        self.do_log('')
+        self.__loop.call_soon_threadsafe(self.__loop.stop)
+        self.__thread.join()
         return True
 
 if __name__ == '__main__':
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import importlib.util
+import numpy as np
+import pytest
+
+pytest.importorskip('sklearn')
+
+# The Detection scripts import each other as top level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'Detection'))
+
+def blobs(n: int=20) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return np.concatenate([rng.normal(center, 0.1, size=(n, 2)) for center in [0.0, 5.0, 10.0]])
+
+def test_elbow():
+    from sklearn.cluster import KMeans
+    import paramDecider
+    df = blobs()
+    distortions, done = paramDecider.elbow([KMeans(n_clusters=k, random_state=0, n_init=3) for k in [1, 2, 3, 4]], df, n_jobs=1)
+    assert done and len(distortions) == 4
+    assert distortions[0] > distortions[1] > distortions[2] > distortions[3]
+    # Sampled silhouettes too small to be scored
+    results = paramDecider.sweep(df, [2, 3], sample_size=2, n_jobs=1)
+    assert all(np.isnan(r['silhouette']) for r in results)
+
+def test_delta_m_chunks(tmp_path):
+    import pandas as pd
+    import measurementPrep
+    df = pd.DataFrame({'IOA': [1, 2, 1, 2, 1, 1], 'Measurement': [1.0, 10.0, 3.0, 15.0, 6.0, 10.0]})
+    df.to_csv(str(tmp_path / 'measurements.csv'), index=False)
+    chunks = list(measurementPrep.delta_m_chunks(str(tmp_path / 'measurements.csv'), chunksize=3))
+    assert len(chunks) == 2
+    assert pd.concat(chunks).deltaM.tolist() == measurementPrep.delta_m(df).deltaM.tolist() == [0.0, 0.0, 2.0, 5.0, 3.0, 4.0]
+
+def test_score_chunks(tmp_path):
+    import pandas as pd
+    import persistence
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'ASDU_Type-CauseTx': ['36-3'] * 90 + ['50-6'] * 10,
+        'IOA': np.tile([1001, 1002], 50),
+        'Measurement': np.concatenate([rng.normal(100.0, 1.0, 90), np.full(10, 500.0)]),
+    })
+    df.to_csv(str(tmp_path / 'capture.csv'), index=False)
+    model = str(tmp_path / 'model.joblib')
+    persistence.train(model, [str(tmp_path / 'capture.csv')], contamination=0.1)
+    expected = persistence.score(model, str(tmp_path / 'capture.csv'), str(tmp_path / 'whole.csv'), chunksize=100, n_jobs=1)
+    # Chunks are appended to the output as they are scored
+    for fmt in ['csv'] + (['parquet'] if importlib.util.find_spec('pyarrow') is not None else []):
+        output = str(tmp_path / f'scores.{fmt:s}')
+        assert persistence.score(model, str(tmp_path / 'capture.csv'), output, chunksize=30, n_jobs=2) == expected
+        scores = pd.read_csv(output) if fmt == 'csv' else pd.read_parquet(output)
+        assert len(scores) == 100 and scores['IOA'].tolist() == df['IOA'].tolist()
+        assert scores['anomaly'].tolist() == pd.read_csv(str(tmp_path / 'whole.csv'))['anomaly'].tolist()
+
+def test_tap_idle_latency(tmp_path):
+    import threading
+    from time import monotonic, sleep
+    from sklearn.cluster import KMeans
+    from scapy.layers.l2 import Ether
+    from scapy.layers.inet import IP, TCP
+    from scapy.utils import wrpcap
+    from nefics.IEC104.dissector import APDU, APCI, ASDU
+    from nefics.IEC104.ioa import IOA36, CP56Time
+    import online
+    from persistence import DEFAULT_FEATURES
+    asdu = ASDU(TypeId=36, SQ=0, NumIx=1, CauseTx=3, Test=0, OA=0, Addr=2, IOA=[IOA36(IOA=1001, Value=100.0, QDS=0, CP56Time=CP56Time())])
+    apdu = (APDU()/APCI(ApduLen=len(asdu.build()) + 4, Type=0x00, Tx=0, Rx=0)/asdu).build()
+    wrpcap(str(tmp_path / 'capture.pcap'), [
+        Ether()/IP(src='10.0.0.2', dst='10.0.0.1')/TCP(sport=2404, dport=40000, flags='S', seq=999),
+        Ether()/IP(src='10.0.0.2', dst='10.0.0.1')/TCP(sport=2404, dport=40000, flags='PA', seq=1000)/apdu
+    ])
+    # Every measurement is an anomaly
+    artifact = {'kind': 'kmeans', 'scaler': None, 'model': KMeans(n_clusters=1, n_init=1).fit(np.zeros((2, 4))),
+                'threshold': -1.0, 'features': DEFAULT_FEATURES, 'schema': {'window': 4}}
+    alerts = []
+    detector = online.OnlineDetector(artifact, batch_size=256, max_latency=0.05, alert=alerts.append)
+    r, w = os.pipe()
+    with open(r, 'rb') as reader:
+        with open(w, 'wb') as writer:
+            with open(str(tmp_path / 'capture.pcap'), 'rb') as capture:
+                writer.write(capture.read())
+            writer.flush()
+            tap = threading.Thread(target=online.run_tap, args=(detector, reader))
+            tap.start()
+            # The capture is still open and idle: the measurement is scored within the latency bound
+            deadline = monotonic() + 5
+            while not alerts and monotonic() < deadline:
+                sleep(0.01)
+            assert [(a['rtu'], a['ioa'], a['value']) for a in alerts] == [('10.0.0.2', 1001, 100.0)]
+            assert tap.is_alive()
+        tap.join(5)
+    assert not tap.is_alive() and detector.scored == 1
+
+def test_pipeline_cache(tmp_path):
+    import pandas as pd
+    import pipeline
+    rng = np.random.default_rng(0)
+    (tmp_path / 'input').mkdir()
+    def capture(name: str, offset: float):
+        pd.DataFrame({
+            'srcIP': '10.0.0.2', 'dstIP': '10.0.0.1',
+            'ASDU_Type-CauseTx': ['36-3'] * 30 + ['3-20'] * 10,
+            'IOA': [1001, 1002] * 15 + [101] * 10,
+            'Measurement': np.concatenate([rng.normal(offset, 1.0, 30), np.full(10, 2.0)]),
+        }).to_csv(str(tmp_path / 'input' / name), index=False)
+    capture('a.csv', 100.0)
+    capture('b.csv', 200.0)
+    outputs = [tmp_path / 'output' / f for f in ['normal_w_attack.csv', 'pca_label.csv']]
+    labels = pipeline.run(str(tmp_path / 'input'), str(tmp_path / 'output'), n_cluster=2, jobs=1, plot=False)
+    # Cache hit: the outputs are written again
+    for output in outputs:
+        output.unlink()
+    assert list(pipeline.run(str(tmp_path / 'input'), str(tmp_path / 'output'), n_cluster=2, jobs=1, plot=False)) == list(labels)
+    assert all(output.is_file() for output in outputs)
+    assert len(pd.read_csv(str(outputs[1]))) == 80
+    # The features of replaced inputs are evicted
+    capture('b.csv', 300.0)
+    pipeline.run(str(tmp_path / 'input'), str(tmp_path / 'output'), n_cluster=2, jobs=1, plot=False)
+    assert len(list((tmp_path / 'output' / '.cache').glob('features-*.pkl'))) == 2
+
+def test_clustering(tmp_path, monkeypatch):
+    import pandas as pd
+    from sklearn import decomposition
+    import clustering
+    monkeypatch.setattr(clustering, 'output_path', tmp_path)
+    # PCA is fitted incrementally above LARGE_INPUT rows
+    monkeypatch.setattr(clustering, 'LARGE_INPUT', 100)
+    monkeypatch.setattr(clustering, 'PCA_BATCH_SIZE', 50)
+    model, X = clustering._pca2(np.concatenate([blobs(), blobs()], axis=1))
+    assert isinstance(model, decomposition.PCA) and X.shape == (60, 2)
+    model, X = clustering._pca2(np.concatenate([blobs(50), blobs(50)], axis=1))
+    assert isinstance(model, decomposition.IncrementalPCA) and X.shape == (150, 2)
+    # km labels a copy of its input
+    df = pd.DataFrame(blobs(), columns=['a', 'b'])
+    original = df.copy()
+    labels, labelled = clustering.km(3, df)
+    assert df.equals(original) and 'clusters' not in df.columns
+    assert labelled['clusters'].tolist() == list(labels) and len(set(labels)) == 3
+    assert pd.read_csv(str(tmp_path / 'pca_label.csv'))['clusters'].is_monotonic_increasing
+    # Downsampled clusters keep their share of the points
+    coordinates = [np.arange(300), np.arange(100), np.arange(0)]
+    sampled = clustering._downsample(coordinates, 40)
+    assert [len(c) for c in sampled] == [30, 10, 0]
+    assert all(np.all(np.diff(c) > 0) and np.isin(c, full).all() for c, full in zip(sampled, coordinates))
+    assert clustering._downsample(coordinates, None) is coordinates
+    labels, _, _ = clustering.cluster_pipeline(df, 3, max_points=20)
+    assert len(labels) == 60 and (tmp_path / 'pca.eps').is_file()
+
+def test_synthetic():
+    import synthetic
+    from nefics.recorder import DETECTION_COLUMNS
+    steps = 2000
+    sc = synthetic.Scenario(steps, falsification_rate=0.01, injection_rate=0.002, attack_duration=(5, 10))
+    df = synthetic.simulate(sc, seed=1)
+    assert list(df.columns) == DETECTION_COLUMNS + ['label']
+    assert df['Time'].is_monotonic_increasing
+    # Periodic measurements: 2 + 3 breakers per step from the transmission, and 1 + 2 from the source and load
+    periodic = df[df['srcIP'] != synthetic.ATTACKER_IP]
+    periodic = periodic[periodic['ASDU_Type-CauseTx'] != '45-7']
+    assert len(periodic) == 8 * steps
+    # Labels: the source is never attacked, injected commands always are
+    assert (df[df['srcIP'] == synthetic.RTU_IPS['source']]['label'] == 0).all()
+    commands = df[df['ASDU_Type-CauseTx'].str.startswith('45-')]
+    assert len(commands) > 0 and (commands['label'] == 1).all()
+    assert len(commands) % (4 * len(sc.loads)) == 0
+    # Falsification ramp: 520000 + U(1, 1000), then decreasing by 500 + U(1, 100) per step
+    voltage = df[(df['srcIP'] == synthetic.RTU_IPS['transmission']) & (df['IOA'] == 1001)]
+    falsified = voltage['label'].values.astype(bool)
+    values = voltage['Measurement'].values
+    assert falsified.any() and (values[~falsified] < 530000).all()
+    starts = np.flatnonzero(falsified & ~np.r_[False, falsified[:-1]])
+    assert ((values[starts] > 520000) & (values[starts] <= 521000)).all()
+    steps_down = np.diff(values)[falsified[1:] & falsified[:-1]]
+    assert ((steps_down <= -501) & (steps_down >= -600)).all()
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import socket
+from time import monotonic, sleep
+from nefics.modules.simplepowergrid import Transmission, IEC104DeviceHandler
+
+STARTDT_ACT = b'\x68\x04\x07\x00\x00\x00'
+STARTDT_CON = b'\x68\x04\x0b\x00\x00\x00'
+TESTFR_ACT = b'\x68\x04\x43\x00\x00\x00'
+TESTFR_CON = b'\x68\x04\x83\x00\x00\x00'
+
+def wait_for(condition, limit: float=5.0) -> bool:
+    deadline = monotonic() + limit
+    while not condition() and monotonic() < deadline:
+        sleep(0.05)
+    return condition()
+
+def test_session_fault_isolation():
+    device = Transmission(7, [6], [8], loads=[100.0, 100.0], state=3)
+    handler = IEC104DeviceHandler(device, '127.0.0.1', 0, max_sessions=1)
+    handler.start()
+    try:
+        session = socket.create_connection(('127.0.0.1', handler.port), timeout=5)
+        # Truncated I-frame (the ASDU header needs 6 octets) and an I-frame without ASDU: discarded
+        session.sendall(b'\x68\x06\x00\x00\x00\x00\x24\x01' + b'\x68\x04\x00\x00\x00\x00' + TESTFR_ACT)
+        assert session.recv(6) == TESTFR_CON
+        assert handler.sessions == 1
+        # The session table is full
+        rejected = socket.create_connection(('127.0.0.1', handler.port), timeout=5)
+        assert rejected.recv(6) == b''
+        rejected.close()
+        assert wait_for(lambda: handler.counters['rejected'] == 1)
+        # The session is still served
+        session.sendall(STARTDT_ACT)
+        assert session.recv(6) == STARTDT_CON
+        # A frame without START octet: the session is closed along with its data transfer thread
+        session.sendall(b'\x00\x04\x07\x00\x00\x00')
+        session.settimeout(5)
+        while session.recv(1024):
+            pass
+        session.close()
+        assert wait_for(lambda: handler.sessions == 0)
+        assert handler._data_transfer_status == {}
+        counters = handler.counters
+        assert (counters['accepted'], counters['frames'], counters['malformed']) == (1, 5, 3)
+        # A new session is accepted, and closed by the peer
+        session = socket.create_connection(('127.0.0.1', handler.port), timeout=5)
+        session.sendall(TESTFR_ACT)
+        assert session.recv(6) == TESTFR_CON
+        session.close()
+        assert wait_for(lambda: handler.sessions == 0)
+        assert handler.counters['accepted'] == 2
+        assert 'malformed' in str(handler)
+    finally:
+        handler.terminate = True
+        device.terminate = True
+        handler.join()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import struct
+from scapy.packet import NoPayload
+from nefics.IEC104.dissector import APDU as ScapyAPDU
+from nefics.IEC104.ioa import IOAS, IOALEN
+from nefics.IEC104.fast import APDU, APCI, ASDU, IOA, SCO, CP56Time, CODECS, apdus, from_scapy, to_scapy
+
+def asdu(typeid: int, numix: int, sq: bool=False) -> bytes:
+    # Every element byte is valid for any field type (floats, qualifiers, time tags)
+    length = IOALEN[typeid] - 3
+    elements = [(struct.pack('<I', 1001 + i)[:3] if not sq or i == 0 else b'') + bytes((i + j) % 0x40 for j in range(length)) for i in range(numix)]
+    return struct.pack('<BBBBH', typeid, (0x80 if sq else 0x00) | numix, 0x43, 0, 2) + b''.join(elements)
+
+def test_codecs_match_scapy():
+    assert sorted(CODECS.keys()) == sorted(IOAS.keys())
+    for typeid in IOAS.keys():
+        assert CODECS[typeid].length == IOALEN[typeid]
+        for sq in [False, True]:
+            data = struct.pack('<BBHH', 0x68, 4 + len(asdu(typeid, 3, sq)), 5 << 1, 7 << 1) + asdu(typeid, 3, sq)
+            apdu = APDU(data)
+            scapy_apdu = ScapyAPDU(data)
+            assert (apdu['APCI'].Tx, apdu['APCI'].Rx) == (5, 7)
+            assert (apdu['ASDU'].TypeId, apdu['ASDU'].CauseTx, apdu['ASDU'].PN, apdu['ASDU'].Addr) == (typeid, 3, 0x40, 2)
+            assert [i.IOA for i in apdu['ASDU'].IOA] == [1001, 1002, 1003]
+            assert [i.build() for i in apdu['ASDU'].IOA] == [i.build() for i in scapy_apdu['ASDU'].IOA]
+            # Qualifiers and time tags leave the following fields to the information object
+            assert all(isinstance(i.getfieldval(f.name).payload, NoPayload) for i in scapy_apdu['ASDU'].IOA for f in i.packetfields)
+            assert apdu.build() == data
+            assert [i.build() for i in to_scapy(apdu)['ASDU'].IOA] == [i.build() for i in scapy_apdu['ASDU'].IOA]
+            if not sq: # The scapy ASDU encodes the address of every object
+                assert scapy_apdu.build() == from_scapy(scapy_apdu).build() == data
+
+def test_build_and_lookup():
+    command = APDU()/APCI(Type=0x00, Tx=1, Rx=2)/ASDU(TypeId=45, CauseTx=6, Addr=2, IOA=IOA(45, IOA=101, SCO=SCO(SE=1, QU=1, SCS=0)))
+    data = command.build()
+    assert data[1] == len(data) - 2
+    assert ScapyAPDU(data)['IOA45'].SCO.SE == 1
+    apdu = APDU(data)
+    assert apdu.haslayer('IOA45') and not apdu.haslayer('IOA36')
+    assert (apdu['IOA45'].IOA, apdu['SCO'].SE, apdu['SCO'].QU, apdu['SCO'].SCS) == (101, 1, 1, 0)
+    measurement = IOA(36, IOA=1001, Value=2.5, QDS=0, CP56Time=CP56Time(MS=1500, Min=2, Hour=3, Day=4, DOW=5, Month=6, Year=24))
+    assert from_scapy(to_scapy(measurement)) == measurement
+
+def test_stream():
+    frames = [b'\x68\x04\x07\x00\x00\x00', b'\x68\x04\x01\x00\x0a\x00', struct.pack('<BBHH', 0x68, 4 + len(asdu(36, 2)), 0, 0) + asdu(36, 2)]
+    decoded = list(apdus(b''.join(frames) + frames[2][:10]))
+    assert [a['APCI'].Type for a in decoded] == [0x03, 0x01, 0x00]
+    assert decoded[0]['APCI'].UType == 0x01
+    assert decoded[1]['APCI'].Rx == 5
+    assert len(decoded[2]['ASDU'].IOA) == 2
+
+def test_unknown_type():
+    # F_SG_NA_1 (125) segments have a variable length: passed through as raw octets
+    data = b'\x68\x0e\x04\x00\x02\x00\x7d\x01\x06\x00\x0a\x00\x01\x02\x03\x04'
+    for apdu in [APDU(data), ScapyAPDU(data)]:
+        assert apdu['ASDU'].TypeId == 125
+        assert apdu['ASDU'].IOA is None
+        assert apdu['ASDU'].RawIOA == b'\x01\x02\x03\x04'
+        assert not apdu.haslayer('IOA125')
+        assert apdu.build() == data
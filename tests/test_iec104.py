@@ -1,7 +1,11 @@
 #!/usr/bin/env python3
 
-from nefics.IEC104.dissector import APDU, APCI, ASDU
-from nefics.IEC104.ioa import DIQ, IOA3
+from copy import deepcopy
+from nefics.IEC104 import fast
+from nefics.IEC104.dissector import APDU, APCI, ASDU, IOAList
+from nefics.IEC104.ioa import DIQ, IOA3, IOA37, IOA101, CP56Time
+from nefics.modules.devicebase import IEDBase
+from nefics.pointtable import measurement_points
 
 def test_TESTFR_actcon():
     apdu = APDU(b'\x68\x04\x83\x00\x00\x00')
@@ -109,3 +113,83 @@ def test_asdu_type36():
     assert ioa.IOA == 1225
     assert str(round(ioa.Value, 2)) == '15.62'
 
+
+def test_asdu_type101():
+    apdu = APDU(b'\x68\x0e\x04\x00\x02\x00\x65\x01\x06\x00\x0a\x00\x00\x00\x00\x05')
+    assert apdu.haslayer('IOA101')
+    apci = apdu['APCI']
+    asdu = apdu['ASDU']
+    ioa = apdu['IOA101']
+    assert isinstance(ioa, IOA101)
+    assert apci.ApduLen == 14
+    assert apci.Tx == 2
+    assert apci.Rx == 1
+    assert asdu.TypeId == 101
+    assert asdu.NumIx == 1
+    assert asdu.CauseTx == 6
+    assert asdu.Addr == 10
+    assert ioa.IOA == 0
+    assert ioa.QCC == 5
+
+def test_lazy_ioas():
+    # Three type 3 objects: 101, 102 and 103 (SQ=1 in the second ASDU)
+    asdu = ASDU(b'\x03\x03\x03\x00\x0a\x00\x65\x00\x00\x01\x66\x00\x00\x02\x67\x00\x00\x01')
+    sq = ASDU(b'\x03\x83\x03\x00\x0a\x00\x65\x00\x00\x01\x02\x01')
+    for pkt in [asdu, sq]:
+        ioas = pkt.IOA
+        assert isinstance(ioas, IOAList)
+        assert len(ioas) == 3
+        assert list.__getitem__(ioas, 1) is None # Not decoded yet
+        assert ioas[-1].IOA == 103
+        assert [i.IOA for i in ioas] == [101, 102, 103]
+        assert [i.DIQ.DPI for i in ioas] == [1, 2, 1]
+        assert pkt.haslayer('DIQ')
+    assert sq.build() == b'\x03\x83\x03\x00\x0a\x00\x65\x00\x00\x01\x66\x00\x00\x02\x67\x00\x00\x01'
+    copy = deepcopy(ASDU(asdu.build()))
+    assert [i.IOA for i in copy.IOA] == [101, 102, 103]
+    ioas = ASDU(asdu.build()).IOA
+    ioas.append(IOA3(IOA=104, DIQ=DIQ(DPI=2)))
+    assert [i.IOA for i in ioas] == [101, 102, 103, 104]
+
+class Meter(IEDBase):
+    'Device reporting a current (IOA 1002) and an integrated total (IOA 2001)'
+
+    def __init__(self):
+        super().__init__(9, [], [])
+        self.amp = 1.0
+        self._load_points(measurement_points(None, 'amp'))
+
+    def counters_IEC104(self) -> list:
+        return [IOA37(IOA=2001, Binary_Counter=12, SQ=0, CP56Time=CP56Time())]
+
+    def simulate(self):
+        self.amp += 1.0
+        self.terminate = True
+
+def interrogation(typeid: int, cot: int, addr: int, qualifier: int) -> fast.APDU:
+    return fast.APDU(bytes([0x68, 0x0e, 0x00, 0x00, 0x00, 0x00, typeid, 0x01, cot, 0x00, addr & 0xff, addr >> 8, 0x00, 0x00, 0x00, qualifier]))
+
+def asdus(frames: list) -> list:
+    return [fast.APDU(frame)['ASDU'] for frame in frames]
+
+def test_interrogation():
+    device = Meter()
+    try:
+        # General interrogation: ActCon, the snapshot (CoT 20, inrogen) and ActTerm
+        replies = asdus(device.handle_IEC104_interrogation(interrogation(100, 6, 9, 20)))
+        assert [(a.TypeId, a.CauseTx, a.Addr) for a in replies] == [(100, 7, 9), (36, 20, 9), (100, 10, 9)]
+        assert [(i.IOA, i.Value) for i in replies[1].IOA] == [(1002, 1.0)]
+        # Broadcasted counter interrogation (RQT 5): ActCon, the counters (CoT 37) and ActTerm
+        replies = asdus(device.handle_IEC104_interrogation(interrogation(101, 6, 0xffff, 5)))
+        assert [(a.TypeId, a.CauseTx) for a in replies] == [(101, 7), (37, 37), (101, 10)]
+        assert replies[1].IOA[0].IOA == 2001
+        # Unknown cause of transmission and unknown common address: a single negative reply
+        assert [(a.TypeId, a.CauseTx) for a in asdus(device.handle_IEC104_interrogation(interrogation(100, 8, 9, 20)))] == [(100, 45)]
+        assert [(a.TypeId, a.CauseTx) for a in asdus(device.handle_IEC104_interrogation(interrogation(100, 6, 10, 20)))] == [(100, 46)]
+        # The snapshot is cached until the next simulation step
+        device.amp = 5.0
+        assert asdus(device.handle_IEC104_interrogation(interrogation(100, 6, 9, 20)))[1].IOA[0].Value == 1.0
+        device.sim_handler()
+        assert asdus(device.handle_IEC104_interrogation(interrogation(100, 6, 9, 20)))[1].IOA[0].Value == 6.0
+    finally:
+        device._sock.close()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import io
+import os
+import json
+from nefics import logger as nlog
+from nefics.logger import LOG_PRIO, Frame, configure, release, flush, records
+
+STARTDT_ACT = b'\x68\x04\x07\x00\x00\x00'
+
+class Counted(object):
+    'Argument counting its formatting'
+
+    def __init__(self):
+        self.calls = 0
+
+    def __str__(self) -> str:
+        self.calls += 1
+        return 'counted'
+
+def test_text_and_levels(tmp_path):
+    path = str(tmp_path / 'logs' / 'device.txt')
+    arg = Counted()
+    logger = configure('test.text', path, 'text', LOG_PRIO['INFO'])
+    logger.debug('Discarded %s', arg)
+    logger.info('Frame %s\r\n', Frame(STARTDT_ACT))
+    logger.warning('Malformed %s', Frame(b'\x68\x01'))
+    release(logger)
+    flush()
+    assert arg.calls == 0
+    with open(path, newline='') as log:
+        lines = log.read().split('\r\n')
+    assert lines[-1] == ''
+    assert lines[0].endswith('\t[INFO] :: Frame <APDU <APCI ApduLen=4 Type=U UType=0x01>>')
+    assert lines[1].endswith('\t[WARNING] :: Malformed <Malformed APDU 6801>')
+    # Released loggers discard their records
+    logger.critical('Discarded')
+    flush()
+    with open(path, newline='') as log:
+        assert len(log.read().split('\r\n')) == 3
+
+def test_jsonl_stream():
+    stream = io.StringIO()
+    logger = configure('test.jsonl', stream, 'jsonl', LOG_PRIO['DEBUG'])
+    logger.debug('Sent to %s: %s', '10.0.0.2', Frame(STARTDT_ACT))
+    release(logger)
+    flush()
+    line = json.loads(stream.getvalue())
+    assert (line['level'], line['logger']) == ('DEBUG', 'nefics.test.jsonl')
+    assert line['message'] == 'Sent to 10.0.0.2: <APDU <APCI ApduLen=4 Type=U UType=0x01>>'
+    assert line['frames'] == [STARTDT_ACT.hex()]
+
+def test_binary_rotation(tmp_path):
+    path = str(tmp_path / 'rtu.bin')
+    logger = configure('test.binary', path, 'binary', LOG_PRIO['DEBUG'], max_bytes=512, backups=2)
+    for i in range(20):
+        logger.info('Frames %d: %s %s', i, Frame(STARTDT_ACT), Frame(b'\x68\x01'))
+    release(logger)
+    flush()
+    assert sorted(os.listdir(str(tmp_path))) == ['rtu.bin', 'rtu.bin.1', 'rtu.bin.2']
+    assert all(os.path.getsize(str(tmp_path / f)) <= 512 for f in os.listdir(str(tmp_path)))
+    logged = list(records(path))
+    assert logged[-1]['message'] == 'Frames 19: <frame> <frame>'
+    assert logged[-1]['frames'] == [STARTDT_ACT, b'\x68\x01']
+    assert (logged[-1]['level'], logged[-1]['logger']) == ('INFO', 'nefics.test.binary')
+    assert nlog.dropped() == 0
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+import asyncio
+from nefics.IEC104.dissector import APDU, APCI, ASDU
+from nefics.IEC104.ioa import IOA36, IOA100, CP56Time
+from nefics.master import Master
+
+def iframe(asdu: ASDU) -> bytes:
+    return (APDU()/APCI(ApduLen=len(asdu.build()) + 4, Type=0x00, Tx=0, Rx=0)/asdu).build()
+
+async def fake_rtu(reader, writer):
+    try:
+        while True:
+            header = await reader.readexactly(2)
+            data = APDU(header + await reader.readexactly(header[1]))
+            if data['APCI'].Type == 0x03:
+                writer.write((APDU()/APCI(ApduLen=4, Type=0x03, UType=data['APCI'].UType << 1)).build())
+            elif data['ASDU'].TypeId == 100:
+                # A truncated I-frame, dropped by the master
+                writer.write(b'\x68\x05\x00\x00\x00\x00\x24')
+                writer.write(iframe(ASDU(TypeId=100, SQ=0, NumIx=1, CauseTx=7, Test=0, OA=0, Addr=2, IOA=[IOA100(IOA=0, QOI=20)])))
+                writer.write(iframe(ASDU(TypeId=36, SQ=0, NumIx=2, CauseTx=20, Test=0, OA=0, Addr=2, IOA=[
+                    IOA36(IOA=1001, Value=100.0, QDS=0, CP56Time=CP56Time()),
+                    IOA36(IOA=1002, Value=2.5, QDS=0, CP56Time=CP56Time())
+                ])))
+                writer.write(iframe(ASDU(TypeId=100, SQ=0, NumIx=1, CauseTx=10, Test=0, OA=0, Addr=2, IOA=[IOA100(IOA=0, QOI=20)])))
+    except asyncio.IncompleteReadError:
+        writer.close()
+
+def test_master():
+    async def run():
+        server = await asyncio.start_server(fake_rtu, '127.0.0.1', 0)
+        master = Master(port=server.sockets[0].getsockname()[1])
+        measurements = []
+        master.subscribe(lambda measurement: 1 / 0)
+        master.subscribe(measurements.append)
+        # Requests to unknown RTUs are not confirmed
+        assert not await master.startdt('127.0.0.2')
+        assert await master.interrogate('127.0.0.2') is None
+        assert not await master.command('127.0.0.2', 101, 1)
+        assert not await master.disconnect('127.0.0.2')
+        await master.connect('127.0.0.1', 2)
+        assert await master.startdt('127.0.0.1')
+        values = await master.interrogate('127.0.0.1')
+        assert values == {1001: 100.0, 1002: 2.5}
+        assert [(m['ioa'], m['cot']) for m in measurements] == [(1001, 20), (1002, 20)]
+        assert master['127.0.0.1'].malformed == 1 and not master['127.0.0.1'].closed
+        assert await master.disconnect('127.0.0.1')
+        server.close()
+        await server.wait_closed()
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import pytest
+from scapy.layers.l2 import Ether
+from scapy.layers.inet import IP, TCP
+from nefics.IEC104.dissector import APDU, APCI, ASDU
+from nefics.IEC104.ioa import IOA36, CP56Time
+from mitm import Rewriter, checksum_update, _sum16
+
+RTU = ('10.0.0.2', '02:00:00:00:00:02')
+SCADA = ('10.0.0.1', '02:00:00:00:00:01')
+MITM = '02:00:00:00:00:03'
+
+def segment(payload: bytes) -> memoryview:
+    pkt = Ether(dst=MITM, src=RTU[1])/IP(src=RTU[0], dst=SCADA[0])/TCP(sport=2404, dport=40000, flags='PA')/payload
+    return memoryview(bytearray(pkt.build()))
+
+def measurements(*values) -> bytes:
+    asdu = ASDU(TypeId=36, SQ=0, NumIx=len(values), CauseTx=3, Test=0, OA=0, Addr=2, IOA=[
+        IOA36(IOA=1001 + i, Value=value, QDS=0, CP56Time=CP56Time()) for i, value in enumerate(values)
+    ])
+    return (APDU()/APCI(ApduLen=len(asdu.build()) + 4, Type=0x00, Tx=0, Rx=0)/asdu).build()
+
+def valid_checksum(frame: memoryview) -> bool:
+    # TCP checksum over the pseudo header and the segment (Ethernet + 20 octets IP header)
+    tcp = bytes(frame[34:])
+    pseudo = bytes(frame[26:34]) + struct.pack('!HH', 6, len(tcp))
+    return _sum16(pseudo + tcp + b'\x00' * (len(tcp) & 1)) == 0xffff
+
+def payload(frame: memoryview) -> bytes:
+    return bytes(frame[54:])
+
+def test_checksum_update():
+    data = bytearray(os.urandom(64))
+    checksum = ~_sum16(data) & 0xffff
+    old = bytes(data[10:16])
+    data[10:16] = os.urandom(6)
+    assert checksum_update(checksum, old, data[10:16]) == ~_sum16(data) & 0xffff
+
+def test_rewrite():
+    rewriter = Rewriter('lo', RTU, SCADA, MITM)
+    frame = segment(measurements(100.0, 2.5) + measurements(101.0))
+    assert rewriter.rewrite(frame)
+    assert (bytes(frame[0:6]).hex(':'), bytes(frame[6:12]).hex(':')) == (SCADA[1], MITM)
+    assert valid_checksum(frame) and rewriter.altered == 1
+    data = payload(frame)
+    first, second = APDU(data[:data[1] + 2]), APDU(data[data[1] + 2:])
+    assert [i.Value for i in first['ASDU'].IOA][1] == 2.5
+    # Every change of the voltage changes the falsified value
+    assert 500000.0 < first['ASDU'].IOA[0].Value != second['ASDU'].IOA[0].Value
+    assert second['ASDU'].IOA[0].Value == pytest.approx(rewriter.value_out)
+
+def test_rewrite_malformed():
+    rewriter = Rewriter('lo', RTU, SCADA, MITM)
+    # NumIx (5) larger than the objects present (1): only the present object is falsified
+    apdu = bytearray(measurements(100.0))
+    apdu[7] = 5
+    frame = segment(bytes(apdu))
+    assert rewriter.rewrite(frame)
+    assert valid_checksum(frame) and rewriter.altered == 1
+    assert struct.unpack_from('<f', payload(frame), 15)[0] == pytest.approx(rewriter.value_out)
+    # SQ=1 ASDU truncated within the IOA: forwarded unmodified
+    truncated = b'\x68\x0c\x00\x00\x00\x00' + b'\x24\x81\x03\x00\x02\x00' + b'\xe9\x03'
+    frame = segment(truncated)
+    assert rewriter.rewrite(frame)
+    assert payload(frame) == truncated
+    assert valid_checksum(frame) and rewriter.altered == 1
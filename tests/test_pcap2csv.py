@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+import csv
+from scapy.layers.l2 import Ether
+from scapy.layers.inet import IP, TCP
+from scapy.utils import wrpcap, wrpcapng
+from nefics.IEC104.dissector import APDU, APCI, ASDU
+from nefics.IEC104.ioa import IOA3, IOA36, DIQ, CP56Time
+from nefics.pcap2csv import convert, FAST_VALUES, CODECS
+from nefics.master import point_value
+from nefics.recorder import DETECTION_COLUMNS
+
+def frames() -> list:
+    data = b''
+    for i in range(3):
+        asdu = ASDU(TypeId=36, SQ=0, NumIx=2, CauseTx=3, Test=0, OA=0, Addr=2, IOA=[
+            IOA36(IOA=1001, Value=100.0 + i, QDS=0, CP56Time=CP56Time()),
+            IOA36(IOA=1002, Value=2.5, QDS=0, CP56Time=CP56Time())
+        ])
+        data += (APDU()/APCI(ApduLen=len(asdu.build()) + 4, Type=0x00, Tx=i, Rx=0)/asdu).build()
+    asdu = ASDU(TypeId=3, SQ=0, NumIx=1, CauseTx=20, Test=0, OA=0, Addr=2, IOA=[IOA3(IOA=101, DIQ=DIQ(DPI=2, flags=0))])
+    data += (APDU()/APCI(ApduLen=len(asdu.build()) + 4, Type=0x00, Tx=3, Rx=0)/asdu).build()
+    base = Ether()/IP(src='10.0.0.2', dst='10.0.0.1')/TCP(sport=2404, dport=40000, flags='PA')
+    # Split the stream at arbitrary offsets, out of order and with a retransmission
+    cuts = [0, 10, 47, 80, len(data)]
+    segments = [(cuts[i], data[cuts[i]:cuts[i + 1]]) for i in range(len(cuts) - 1)]
+    segments = [segments[0], segments[2], segments[1], segments[1], segments[3]]
+    pkts = [Ether()/IP(src='10.0.0.2', dst='10.0.0.1')/TCP(sport=2404, dport=40000, flags='S', seq=999)]
+    for offset, payload in segments:
+        pkt = base.copy()
+        pkt[TCP].seq = 1000 + offset
+        pkts.append(pkt/payload)
+    for i, pkt in enumerate(pkts):
+        pkt.time = 1000 + i
+    return pkts
+
+def test_convert(tmp_path):
+    for writer in [wrpcap, wrpcapng]:
+        capture = str(tmp_path / 'capture')
+        writer(capture, frames())
+        files = convert(capture, str(tmp_path / 'out'), jobs=2)
+        assert [f.split('/')[-1] for f in files] == ['10.0.0.2;10.0.0.1.csv']
+        with open(files[0]) as f:
+            rows = list(csv.DictReader(f))
+        assert list(rows[0].keys()) == DETECTION_COLUMNS
+        assert [(r['ASDU_Type-CauseTx'], r['IOA'], float(r['Measurement'])) for r in rows] == [
+            ('36-3', '1001', 100.0), ('36-3', '1002', 2.5),
+            ('36-3', '1001', 101.0), ('36-3', '1002', 2.5),
+            ('36-3', '1001', 102.0), ('36-3', '1002', 2.5),
+            ('3-20', '101', 2.0)
+        ]
+
+def test_fast_values():
+    # The fast decoders match the codec fallback (e.g. SE=1 single commands: (SE << 7) | SCS)
+    for typeid, fast in FAST_VALUES.items():
+        for octet in [0x00, 0x01, 0x02, 0x80, 0x81, 0xf3]:
+            element = b'\xe9\x03\x00' + bytes([octet, 0x40, 0x41, 0x42, 0x00, 0x00] + [1] * 7)[:CODECS[typeid].length - 3]
+            assert fast(element) == point_value(CODECS[typeid].decode(element, 3, 1001))
+    assert FAST_VALUES[45](b'\xe9\x03\x00\x81') == 129
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+
+from nefics.IEC104.ioa import IOA3, IOA36, CP56Time
+from nefics.pointtable import PointTable, measurement_points, breaker_points
+
+class Device(object):
+
+    def __init__(self):
+        self.vin = None
+        self.amp = 2.0
+        self.state = 0b01
+
+    def point_source(self, point):
+        if point.source == 'breaker':
+            return lambda: 0x01 if (self.state & (2 ** point.index)) > 0 else 0x02
+        return lambda: getattr(self, point.source)
+
+    def point_command(self, point):
+        return lambda p, scs: None
+
+def test_lookup():
+    table = PointTable.from_config(measurement_points() + breaker_points(2))
+    assert len(table) == 4
+    assert 1001 in table
+    assert 103 not in table
+    assert table[101].index == 0
+    assert table[102].command == 'breaker'
+    assert table.get(999) is None
+    assert [p.ioa for p in table] == [1001, 1002, 101, 102]
+
+def test_snapshot():
+    table = PointTable.from_config(measurement_points() + breaker_points(2))
+    table.bind(Device())
+    assert table[1001].handler is None
+    assert table[101].handler is not None
+    points = table.snapshot(CP56Time())
+    # The voltage has no value yet
+    assert [(t, p.IOA) for t, p in points] == [(36, 1002), (3, 101), (3, 102)]
+    assert isinstance(points[0][1], IOA36)
+    assert isinstance(points[1][1], IOA3)
+    assert points[1][1].DIQ.DPI == 0x01
+    assert points[2][1].DIQ.DPI == 0x02
+
+def test_deadband():
+    device = Device()
+    table = PointTable.from_config([{'ioa': 1002, 'type': 36, 'source': 'amp', 'deadband': 0.5}])
+    table.bind(device)
+    assert len(table.report(CP56Time())) == 1
+    device.amp = 2.4
+    assert len(table.report(CP56Time())) == 0
+    device.amp = 2.6
+    assert len(table.report(CP56Time())) == 1
+
+def test_deadband_sessions():
+    device = Device()
+    table = PointTable.from_config([{'ioa': 1002, 'type': 36, 'source': 'amp', 'deadband': 0.5}])
+    table.bind(device)
+    first, second = {}, {}
+    assert len(table.report(CP56Time(), first)) == 1
+    device.amp = 3.0
+    # A change reported to a session is still reported to the other ones
+    assert len(table.report(CP56Time(), first)) == 1
+    assert len(table.report(CP56Time(), second)) == 1
+    assert len(table.report(CP56Time(), first)) == len(table.report(CP56Time(), second)) == 0
+    assert first == second == {1002: 3.0}
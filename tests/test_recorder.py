@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+
+import pytest
+import numpy as np
+from threading import Event
+from nefics.recorder import pq, Recorder, load, to_detection, DETECTION_COLUMNS, MAX_PENDING_SEGMENTS
+
+def measurement(i: int) -> dict:
+    return {'time': float(i), 'rtu': '10.0.0.2', 'ca': 2, 'ioa': 1001 + (i % 2), 'type': 36, 'cot': 3, 'value': float(i) if i != 3 else None, 'quality': 0}
+
+def test_recorder(tmp_path):
+    for fmt in ['npz'] + (['parquet'] if pq is not None else []):
+        path = str(tmp_path / fmt)
+        recorder = Recorder(path, chunk_size=4, fmt=fmt)
+        for i in range(10):
+            recorder(measurement(i))
+        recorder.close()
+        assert recorder.segments == 3
+        df = load(path)
+        assert len(df) == 10
+        assert list(df['time']) == [float(i) for i in range(10)]
+        assert np.isnan(df['value'][3])
+        assert list(df['rtu'].unique()) == ['10.0.0.2']
+        det = to_detection(df, '10.0.0.1')
+        assert list(det.columns) == DETECTION_COLUMNS
+        assert det['ASDU_Type-CauseTx'][0] == '36-3'
+
+def test_recorder_backpressure(tmp_path, monkeypatch):
+    writing, release = Event(), Event()
+    savez = np.savez_compressed
+    def stalled(*args, **kwargs):
+        writing.set()
+        release.wait(5)
+        savez(*args, **kwargs)
+    monkeypatch.setattr(np, 'savez_compressed', stalled)
+    recorder = Recorder(str(tmp_path / 'stalled'), chunk_size=1, fmt='npz')
+    recorder(measurement(0))
+    assert writing.wait(5)
+    # The writer is stalled: the recorder does not block, it drops the segments
+    for i in range(1, MAX_PENDING_SEGMENTS + 3):
+        recorder(measurement(i))
+    assert (recorder.segments, recorder.dropped) == (MAX_PENDING_SEGMENTS + 1, 2)
+    release.set()
+    recorder.close()
+    assert len(load(str(tmp_path / 'stalled'))) == MAX_PENDING_SEGMENTS + 1
+    # Writer failures are raised by the recorder
+    def failing(*args, **kwargs):
+        raise OSError('No space left on device')
+    monkeypatch.setattr(np, 'savez_compressed', failing)
+    recorder = Recorder(str(tmp_path / 'failing'), chunk_size=1, fmt='npz')
+    recorder(measurement(0))
+    with pytest.raises(OSError):
+        recorder.close()
+    assert isinstance(recorder.error, OSError)
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import asyncio
+import pytest
+from scapy.utils import wrpcap
+from nefics.master import Master
+from nefics.recorder import Recorder
+from nefics.replay import ReplayServer, load_capture, load_recording
+from tests.test_pcap2csv import frames
+
+def replay(asdus: dict, speed: float=None) -> tuple:
+    async def run():
+        server = ReplayServer(asdus, speed=speed, port=0)
+        await server.start()
+        address, port = server.endpoints['10.0.0.2']
+        master = Master(port=port)
+        measurements = []
+        master.subscribe(measurements.append)
+        session = await master.connect(address, 2)
+        assert await session.startdt()
+        deadline = asyncio.get_running_loop().time() + 5
+        while len(measurements) < 7 and asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(0.01)
+        assert len(measurements) >= 7
+        values = await session.interrogate()
+        assert not await session.command(101, 0)
+        await master.close()
+        await server.close()
+        return measurements, values, server.sessions[0]
+    return asyncio.run(run())
+
+def test_replay_capture(tmp_path):
+    capture = str(tmp_path / 'capture.pcap')
+    wrpcap(capture, frames())
+    asdus = load_capture(capture)
+    assert list(asdus.keys()) == ['10.0.0.2']
+    assert len(asdus['10.0.0.2']) == 4
+    measurements, values, session = replay(asdus)
+    assert [(m['ioa'], m['cot'], m['value']) for m in measurements[:7]] == [
+        (1001, 3, 100.0), (1002, 3, 2.5),
+        (1001, 3, 101.0), (1002, 3, 2.5),
+        (1001, 3, 102.0), (1002, 3, 2.5),
+        (101, 20, 2)
+    ]
+    assert values == {1001: 102.0, 1002: 2.5, 101: 2}
+    assert session.sent == 4
+
+def test_replay_recording(tmp_path):
+    path = str(tmp_path / 'recording')
+    recorder = Recorder(path, fmt='npz')
+    for i in range(3):
+        recorder({'time': float(i), 'rtu': '10.0.0.2', 'ca': 2, 'ioa': 1001, 'type': 36, 'cot': 3, 'value': 100.0 + i, 'quality': 0})
+        recorder({'time': float(i), 'rtu': '10.0.0.2', 'ca': 2, 'ioa': 1002, 'type': 36, 'cot': 3, 'value': 2.5, 'quality': 0})
+    recorder({'time': 3.0, 'rtu': '10.0.0.2', 'ca': 2, 'ioa': 101, 'type': 3, 'cot': 20, 'value': 2, 'quality': 0})
+    recorder.close()
+    asdus = load_recording(path)
+    assert [asdu[1] for _, asdu in asdus['10.0.0.2']] == [2, 2, 2, 1] # NumIx
+    measurements, values, _ = replay(asdus)
+    assert [(m['ioa'], m['value']) for m in measurements[:7]] == [
+        (1001, 100.0), (1002, 2.5), (1001, 101.0), (1002, 2.5), (1001, 102.0), (1002, 2.5), (101, 2)
+    ]
+    assert values == {1001: 102.0, 1002: 2.5, 101: 2}
+
+def test_replay_timing(tmp_path):
+    capture = str(tmp_path / 'capture.pcap')
+    wrpcap(capture, frames())
+    asdus = load_capture(capture)
+    span = asdus['10.0.0.2'][-1][0] - asdus['10.0.0.2'][0][0]
+    assert span > 0
+    # The frames keep their spacing, scaled by the speed
+    measurements, values, session = replay(asdus, speed=span / 0.2)
+    assert measurements[6]['time'] - measurements[0]['time'] >= 0.18
+    assert values == {1001: 102.0, 1002: 2.5, 101: 2}
+    assert session.sent == 4
+    for speed in [0, -1.0]:
+        with pytest.raises(AssertionError):
+            ReplayServer(asdus, speed=speed)